@@ -0,0 +1,88 @@
+"""
+accuracy against throughput of int8 dynamically quantized inference
+
+    python -m benchmark.quantize_report --load_arg checkpoint/ner_stack_lstm.json --load_check_point checkpoint/ner_stack_lstm.model --dev_file dev.txt
+
+decodes the labelled --dev_file with the float32 model and with its quantized copy (see
+TransitionNER.quantize) and prints entity f1, action accuracy, sentences/s and the size of the
+serialized weights of both, plus the share of sentences whose predicted actions differ
+"""
+from __future__ import print_function
+import argparse
+import codecs
+import io
+import json
+import time
+
+import torch
+
+from model.predictor import Predictor
+import model.evaluate as evaluate
+import model.utils as utils
+
+
+def weight_bytes(ner_model):
+    buf = io.BytesIO()
+    torch.save(ner_model.state_dict(), buf)
+    return buf.tell()
+
+
+def decode_all(ner_model, batches, seed):
+    torch.manual_seed(seed)
+    start = time.perf_counter()
+    pre_actions = [pre_action for feature, _, _ in batches for pre_action in evaluate.decode_batch(ner_model, feature, False)]
+    return pre_actions, time.perf_counter() - start
+
+
+def score(ner_model, batches, a_map, seed):
+    torch.manual_seed(seed)
+    return evaluate.calc_f1_score(ner_model, [batches], a_map, False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Accuracy and throughput of int8 quantized inference')
+    parser.add_argument('--load_arg', default='./checkpoint/ner_stack_lstm.json', help='arg json file path')
+    parser.add_argument('--load_check_point', default='./checkpoint/ner_stack_lstm.model', help='checkpoint path')
+    parser.add_argument('--spelling', default=False, help='use spelling or not')
+    parser.add_argument('--dev_file', required=True, help='labelled CoNLL file to score on')
+    parser.add_argument('--batch_size', type=int, default=32, help='sentences decoded together')
+    parser.add_argument('--threads', type=int, default=1, help='torch cpu threads')
+    parser.add_argument('--repeat', type=int, default=3, help='timed decoding passes, the fastest one is kept')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the initial lstm states')
+    parser.add_argument('--out', default='', help='also write the report to this json file')
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    predictor = Predictor(args.load_arg, args.load_check_point, -1, args.spelling)
+    checkpoint_file = torch.load(args.load_check_point, map_location=lambda storage, loc: storage)
+    f_map, l_map, a_map = predictor.f_map, checkpoint_file['l_map'], predictor.a_map
+    with codecs.open(args.dev_file, 'r', 'utf-8') as f:
+        features, labels, actions, _ = utils.read_corpus_ner(f, dict())
+    dataset = utils.construct_dataset(features, labels, actions, f_map, l_map, a_map, True)
+    collate = utils.TransitionCollate(f_map['<eof>'], l_map['<pad>'], a_map['<pad>'])
+    batches = list(torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, collate_fn=collate))
+
+    models = [('float32', predictor.ner_model), ('int8', predictor.ner_model.quantize())]
+    report = dict()
+    decoded = dict()
+    for name, ner_model in models:
+        ner_model.eval()
+        f1, pre, rec, acc = score(ner_model, batches, a_map, args.seed)
+        seconds = min(decode_all(ner_model, batches, args.seed)[1] for _ in range(args.repeat))
+        decoded[name] = decode_all(ner_model, batches, args.seed)[0]
+        report[name] = {'f1': f1, 'precision': pre, 'recall': rec, 'action_accuracy': acc,
+                        'sentences_per_sec': len(dataset) / seconds, 'weight_mb': weight_bytes(ner_model) / 2. ** 20}
+    report['changed_sentences'] = sum(a != b for a, b in zip(decoded['float32'], decoded['int8'])) / float(max(len(dataset), 1))
+
+    print('%d sentences, batch size %d, %d thread(s)' % (len(dataset), args.batch_size, args.threads))
+    print('%-8s %8s %8s %8s %8s %12s %10s' % ('model', 'f1', 'pre', 'rec', 'acc', 'sentences/s', 'weights'))
+    for name, _ in models:
+        r = report[name]
+        print('%-8s %8.4f %8.4f %8.4f %8.4f %12.1f %8.2fMB' % (name, r['f1'], r['precision'], r['recall'], r['action_accuracy'],
+                                                             r['sentences_per_sec'], r['weight_mb']))
+    print('speedup %.2fx, f1 change %+.4f, %.1f%% of the sentences decoded differently' % (
+        report['int8']['sentences_per_sec'] / report['float32']['sentences_per_sec'], report['int8']['f1'] - report['float32']['f1'],
+        100 * report['changed_sentences']))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
@@ -0,0 +1,69 @@
+"""
+load test for serve.py
+
+    python serve.py --load_arg ... --load_check_point ... &
+    python -m benchmark.serve_load --input test.txt --concurrency 16 --requests 2000
+
+posts the sentences of --input (one tokenized sentence per line, as read by predict.py) from --concurrency
+client threads, one sentence per request, and prints client-side throughput and latency next to /stats
+"""
+from __future__ import print_function
+import argparse
+import codecs
+import json
+import threading
+import time
+from urllib.request import Request, urlopen
+
+
+def post(url, sentences):
+    request = Request(url + '/predict', json.dumps({'sentences': sentences}).encode('utf-8'),
+                      {'Content-Type': 'application/json'})
+    return json.loads(urlopen(request).read().decode('utf-8'))
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test for the Stack-LSTM NER service')
+    parser.add_argument('--url', default='http://127.0.0.1:8080', help='service address')
+    parser.add_argument('--input', required=True, help='one tokenized sentence per line')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads')
+    parser.add_argument('--requests', type=int, default=1000, help='total requests')
+    args = parser.parse_args()
+
+    with codecs.open(args.input, 'r', 'utf-8') as f:
+        sentences = [line.split() for line in f if line.strip()]
+
+    latencies = []
+    failures = [0]
+    lock = threading.Lock()
+    counter = iter(range(args.requests))
+
+    def client():
+        for idx in counter:
+            start = time.time()
+            try:
+                post(args.url, [sentences[idx % len(sentences)]])
+            except Exception:
+                with lock:
+                    failures[0] += 1
+                continue
+            with lock:
+                latencies.append(time.time() - start)
+
+    start = time.time()
+    threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    print('%d requests (%d failed) in %.2f s: %.1f req/s' % (args.requests, failures[0], elapsed, len(latencies) / elapsed))
+    if latencies:
+        print('client latency p50 %.2f ms, p99 %.2f ms' % (1000 * percentile(latencies, 0.5), 1000 * percentile(latencies, 0.99)))
+    print('server stats: %s' % json.dumps(json.loads(urlopen(args.url + '/stats').read().decode('utf-8'))))
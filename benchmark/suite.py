@@ -0,0 +1,336 @@
+"""
+reproducible cpu benchmark suite
+
+    python -m benchmark.suite --out baseline.json
+    python -m benchmark.suite --out current.json --baseline baseline.json
+
+builds a synthetic corpus and embedding file (see benchmark.synthetic) from a fixed seed, then times
+micro benchmarks of the stack lstm, the model and the data pipeline, and end-to-end sentences/s of
+training and prediction. Every benchmark runs once to warm up and --repeat timed times, the median
+is reported. Results are written as json; with --baseline each benchmark is compared against a saved
+result file and the suite exits with status 1 when one got slower by more than --tolerance
+"""
+from __future__ import print_function
+import argparse
+import codecs
+import itertools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from benchmark import synthetic
+from model.stack_lstm import StackRNN, TransitionNER
+import model.evaluate as evaluate
+import model.utils as utils
+
+
+class Workload(object):
+    """
+    synthetic files, corpus, coding tables, datasets and a model built the way train.py builds them
+    """
+    def __init__(self, args, work_dir):
+        self.args = args
+        vocab = synthetic.make_vocab(args.vocab_size, args.seed)
+        sentences = list(synthetic.generate_sentences(vocab, args.sentences, args.min_len, args.max_len, args.entity_density,
+                                                      zipf=args.zipf, seed=args.seed))
+        self.conll_file = os.path.join(work_dir, 'train.txt')
+        self.predict_file = os.path.join(work_dir, 'predict.txt')
+        self.emb_file = os.path.join(work_dir, 'emb.txt')
+        self.tokens = synthetic.write_conll(self.conll_file, sentences)
+        synthetic.write_predict_input(self.predict_file, sentences)
+        self.emb_rows = synthetic.write_embedding(self.emb_file, vocab, args.embedding_dim, args.coverage, args.extra_words, seed=args.seed)
+        with codecs.open(self.conll_file, 'r', 'utf-8') as f:
+            self.conll_lines = f.readlines()
+
+        features, labels, actions, f_map, l_map, a_map, char_map, ner_map, singleton = self.read_corpus()
+        self.features, self.labels, self.actions = features, labels, actions
+        self.l_map, self.a_map, self.char_map, self.ner_map = l_map, a_map, char_map, ner_map
+        self.f_map, self.embedding = self.load_embedding()
+        self.dataset = self.build_dataset()
+        self.singleton_mask = utils.build_singleton_mask([w for w in singleton if w in self.f_map], self.f_map)
+        self.models = dict()
+
+    def read_corpus(self):
+        return utils.generate_corpus(self.conll_lines, dict(), if_shrink_feature=True, thresholds=0)
+
+    def load_embedding(self):
+        corpus_words = set(itertools.chain.from_iterable(self.features))
+        return utils.load_embedding_wlm(self.emb_file, ' ', {'<eof>': 0}, corpus_words, True, 'unk', self.args.embedding_dim)
+
+    def build_dataset(self):
+        return utils.construct_dataset(self.features, self.labels, self.actions, self.f_map, self.l_map, self.a_map, True)
+
+    def build_model(self, mode='train'):
+        args = self.args
+        torch.manual_seed(args.seed)
+        ner_model = TransitionNER(mode, self.a_map, self.f_map, self.l_map, self.char_map, self.ner_map, len(self.f_map), len(self.a_map),
+                                  args.embedding_dim, args.action_embedding_dim, args.char_embedding_dim, args.hidden, args.char_hidden,
+                                  1, args.drop_out, not args.no_spelling, args.char_structure, is_cuda=-1)
+        ner_model.load_pretrained_embedding(self.embedding)
+        ner_model.rand_init(init_word_embedding=False)
+        return ner_model
+
+    def model(self, mode):
+        """
+        a model built once per mode and shared by the benchmarks that do not train it
+        """
+        if mode not in self.models:
+            self.models[mode] = self.build_model(mode)
+        return self.models[mode]
+
+    def batches(self, shuffle=False, singleton_rate=0):
+        collate = utils.TransitionCollate(self.f_map['<eof>'], self.l_map['<pad>'], self.a_map['<pad>'], self.f_map['<unk>'],
+                                          self.singleton_mask, singleton_rate)
+        generator = torch.Generator()
+        generator.manual_seed(self.args.seed)
+        sampler = utils.TokenBudgetSampler([len(action) for action in self.dataset.action_tensor], self.args.batch_tokens,
+                                           self.args.batch_size, shuffle=shuffle, generator=generator)
+        return torch.utils.data.DataLoader(self.dataset, batch_sampler=sampler, collate_fn=collate)
+
+
+def bench_stack_rnn(work):
+    """
+    StackRNN push / pop of single rows through an LSTMCell, in operations
+    """
+    hidden = work.args.hidden
+    cell = nn.LSTMCell(hidden, hidden)
+    initial = (torch.zeros(1, hidden), torch.zeros(1, hidden))
+    inputs = [torch.randn(1, hidden) for _ in range(work.args.max_len)]
+    n_ops = 0
+    for _ in range(20):
+        stack = StackRNN(cell, initial, None, lambda state: state[0], torch.zeros(1, hidden))
+        for expr in inputs:
+            stack.push(expr, expr)
+            stack.embedding()
+        while len(stack) > 0:
+            stack.pop()
+        n_ops += 2 * len(inputs)
+    return n_ops
+
+
+def bench_forward(work, n_sentences=50):
+    """
+    per-sentence TransitionNER.forward with gold actions, in sentences
+    """
+    ner_model = work.model('train')
+    ner_model.train()
+    for idx in range(min(n_sentences, len(work.dataset))):
+        feature, _, action = work.dataset[idx]
+        ner_model.forward(feature.unsqueeze(0), action.unsqueeze(0))
+    return min(n_sentences, len(work.dataset))
+
+
+def bench_forward_batch(work):
+    """
+    TransitionNER.forward_batch with gold actions over the token-budget batches of the corpus, in sentences
+    """
+    ner_model = work.model('train')
+    ner_model.train()
+    n_sentences = 0
+    for feature, _, action in work.batches():
+        ner_model.forward_batch(feature, action)
+        n_sentences += feature.size(0)
+    return n_sentences
+
+
+def bench_forward_batch_predict(work):
+    """
+    greedy decoding with TransitionNER.forward_batch over the token-budget batches of the corpus, in sentences
+    """
+    ner_model = work.model('train')
+    ner_model.eval()
+    n_sentences = 0
+    with torch.no_grad():
+        for feature, _, _ in work.batches():
+            ner_model.forward_batch(feature)
+            n_sentences += feature.size(0)
+    return n_sentences
+
+
+def bench_forward_batch_fused(work):
+    """
+    forward_batch_predict with TransitionNER.enable_fused_cells, in sentences
+    """
+    ner_model = work.model('train')
+    ner_model.enable_fused_cells()
+    try:
+        return bench_forward_batch_predict(work)
+    finally:
+        ner_model.disable_fused_cells()
+
+
+def bench_load_embedding(work):
+    """
+    utils.load_embedding_wlm on the synthetic embedding file, in embedding rows
+    """
+    work.load_embedding()
+    return work.emb_rows
+
+
+def bench_generate_corpus(work):
+    """
+    utils.generate_corpus on the synthetic corpus, in sentences
+    """
+    work.read_corpus()
+    return len(work.features)
+
+
+def bench_construct_dataset(work):
+    """
+    utils.construct_dataset of the synthetic corpus, in sentences
+    """
+    work.build_dataset()
+    return len(work.features)
+
+
+def bench_train(work):
+    """
+    one training epoch as train.py runs it (shuffled batches, singleton dropping, backward, clipping and adam), in sentences
+    """
+    ner_model = work.build_model()
+    ner_model.train()
+    optimizer = optim.Adam(ner_model.parameters(), lr=0.001)
+    n_sentences = 0
+    for feature, _, action in work.batches(shuffle=True, singleton_rate=0.2):
+        ner_model.zero_grad()
+        loss, _, _ = ner_model.forward_batch(feature, action)
+        loss.backward()
+        nn.utils.clip_grad_norm_(ner_model.parameters(), 5.0)
+        optimizer.step()
+        n_sentences += feature.size(0)
+    return n_sentences
+
+
+def bench_predict(work):
+    """
+    predict.py on the synthetic sentences: streaming, encoding, greedy decoding and entity extraction, in sentences
+    """
+    ner_model = work.model('predict')
+    ner_model.eval()
+    idx2action = {v: k for k, v in work.a_map.items()}
+    n_sentences = 0
+    with codecs.open(work.predict_file, 'r', 'utf-8') as f:
+        for feature in utils.iter_batches_predict(utils.iter_corpus_predict(f), work.f_map, work.args.predict_batch_size):
+            for pre_action in evaluate.decode_batch(ner_model, feature, False):
+                evaluate.get_entities(pre_action, idx2action)
+            n_sentences += feature.size(0)
+    return n_sentences
+
+
+BENCHMARKS = [('stack_rnn_push_pop', bench_stack_rnn, 'ops'),
+              ('forward', bench_forward, 'sentences'),
+              ('forward_batch', bench_forward_batch, 'sentences'),
+              ('forward_batch_predict', bench_forward_batch_predict, 'sentences'),
+              ('forward_batch_fused', bench_forward_batch_fused, 'sentences'),
+              ('load_embedding_wlm', bench_load_embedding, 'rows'),
+              ('generate_corpus', bench_generate_corpus, 'sentences'),
+              ('construct_dataset', bench_construct_dataset, 'sentences'),
+              ('train_e2e', bench_train, 'sentences'),
+              ('predict_e2e', bench_predict, 'sentences')]
+
+
+def run_benchmark(fn, work, repeat):
+    # reseeded before every run, so decoding and dropout take the same path each time
+    torch.manual_seed(work.args.seed)
+    fn(work)
+    times = list()
+    for _ in range(repeat):
+        torch.manual_seed(work.args.seed)
+        start = time.perf_counter()
+        units = fn(work)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    median = times[len(times) // 2]
+    return {'median_s': median, 'min_s': times[0], 'max_s': times[-1], 'repeat': repeat, 'units': units, 'rate': units / median}
+
+
+def compare(results, baseline, tolerance):
+    """
+    print each benchmark against the baseline, returns the names of those slower by more than tolerance
+    """
+    if baseline['config'] != results['config']:
+        print('warning: the baseline was run with a different configuration, rates may not be comparable')
+    regressions = list()
+    print('%-24s %14s %14s %9s' % ('benchmark', 'baseline', 'current', 'change'))
+    for name, result in results['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            continue
+        base_rate = baseline['benchmarks'][name]['rate']
+        change = result['rate'] / base_rate - 1
+        flag = ''
+        if change < -tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-24s %14.1f %14.1f %+8.1f%%%s' % (name, base_rate, result['rate'], 100 * change, flag))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='CPU benchmark suite for the Stack-LSTM NER model')
+    parser.add_argument('--out', default='benchmark_results.json', help='json file the results are written to')
+    parser.add_argument('--baseline', default='', help='json result file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative slowdown against the baseline reported as a regression')
+    parser.add_argument('--only', nargs='+', default=None, choices=[name for name, _, _ in BENCHMARKS], help='run these benchmarks only')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of every benchmark, the median is kept')
+    parser.add_argument('--threads', type=int, default=1, help='torch cpu threads')
+    parser.add_argument('--work_dir', default='', help='keep the synthetic files in this directory (a temporary one by default)')
+    synthetic.add_arguments(parser)
+    parser.add_argument('--embedding_dim', type=int, default=100, help='dimension for word embedding')
+    parser.add_argument('--action_embedding_dim', type=int, default=20, help='dimension for action embedding')
+    parser.add_argument('--char_embedding_dim', type=int, default=50, help='dimension for char embedding')
+    parser.add_argument('--hidden', type=int, default=100, help='hidden dimension')
+    parser.add_argument('--char_hidden', type=int, default=50, help='hidden dimension for character')
+    parser.add_argument('--char_structure', choices=['lstm', 'cnn'], default='lstm', help='char encoder')
+    parser.add_argument('--no_spelling', action='store_true', help='word embeddings only')
+    parser.add_argument('--drop_out', type=float, default=0.5, help='dropout ratio')
+    parser.add_argument('--batch_tokens', type=int, default=2000, help='maximum number of actions in a training batch')
+    parser.add_argument('--batch_size', type=int, default=100, help='maximum number of sentences in a training batch')
+    parser.add_argument('--predict_batch_size', type=int, default=32, help='sentences decoded together in predict_e2e')
+    parser.set_defaults(sentences=300, vocab_size=5000, extra_words=5000)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='stack_lstm_bench_')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    config = {k: v for k, v in vars(args).items() if k not in ('out', 'baseline', 'tolerance', 'only', 'repeat', 'work_dir')}
+    try:
+        work = Workload(args, work_dir)
+        print('%d sentences, %d tokens, %d words, %d embedding rows' % (len(work.features), work.tokens, len(work.f_map), work.emb_rows))
+
+        benchmarks = dict()
+        for name, fn, unit in BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+            result = run_benchmark(fn, work, args.repeat)
+            result['unit'] = unit
+            benchmarks[name] = result
+            print('%-24s %12.1f %s/s  (median %.3fs over %d runs)' % (name, result['rate'], unit, result['median_s'], args.repeat))
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+
+    results = {'config': config,
+               'environment': {'python': platform.python_version(), 'torch': torch.__version__, 'platform': platform.platform(),
+                               'processor': platform.processor(), 'threads': torch.get_num_threads()},
+               'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'benchmarks': benchmarks}
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('results written to %s' % args.out)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('slower than the baseline by more than %.0f%%: %s' % (100 * args.tolerance, ', '.join(regressions)))
+            sys.exit(1)
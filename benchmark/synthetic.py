@@ -0,0 +1,123 @@
+"""
+synthetic CoNLL corpora and matching embedding files for the benchmarks
+
+    python -m benchmark.synthetic --conll synthetic.txt --emb synthetic.emb --sentences 5000 --vocab_size 20000
+
+word frequencies follow a zipf law over a random lowercase vocabulary, entity tokens are capitalized.
+The embedding file has a row for --unk, one for a --coverage share of the (lowercased) vocabulary and
+--extra_words rows for words outside the corpus. The same seed always gives the same files
+"""
+from __future__ import print_function
+import argparse
+import codecs
+import itertools
+import random
+
+import numpy as np
+
+
+def make_vocab(vocab_size, seed=1):
+    """
+    vocab_size distinct random lowercase words, the most frequent first
+    """
+    rand = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    vocab = list()
+    seen = set()
+    while len(vocab) < vocab_size:
+        word = ''.join(rand.choice(letters) for _ in range(rand.randint(2, 10)))
+        if word not in seen:
+            seen.add(word)
+            vocab.append(word)
+    return vocab
+
+
+def generate_sentences(vocab, sentences, min_len=5, max_len=40, entity_density=0.1, entity_types=('PER', 'LOC', 'ORG', 'MISC'),
+                       max_entity_len=3, zipf=1.0, seed=1):
+    """
+    yield sentences as lists of (word, label) pairs, BIO labelled
+
+    entity_density is the probability that an entity starts at a given token
+    """
+    rand = random.Random(seed)
+    cum_weights = list(itertools.accumulate(1.0 / (rank + 1) ** zipf for rank in range(len(vocab))))
+    for _ in range(sentences):
+        sent_len = rand.randint(min_len, max_len)
+        words = rand.choices(vocab, cum_weights=cum_weights, k=sent_len)
+        sentence = list()
+        while len(sentence) < sent_len:
+            if rand.random() < entity_density:
+                ent_type = rand.choice(entity_types)
+                ent_len = min(rand.randint(1, max_entity_len), sent_len - len(sentence))
+                for idx in range(ent_len):
+                    sentence.append((words[len(sentence)].capitalize(), ('B-' if idx == 0 else 'I-') + ent_type))
+            else:
+                sentence.append((words[len(sentence)], 'O'))
+        yield sentence
+
+
+def write_conll(path, sentences):
+    """
+    write (word, label) sentences in the CoNLL format read by train.py, returns the number of tokens
+    """
+    tokens = 0
+    with codecs.open(path, 'w', 'utf-8') as f:
+        for sentence in sentences:
+            for word, label in sentence:
+                f.write('%s %s\n' % (word, label))
+            f.write('\n')
+            tokens += len(sentence)
+    return tokens
+
+
+def write_predict_input(path, sentences):
+    """
+    write sentences in the one-sentence-per-line format read by predict.py
+    """
+    with codecs.open(path, 'w', 'utf-8') as f:
+        for sentence in sentences:
+            f.write(' '.join(word for word, _ in sentence) + '\n')
+
+
+def write_embedding(path, vocab, dim, coverage=0.9, extra_words=0, unk='unk', seed=1):
+    """
+    write a text embedding file, returns the number of rows
+    """
+    rand = random.Random(seed)
+    words = [unk] + [word for word in vocab if rand.random() < coverage]
+    words += ['%s%d' % (word, idx) for idx, word in enumerate(make_vocab(extra_words, seed + 1))]
+    vectors = np.random.RandomState(seed).uniform(-0.5, 0.5, (len(words), dim))
+    with codecs.open(path, 'w', 'utf-8') as f:
+        for word, vector in zip(words, vectors):
+            f.write(word + ' ' + ' '.join('%.5f' % v for v in vector) + '\n')
+    return len(words)
+
+
+def add_arguments(parser):
+    parser.add_argument('--sentences', type=int, default=2000, help='number of sentences')
+    parser.add_argument('--min_len', type=int, default=5, help='minimum sentence length')
+    parser.add_argument('--max_len', type=int, default=40, help='maximum sentence length')
+    parser.add_argument('--entity_density', type=float, default=0.1, help='probability that an entity starts at a token')
+    parser.add_argument('--vocab_size', type=int, default=20000, help='number of distinct words')
+    parser.add_argument('--zipf', type=float, default=1.0, help='exponent of the zipf law of word frequencies')
+    parser.add_argument('--coverage', type=float, default=0.9, help='share of the vocabulary found in the embedding file')
+    parser.add_argument('--extra_words', type=int, default=10000, help='embedding rows for words outside the corpus')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Synthetic CoNLL corpus and embedding generator')
+    parser.add_argument('--conll', required=True, help='output CoNLL file')
+    parser.add_argument('--emb', default='', help='output embedding file')
+    parser.add_argument('--predict_input', default='', help='also write the sentences in the predict.py input format')
+    parser.add_argument('--emb_dim', type=int, default=100, help='dimension of the synthetic embedding')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    vocab = make_vocab(args.vocab_size, args.seed)
+    sentences = list(generate_sentences(vocab, args.sentences, args.min_len, args.max_len, args.entity_density, zipf=args.zipf, seed=args.seed))
+    print('%d sentences, %d tokens' % (len(sentences), write_conll(args.conll, sentences)))
+    if args.predict_input:
+        write_predict_input(args.predict_input, sentences)
+    if args.emb:
+        print('%d embedding rows' % write_embedding(args.emb, vocab, args.emb_dim, args.coverage, args.extra_words, seed=args.seed))
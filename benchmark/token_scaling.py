@@ -0,0 +1,81 @@
+"""
+regression benchmark: assembling token representations must scale linearly with sentence length
+
+    python -m benchmark.token_scaling
+
+times TransitionNER.token_representation on batches of synthetic sentences of growing length,
+fits the slope of log(time) against log(length) and exits with status 1 when it exceeds --max_slope
+"""
+from __future__ import print_function
+import argparse
+import math
+import random
+import sys
+import time
+
+import torch
+
+from model.stack_lstm import TransitionNER
+import model.utils as utils
+
+
+def build_model(vocab_size, use_spelling, char_structure, seed=1):
+    rand = random.Random(seed)
+    chars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+    char_map = {'<start>': 0, '<end>': 1}
+    for char in chars:
+        char_map[char] = len(char_map)
+    word_map = {'<unk>': 0, '<eof>': 1}
+    while len(word_map) < vocab_size:
+        word = ''.join(rand.choice(chars) for _ in range(rand.randint(1, 12)))
+        if word not in word_map:
+            word_map[word] = len(word_map)
+    action_map = {'OUT': 0, 'SHIFT': 1, 'REDUCE-PER': 2, 'REDUCE-LOC': 3, '<pad>': 4}
+    ner_map = {'REDUCE-PER': 0, 'REDUCE-LOC': 1}
+    label_map = {'O': 0, 'B-PER': 1, 'I-PER': 2, 'B-LOC': 3, 'I-LOC': 4, '<pad>': 5}
+    ner_model = TransitionNER('predict', action_map, word_map, label_map, char_map, ner_map, len(word_map), len(action_map),
+                              100, 20, 50, 100, 50, 1, 0.5, use_spelling, char_structure, is_cuda=-1)
+    ner_model.rand_init(init_word_embedding=True)
+    ner_model.eval()
+    return ner_model
+
+
+def time_assembly(ner_model, sent_len, batch_size, repeat):
+    sentences = torch.LongTensor(batch_size, sent_len).random_(2, ner_model.vocab_size)
+    sents_len = torch.LongTensor(batch_size).fill_(sent_len)
+    best = float('inf')
+    with torch.no_grad():
+        for _ in range(repeat):
+            start = time.perf_counter()
+            utils.reverse_padded(ner_model.token_representation(sentences, pad_word=1), sents_len)
+            best = min(best, time.perf_counter() - start)
+    return best
+
+
+def fit_slope(lengths, times):
+    xs = [math.log(l) for l in lengths]
+    ys = [math.log(t) for t in times]
+    x_mean = sum(xs) / len(xs)
+    y_mean = sum(ys) / len(ys)
+    return sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys)) / sum((x - x_mean) ** 2 for x in xs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Scaling of token representation assembly with sentence length')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[25, 50, 100, 200, 400], help='sentence lengths to time')
+    parser.add_argument('--batch_size', type=int, default=10, help='sentences per batch')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per length, the fastest one is kept')
+    parser.add_argument('--vocab_size', type=int, default=5000, help='synthetic vocabulary size')
+    parser.add_argument('--char_structure', choices=['lstm', 'cnn'], default='lstm', help='char encoder')
+    parser.add_argument('--no_spelling', action='store_true', help='word embeddings only')
+    parser.add_argument('--max_slope', type=float, default=1.25, help='fail when the log-log slope exceeds this value')
+    args = parser.parse_args()
+
+    torch.manual_seed(1)
+    ner_model = build_model(args.vocab_size, not args.no_spelling, args.char_structure)
+    times = [time_assembly(ner_model, sent_len, args.batch_size, args.repeat) for sent_len in args.lengths]
+    for sent_len, t in zip(args.lengths, times):
+        print('length %4d: %8.2f ms  (%.2f us/token)' % (sent_len, t * 1000, t * 1e6 / (sent_len * args.batch_size)))
+    slope = fit_slope(args.lengths, times)
+    print('log-log slope: %.3f (max %.2f)' % (slope, args.max_slope))
+    sys.exit(0 if slope <= args.max_slope else 1)
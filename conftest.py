@@ -0,0 +1,96 @@
+"""
+shared fixtures: a small synthetic corpus (see benchmark.synthetic) and models built and briefly trained on it
+the way train.py does, so that decoding makes real SHIFT / OUT / REDUCE decisions
+"""
+import argparse
+import os
+
+import pytest
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from benchmark.suite import Workload
+from model.stack_lstm import TransitionNER
+import model.utils as utils
+
+
+WORKLOAD_ARGS = dict(sentences=120, min_len=1, max_len=25, entity_density=0.2, vocab_size=300, zipf=1.0, coverage=0.9,
+                     extra_words=200, seed=1, embedding_dim=16, action_embedding_dim=8, char_embedding_dim=8, hidden=16,
+                     char_hidden=8, char_structure='lstm', no_spelling=False, drop_out=0.5, batch_tokens=400, batch_size=16,
+                     predict_batch_size=8)
+
+
+@pytest.fixture(scope='session')
+def workload(tmp_path_factory):
+    return Workload(argparse.Namespace(**WORKLOAD_ARGS), str(tmp_path_factory.mktemp('corpus')))
+
+
+def build_model(work, mode='predict', spelling=True, char_structure='lstm', layers=1):
+    args = work.args
+    ner_model = TransitionNER(mode, work.a_map, work.f_map, work.l_map, work.char_map, work.ner_map, len(work.f_map), len(work.a_map),
+                              args.embedding_dim, args.action_embedding_dim, args.char_embedding_dim, args.hidden, args.char_hidden,
+                              layers, args.drop_out, spelling, char_structure, is_cuda=-1)
+    ner_model.load_pretrained_embedding(work.embedding.clone())
+    ner_model.rand_init(init_word_embedding=False)
+    return ner_model
+
+
+def train_model(work, ner_model, epochs=3):
+    """
+    train ner_model on the corpus of work for a few epochs, then put it in eval mode
+    """
+    mode = ner_model.mode
+    ner_model.mode = 'train'
+    optimizer = optim.Adam(ner_model.parameters(), lr=0.01)
+    ner_model.train()
+    for _ in range(epochs):
+        for feature, _, action in work.batches(shuffle=True):
+            ner_model.zero_grad()
+            loss, _, _ = ner_model.forward_batch(feature, action)
+            loss.backward()
+            nn.utils.clip_grad_norm_(ner_model.parameters(), 5.0)
+            optimizer.step()
+    ner_model.mode = mode
+    ner_model.eval()
+    return ner_model
+
+
+@pytest.fixture(scope='session')
+def trained_model(workload):
+    """
+    trained model with bi-lstm char features
+    """
+    torch.manual_seed(1)
+    return train_model(workload, build_model(workload))
+
+
+@pytest.fixture(scope='session')
+def word_model(workload):
+    """
+    trained model with word embeddings only
+    """
+    torch.manual_seed(2)
+    return train_model(workload, build_model(workload, spelling=False), epochs=6)
+
+
+@pytest.fixture(scope='session')
+def sentences(workload):
+    """
+    word ids of the synthetic sentences
+    """
+    return [[workload.f_map.get(word.lower(), workload.f_map['<unk>']) for word in feature] for feature in workload.features]
+
+
+@pytest.fixture(scope='session')
+def checkpoint(workload, trained_model, tmp_path_factory):
+    """
+    (arg json, checkpoint) of trained_model written as train.py saves them, load them with spelling=True
+    """
+    work = workload
+    prefix = os.path.join(str(tmp_path_factory.mktemp('checkpoint')), 'ner_stack_lstm')
+    args = dict(vars(work.args), layers=1, mode='train')
+    utils.save_checkpoint({'epoch': 0, 'state_dict': trained_model.state_dict(), 'optimizer': None, 'f_map': work.f_map,
+                           'l_map': work.l_map, 'a_map': work.a_map, 'char_map': work.char_map, 'ner_map': work.ner_map},
+                          {'track_list': [], 'args': args}, prefix)
+    return prefix + '.json', prefix + '.model'
@@ -0,0 +1,104 @@
+"""
+export a trained model for inference
+
+    python export.py --load_arg checkpoint/ner_stack_lstm.json --load_check_point checkpoint/ner_stack_lstm.model --output ner_stack_lstm.pt
+
+writes the greedy decoder as a single TorchScript file, which only needs torch to run:
+
+    decoder = torch.jit.load('ner_stack_lstm.pt')
+    decoder.predict([['John', 'lives', 'in', 'New', 'York']])   # [[(0, 1, 'PER'), (3, 5, 'LOC')]]
+
+    python export.py --format bundle --train_file train.txt --min_count 1 --output ner_stack_lstm.bundle ...
+
+writes an inference bundle directory (see model.bundle): the weights, the config and the coding tables without the
+optimizer state, with the vocabulary pruned to the words seen --min_count times in --train_file. The bundle is
+loaded by predict.py / serve.py --bundle
+"""
+from __future__ import print_function
+import argparse
+import codecs
+import json
+import os
+
+import torch
+
+from model.bundle import prune_vocabulary, save_bundle
+from model.export import export_decoder
+import model.evaluate as evaluate
+from model.predictor import Predictor, load_checkpoint
+import model.utils as utils
+
+
+def checkpoint_entities(ner_model, f_map, idx2action, sentences):
+    features = utils.encode_safe_predict(sentences, f_map, f_map['<unk>'])
+    batch = utils.PadCollate(f_map['<eof>'])([torch.LongTensor(feature) for feature in features])
+    return [evaluate.get_entities(pre_action, idx2action) for pre_action in evaluate.decode_batch(ner_model, batch, False)]
+
+
+def disk_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Exporting Stack-LSTM')
+    parser.add_argument('--load_arg', default='./checkpoint/ner_stack_lstm.json', help='arg json file path')
+    parser.add_argument('--load_check_point', default='./checkpoint/ner_stack_lstm.model', help='checkpoint path')
+    parser.add_argument('--spelling', default=False, help='use spelling or not')
+    parser.add_argument('--format', choices=['torchscript', 'bundle'], default='torchscript',
+                        help='a single TorchScript file of the greedy decoder, or an inference bundle directory')
+    parser.add_argument('--output', default='./checkpoint/ner_stack_lstm.pt', help='path of the exported file (or bundle directory)')
+    parser.add_argument('--train_file', default='',
+                        help='bundle: word counts for --min_count / --max_words, and the char map of checkpoints saved without one')
+    parser.add_argument('--min_count', type=int, default=0,
+                        help='bundle: keep the words seen at least this often in --train_file, 0 keeps the whole vocabulary')
+    parser.add_argument('--max_words', type=int, default=0, help='bundle: keep at most this many of the most frequent words, 0 for no limit')
+    parser.add_argument('--check_file', default='',
+                        help='one tokenized sentence per line, decoded by both models to check that the export predicts the same entities')
+    parser.add_argument('--batch_size', type=int, default=32, help='sentences decoded together by --check_file')
+    args = parser.parse_args()
+    if args.format == 'bundle' and (args.min_count > 0 or args.max_words > 0) and not args.train_file:
+        raise ValueError('pruning the vocabulary needs the word counts of --train_file')
+
+    keep_words = None
+    if args.format == 'torchscript':
+        predictor = Predictor(args.load_arg, args.load_check_point, -1, args.spelling)
+        export_decoder(predictor.ner_model, args.output)
+    else:
+        with open(args.load_arg, 'r') as f:
+            jd = json.load(f)['args']
+        word_count = dict()
+        char_map = None
+        if args.train_file:
+            with codecs.open(args.train_file, 'r', 'utf-8') as f:
+                # the char map train.py builds from this file, used when the checkpoint has none
+                char_map = utils.generate_corpus(f, word_count)[6]
+        ner_model, checkpoint_file = load_checkpoint(args.load_arg, args.load_check_point, -1, args.spelling, char_map)
+        if args.min_count > 0 or args.max_words > 0:
+            keep_words = prune_vocabulary(checkpoint_file['f_map'], word_count, args.min_count, args.max_words)
+        n_words = save_bundle(args.output, ner_model, jd, args.spelling, checkpoint_file['f_map'], checkpoint_file['l_map'],
+                              checkpoint_file['a_map'], checkpoint_file['ner_map'], checkpoint_file['char_map'], keep_words)
+        print('kept %d of %d words' % (n_words, len(checkpoint_file['f_map'])))
+    print('exported %s (%.1f MB)' % (args.output, disk_size(args.output) / 2. ** 20))
+
+    if args.check_file:
+        if args.format == 'torchscript':
+            reference = predictor.predict_entities
+            exported = torch.jit.load(args.output).predict
+        else:
+            idx2action = {v: k for k, v in checkpoint_file['a_map'].items()}
+            reference = lambda batch: checkpoint_entities(ner_model, checkpoint_file['f_map'], idx2action, batch)
+            exported = Predictor(None, None, -1, bundle=args.output).predict_entities
+        with codecs.open(args.check_file, 'r', 'utf-8') as f:
+            sentences = [line.split() for line in f if line.strip()]
+        mismatches = 0
+        for start in range(0, len(sentences), args.batch_size):
+            batch = sentences[start:start + args.batch_size]
+            expected = reference(batch)
+            decoded = exported(batch)
+            mismatches += sum(list(map(tuple, e)) != list(map(tuple, x)) for e, x in zip(expected, decoded))
+        print('%d of %d sentences decoded differently' % (mismatches, len(sentences)))
+        # words pruned from the vocabulary are decoded as <unk>, so a pruned bundle may legitimately differ
+        if mismatches and keep_words is None:
+            raise SystemExit(1)
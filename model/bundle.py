@@ -0,0 +1,114 @@
+import codecs
+import itertools
+import json
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from model.stack_lstm import TransitionNER
+
+BUNDLE_VERSION = 1
+# hyper-parameters of the train.py args TransitionNER is built from
+MODEL_ARGS = ['embedding_dim', 'action_embedding_dim', 'char_embedding_dim', 'hidden', 'char_hidden', 'layers', 'drop_out', 'char_structure']
+ALIGNMENT = 64
+
+
+def prune_vocabulary(f_map, word_count, min_count=1, max_words=0):
+    """
+    words of f_map seen at least min_count times in word_count, the max_words most frequent of them when max_words > 0,
+    plus <unk> and <eof>
+    """
+    kept = [word for word in f_map if word_count.get(word, 0) >= min_count]
+    if max_words > 0:
+        kept = sorted(kept, key=lambda word: -word_count[word])[:max_words]
+    return set(kept) | {'<unk>', '<eof>'}
+
+
+def save_bundle(path, ner_model, model_args, spelling, f_map, l_map, a_map, ner_map, char_map, keep_words=None):
+    """
+    write the inference bundle of ner_model to the directory path
+
+        config.json   hyper-parameters, coding tables and the offset / shape of every tensor in weights.bin
+        vocab.txt     one word per line, line i is word id i
+        weights.bin   the float32 weights, each tensor contiguous at a 64 byte aligned offset
+
+    with keep_words only those words (and their word embedding rows) are kept, the others become <unk>.
+    There is no optimizer state, and nothing is pickled
+    """
+    words = [word for word, _ in sorted(f_map.items(), key=lambda kv: kv[1]) if keep_words is None or word in keep_words]
+    state = {name: tensor for name, tensor in ner_model.state_dict().items() if not name.startswith('word_embeds.')}
+    # through the module, so the rows a PagedEmbedding keeps on disk are written too
+    with torch.no_grad():
+        state['word_embeds.weight'] = ner_model.word_embeds(torch.LongTensor([f_map[word] for word in words]))
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    tensors = dict()
+    offset = 0
+    with open(os.path.join(path, 'weights.bin'), 'wb') as f:
+        for name, tensor in state.items():
+            array = tensor.detach().cpu().float().contiguous().numpy()
+            f.write(b'\0' * (-offset % ALIGNMENT))
+            offset += -offset % ALIGNMENT
+            tensors[name] = {'offset': offset, 'shape': list(array.shape)}
+            f.write(array.tobytes())
+            offset += array.nbytes
+    with codecs.open(os.path.join(path, 'vocab.txt'), 'w', 'utf-8') as f:
+        for word in words:
+            f.write(word + '\n')
+    config = {'version': BUNDLE_VERSION,
+              'model': dict({key: model_args[key] for key in MODEL_ARGS}, spelling=bool(spelling)),
+              'vocab_size': len(words),
+              'l_map': l_map, 'a_map': a_map, 'ner_map': ner_map, 'char_map': char_map,
+              'tensors': tensors}
+    # written last, a bundle without config.json is incomplete
+    with codecs.open(os.path.join(path, 'config.json'), 'w', 'utf-8') as f:
+        json.dump(config, f)
+    return len(words)
+
+
+def load_bundle(path, gpu=-1, mode='predict'):
+    """
+    TransitionNER restored from an inference bundle, and its coding tables as a dict (f_map, l_map, a_map, ner_map, char_map)
+
+    the parameters are views of a memory map of weights.bin, pages are read from disk (or shared from the page cache)
+    as the weights are used
+    """
+    with codecs.open(os.path.join(path, 'config.json'), 'r', 'utf-8') as f:
+        config = json.load(f)
+    if config['version'] != BUNDLE_VERSION:
+        raise ValueError('%s: unsupported bundle version %s' % (path, config['version']))
+    with codecs.open(os.path.join(path, 'vocab.txt'), 'r', 'utf-8') as f:
+        words = f.read().split('\n')[:config['vocab_size']]
+    maps = {'f_map': {word: idx for idx, word in enumerate(words)},
+            'l_map': config['l_map'], 'a_map': config['a_map'], 'ner_map': config['ner_map'], 'char_map': config['char_map']}
+
+    args = config['model']
+    # built with a single word embedding row, the mapped table replaces it instead of a randomly initialized copy of its size
+    ner_model = TransitionNER(mode, maps['a_map'], maps['f_map'], maps['l_map'], maps['char_map'], maps['ner_map'], 1, len(maps['a_map']),
+                              args['embedding_dim'], args['action_embedding_dim'], args['char_embedding_dim'], args['hidden'], args['char_hidden'],
+                              args['layers'], args['drop_out'], args['spelling'], args['char_structure'], is_cuda=gpu)
+    # copy-on-write, a page is only copied if its weights are changed in memory
+    weights = np.memmap(os.path.join(path, 'weights.bin'), dtype=np.uint8, mode='c')
+    state = dict()
+    for name, meta in config['tensors'].items():
+        n_bytes = 4 * int(np.prod(meta['shape']))
+        state[name] = torch.from_numpy(np.frombuffer(weights, dtype=np.float32, count=n_bytes // 4, offset=meta['offset'])
+                                       .reshape(meta['shape']))
+    ner_model.word_embeds.weight = nn.Parameter(state['word_embeds.weight'])
+    ner_model.vocab_size = ner_model.word_embeds.num_embeddings = len(words)
+    if set(state) != set(ner_model.state_dict()):
+        raise ValueError('%s: the weights of the bundle do not match the model, missing %s, unexpected %s'
+                         % (path, sorted(set(ner_model.state_dict()) - set(state)), sorted(set(state) - set(ner_model.state_dict()))))
+    # the parameters and buffers are pointed at the mapped pages instead of being copied into the randomly initialized ones
+    # (what load_state_dict(assign=True) does, which older torch versions lack)
+    for name, tensor in itertools.chain(ner_model.named_parameters(), ner_model.named_buffers()):
+        if tensor.size() != state[name].size():
+            raise ValueError('%s: %s has shape %s in the bundle, the model expects %s' % (path, name, list(state[name].size()), list(tensor.size())))
+        tensor.data = state[name]
+    if gpu >= 0:
+        ner_model.cuda()
+    ner_model.eval()
+    return ner_model, maps
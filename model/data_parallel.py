@@ -0,0 +1,98 @@
+import os
+import time
+
+import torch
+import torch.distributed as dist
+
+
+class DataParallel(object):
+    """
+    synchronous data-parallel training over world_size forked cpu processes joined by a gloo process group
+
+    the processes are forked once the model and optimizer exist, so they start from identical parameters;
+    each one trains on rows rank::world_size of every batch and the gradients are summed with a single
+    all_reduce before clipping and the optimizer step, which keeps the replicas identical
+
+    after the fork every process reseeds the global generator with seed + rank (seed is drawn from it
+    when None), so the processes draw their own dropout masks instead of the same ones
+    """
+    def __init__(self, world_size, port, seed=None):
+        self.world_size = world_size
+        self.rank = 0
+        self.children = list()
+        if seed is None:
+            seed = int(torch.randint(0, 2 ** 31 - world_size, (1,)).item())
+        for rank in range(1, world_size):
+            pid = os.fork()
+            if pid == 0:
+                self.rank = rank
+                self.children = list()
+                break
+            self.children.append(pid)
+        torch.manual_seed(seed + self.rank)
+        torch.set_num_threads(max(1, torch.get_num_threads() // world_size))
+        dist.init_process_group('gloo', init_method='tcp://127.0.0.1:%d' % port, rank=self.rank, world_size=world_size)
+        self.sync_time = 0
+        self.epoch_start = time.time()
+        self.epoch_sentences = 0
+
+    def shard(self, feature, label, action):
+        self.epoch_sentences += feature.size(0)
+        return feature[self.rank::self.world_size], label[self.rank::self.world_size], action[self.rank::self.world_size]
+
+    def all_reduce(self, parameters, loss):
+        """
+        sum the gradients of parameters and the batch loss over all processes, returns the summed loss
+
+        a parameter gets a gradient on every process as soon as one of them has one (zeros where it had none),
+        so the optimizer steps the same parameters everywhere
+        """
+        start = time.time()
+        params = [p for p in parameters if p.requires_grad]
+        flat = torch.cat([p.grad.data.view(-1) if p.grad is not None else p.data.new_zeros(p.numel()) for p in params]
+                         + [params[0].data.new_tensor([float(p.grad is not None) for p in params] + [float(loss)])])
+        dist.all_reduce(flat)
+        offset = 0
+        has_grad = flat[-len(params) - 1:-1].tolist()
+        for p, n_grads in zip(params, has_grad):
+            grad = flat[offset:offset + p.numel()].view_as(p)
+            offset += p.numel()
+            if p.grad is not None:
+                p.grad.data.copy_(grad)
+            elif n_grads > 0:
+                p.grad = grad.clone()
+        self.sync_time += time.time() - start
+        return flat[-1].item()
+
+    def start_epoch(self):
+        # rank 0 may still be evaluating the previous epoch
+        dist.barrier()
+        self.sync_time = 0
+        self.epoch_sentences = 0
+        self.epoch_start = time.time()
+
+    def epoch_report(self):
+        """
+        training throughput of the epoch and the share of wall time spent in the gradient all_reduce, which includes
+        waiting for the slowest process, averaged over the processes
+        """
+        wall = time.time() - self.epoch_start
+        sync_share = torch.FloatTensor([self.sync_time / max(wall, 1e-9)])
+        dist.all_reduce(sync_share)
+        return {'processes': self.world_size, 'sentences_per_sec': self.epoch_sentences / max(wall, 1e-9),
+                'sync_share': sync_share.item() / self.world_size}
+
+    def should_stop(self, stop):
+        """
+        broadcast the early stopping decision of rank 0
+        """
+        flag = torch.LongTensor([int(stop)])
+        dist.broadcast(flag, 0)
+        return bool(flag.item())
+
+    def close(self):
+        dist.destroy_process_group()
+        if self.rank > 0:
+            os._exit(0)
+        for pid in self.children:
+            os.waitpid(pid, 0)
@@ -1,30 +1,41 @@
+import copy
 import torch
+import torch.multiprocessing as mp
 import numpy as np
 import itertools
+import queue
 
 import model.utils as utils
 
 
 def calc_score(ner_model, dataset_loader, if_cuda):
+    """
+    action accuracy of the model following the gold actions (teacher forcing), a batch at a time under no_grad
 
+    needs ner_model.mode == 'train', in predict mode forward_batch ignores the gold actions
+    """
     ner_model.eval()
     correct = 0
     total_act = 0
     for feature, label, action in itertools.chain.from_iterable(dataset_loader):  # feature : torch.Size([4, 17])
         fea_v, tg_v, ac_v = utils.repack_vb(if_cuda, feature, label, action)
-        loss, pre_action = ner_model.forward(fea_v, ac_v)  # loss torch.Size([1, seq_len, action_size+1, action_size+1])
-        for idx in range(len(pre_action)):
-            if pre_action[idx] == ac_v.squeeze(0).data[idx]:
-                correct += 1
-        total_act += len(pre_action)
+        with torch.no_grad():
+            _, pre_actions, right = ner_model.forward_batch(fea_v, ac_v)
+        correct += sum(right)
+        total_act += sum(len(pre_action) for pre_action in pre_actions)
 
     acc = correct / float(total_act)
 
     return acc
 
 def calc_f1_score(ner_model, dataset_loader, action2idx, if_cuda):
+    """
+    entity f1, precision, recall and action accuracy of greedy decoding against the gold actions
 
+    the model decodes on its own predictions (no teacher forcing), a batch at a time under no_grad
+    """
     idx2action = {v: k for k, v in action2idx.items()}
+    action_pad = action2idx['<pad>']
     ner_model.eval()
     correct = 0
     total_correct_entity = 0
@@ -33,18 +44,16 @@ def calc_f1_score(ner_model, dataset_loader, action2idx, if_cuda):
     total_entity_in_gold = 0
     total_entity_in_pre = 0
     for feature, label, action in itertools.chain.from_iterable(dataset_loader):  # feature : torch.Size([4, 17])
-        fea_v, tg_v, ac_v = utils.repack_vb(if_cuda, feature, label, action)
-        # loss, pre_action, right_num = ner_model.forward(fea_v, ac_v)  # loss torch.Size([1, seq_len, action_size+1, action_size+1])
-        _, pre_actions, right_num = ner_model.forward_batch(fea_v, ac_v)  # loss torch.Size([1, seq_len, action_size+1, action_size+1])
-        for ac_golden, ac_pre in zip(ac_v.squeeze(0).data.tolist(), pre_actions):
+        pre_actions = decode_batch(ner_model, feature, if_cuda)
+        for ac_golden, ac_pre in zip(action.tolist(), pre_actions):
+            # the gold row is padded to the longest action sequence of its batch
+            ac_golden = [ac for ac in ac_golden if ac != action_pad]
             num_entity_in_real, num_entity_in_pre, correct_entity = to_entity(ac_golden, ac_pre, idx2action)
             total_correct_entity += correct_entity
             total_entity_in_gold += num_entity_in_real
             total_entity_in_pre += num_entity_in_pre
-            for idx in range(len(ac_pre)):
-                if ac_pre[idx] == ac_golden[idx]:
-                    correct += 1
-            total_act += len(ac_pre)
+            correct += sum(1 for pre, golden in zip(ac_pre, ac_golden) if pre == golden)
+            total_act += len(ac_golden)
 
     acc = correct / float(total_act)
     if total_entity_in_pre > 0 :
@@ -61,58 +70,222 @@ def calc_f1_score(ner_model, dataset_loader, action2idx, if_cuda):
         f1 = 0
     return f1, pre, rec, acc
 
+class Evaluator(object):
+    """
+    scores each epoch's model on dev, and on test whenever dev improves
+
+    score_fn(ner_model, dataset_loader) returns a tuple led by the model selection metric
+    """
+    def __init__(self, score_fn, dev_dataset_loader, test_dataset_loader):
+        self.score_fn = score_fn
+        self.dev_dataset_loader = dev_dataset_loader
+        self.test_dataset_loader = test_dataset_loader
+        self.best = float('-inf')
+        self.done = list()
+
+    def evaluate(self, ner_model):
+        dev_scores = self.score_fn(ner_model, self.dev_dataset_loader)
+        test_scores = None
+        if dev_scores[0] > self.best:
+            self.best = dev_scores[0]
+            test_scores = self.score_fn(ner_model, self.test_dataset_loader)
+        return dev_scores, test_scores
+
+    def submit(self, epoch, epoch_loss, ner_model, optimizer):
+        state = {'state_dict': ner_model.state_dict(), 'optimizer': optimizer.state_dict()}
+        self.done.append((epoch, epoch_loss, state) + self.evaluate(ner_model))
+
+    def results(self, wait=False):
+        """
+        (epoch, epoch_loss, state, dev_scores, test_scores or None) of the evaluations finished so far, in epoch order
+        """
+        done, self.done = self.done, list()
+        return done
+
+    def close(self):
+        pass
+
+
+class AsyncEvaluator(Evaluator):
+    """
+    Evaluator running in a background process on snapshots of the model, so training goes on meanwhile
+
+    the process is forked with a cpu copy of the model; at most max_pending snapshots wait for their scores
+    """
+    def __init__(self, score_fn, dev_dataset_loader, test_dataset_loader, ner_model, max_pending=2):
+        super(AsyncEvaluator, self).__init__(score_fn, dev_dataset_loader, test_dataset_loader)
+        self.max_pending = max_pending
+        self.pending = dict()
+        ctx = mp.get_context('fork')
+        self.tasks = ctx.Queue()
+        self.scores = ctx.Queue()
+        self.proc = ctx.Process(target=self._work, args=(copy.deepcopy(ner_model).cpu(),))
+        self.proc.daemon = True
+        self.proc.start()
+
+    def _work(self, ner_model):
+        for epoch, state_dict in iter(self.tasks.get, None):
+            ner_model.load_state_dict(state_dict)
+            self.scores.put((epoch,) + self.evaluate(ner_model))
+
+    def submit(self, epoch, epoch_loss, ner_model, optimizer):
+        while len(self.pending) >= self.max_pending:
+            self._collect(block=True)
+        state = {'state_dict': {k: v.detach().cpu().clone() for k, v in ner_model.state_dict().items()},
+                 'optimizer': copy.deepcopy(optimizer.state_dict())}
+        self.pending[epoch] = (epoch_loss, state)
+        self.tasks.put((epoch, state['state_dict']))
+
+    def _collect(self, block):
+        while True:
+            try:
+                epoch, dev_scores, test_scores = self.scores.get(timeout=1) if block else self.scores.get_nowait()
+                break
+            except queue.Empty:
+                if not block:
+                    return False
+                if not self.proc.is_alive():
+                    raise RuntimeError('the evaluation process died')
+        epoch_loss, state = self.pending.pop(epoch)
+        self.done.append((epoch, epoch_loss, state, dev_scores, test_scores))
+        return True
+
+    def results(self, wait=False):
+        while self.pending and self._collect(block=wait):
+            pass
+        return super(AsyncEvaluator, self).results()
+
+    def close(self):
+        self.tasks.put(None)
+        self.proc.join(timeout=10)
+        if self.proc.is_alive():
+            self.proc.terminate()
+
+
 def to_entity(real_action, predict_action, idx2action):
-    flags = [False, False]
-    entitys = [[],[]]
-    actions = [real_action, predict_action]
-    for idx in range(len(actions)):
-        ner_start_pos = -1
-        for ac_idx in range(len(actions[idx])):
-            if idx2action[actions[idx][ac_idx]].startswith('S') and ner_start_pos < 0:
-                ner_start_pos = ac_idx
-            elif idx2action[actions[idx][ac_idx]].startswith('O') and ner_start_pos >= 0:
-                ner_start_pos = -1
-            elif idx2action[actions[idx][ac_idx]].startswith('R') and ner_start_pos >= 0:
-                entitys[idx].append(str(ner_start_pos)+'-'+str(ac_idx-1)+idx2action[actions[idx][ac_idx]])
-                ner_start_pos = -1
-    correct_entity = set(entitys[0]) & set(entitys[1])
-    return len(entitys[0]), len(entitys[1]), len(correct_entity)
-
-def generate_ner(ner_model, fileout, dataset_loader, action2idx, word2idx, if_cuda):
+    """
+    gold, predicted and correct entity counts, entities compared by word span and type
+
+    predicted actions may drift from the gold ones, so positions in the action sequences are not comparable
+    """
+    real_entity = set(get_entities(real_action, idx2action))
+    predict_entity = set(get_entities(predict_action, idx2action))
+    return len(real_entity), len(predict_entity), len(real_entity & predict_entity)
+
+def generate_ner(ner_model, fileout, dataset_loader, action2idx, word2idx, if_cuda, beam_size=1, workers=1):
 
     idx2action = {v: k for k, v in action2idx.items()}
     idx2word = {v: k for k, v in word2idx.items()}
     ner_model.eval()
 
-    for feature in itertools.chain.from_iterable(dataset_loader):  # feature : torch.Size([4, 17])
-        fe_v = utils.varible(feature, if_cuda)
-        _, pre_action, _ = ner_model.forward(fe_v)
-        feature_seq = [idx2word[w_idx] for w_idx in fe_v.squeeze(0).data.tolist()]
-        entitys = []
-        ner_start_pos = -1
-        word_start = -1
-        word_idx = 0
-        for ac_idx in range(len(pre_action)):
-            if idx2action[pre_action[ac_idx]].startswith('S') and ner_start_pos < 0:
-                ner_start_pos = ac_idx
-                word_start = word_idx
-                word_idx += 1
-            elif idx2action[pre_action[ac_idx]].startswith('O') and ner_start_pos >= 0:
-                ner_start_pos = -1
-                word_idx += 1
-            elif idx2action[pre_action[ac_idx]].startswith('R') and ner_start_pos >= 0:
-                ent = []
-                ent.append(" ".join(feature_seq[word_start:word_idx]))
-                ent.append([ner_start_pos, ac_idx-1])
-                ent.append(idx2action[pre_action[ac_idx]].split('-')[1])
-                entitys.append(ent)
-                ner_start_pos = -1
-            else:
-                word_idx += 1
-
-        fileout.write("%s\nEntities: " % (" ".join(feature_seq)))
-        for i in range(len(entitys)):
-            fileout.write("%s-%s " %(entitys[i][0], entitys[i][2]))
-        fileout.write("\n\n")
+    batches = itertools.chain.from_iterable(dataset_loader)  # feature : torch.Size([batch_size, max_len])
+    if workers > 1 and not if_cuda:
+        decoded = parallel_decode(ner_model, batches, beam_size, workers)
+    else:
+        decoded = ((feature, decode_batch(ner_model, feature, if_cuda, beam_size)) for feature in batches)
+    for feature, pre_actions in decoded:
+        for sentence, pre_action in zip(feature.tolist(), pre_actions):
+            sent_len = sum(1 for ac_idx in pre_action if not idx2action[ac_idx].startswith('R'))
+            feature_seq = [idx2word[w_idx] for w_idx in sentence[:sent_len]]
+            fileout.write("%s\nEntities: " % (" ".join(feature_seq)))
+            for word_start, word_end, ent_type in get_entities(pre_action, idx2action):
+                fileout.write("%s-%s " % (" ".join(feature_seq[word_start:word_end]), ent_type))
+            fileout.write("\n\n")
+
+
+def decode_batch(ner_model, feature, if_cuda, beam_size=1):
+    """
+    predicted action ids of every sentence of a padded batch
+    """
+    fe_v = utils.varible(feature, if_cuda)
+    if beam_size > 1:
+        return ner_model.beam_search(fe_v, beam_size)
+    with torch.no_grad():
+        _, pre_actions, _ = ner_model.forward_batch(fe_v)
+    return pre_actions
 
 
+def _decode_worker(ner_model, beam_size, tasks, results):
+    torch.set_num_threads(1)
+    for batch_idx, feature in iter(tasks.get, None):
+        try:
+            results.put((batch_idx, decode_batch(ner_model, feature, False, beam_size)))
+        except Exception as e:
+            results.put((batch_idx, RuntimeError('decoding batch %d failed: %r' % (batch_idx, e))))
+
+
+def parallel_decode(ner_model, batches, beam_size, workers):
+    """
+    decode batches on the cpu in worker processes, yielding (feature, predicted actions) in input order
+
+    the parameters are moved to shared memory and the workers are forked, so the weights and the vocabulary
+    held by ner_model exist once; at most 2 * workers batches are in flight or waiting to be written
+    """
+    ner_model.share_memory()
+    ctx = mp.get_context('fork')
+    tasks = ctx.Queue()
+    results = ctx.Queue()
+    procs = [ctx.Process(target=_decode_worker, args=(ner_model, beam_size, tasks, results)) for _ in range(workers)]
+    for proc in procs:
+        proc.daemon = True
+        proc.start()
+
+    batches = iter(batches)
+    features = dict()
+    decoded = dict()
+    n_sent = 0
+    n_done = 0
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and n_sent - n_done < 2 * workers:
+                feature = next(batches, None)
+                if feature is None:
+                    exhausted = True
+                    break
+                features[n_sent] = feature
+                tasks.put((n_sent, feature))
+                n_sent += 1
+            if n_done == n_sent:
+                break
+            try:
+                batch_idx, pre_actions = results.get(timeout=1)
+            except queue.Empty:
+                if not all(proc.is_alive() for proc in procs):
+                    raise RuntimeError('a decoding worker died')
+                continue
+            if isinstance(pre_actions, Exception):
+                raise pre_actions
+            decoded[batch_idx] = pre_actions
+            while n_done in decoded:
+                yield features.pop(n_done), decoded.pop(n_done)
+                n_done += 1
+    finally:
+        for proc in procs:
+            tasks.put(None)
+        for proc in procs:
+            proc.join(timeout=1)
+            if proc.is_alive():
+                proc.terminate()
+
+
+def get_entities(pre_action, idx2action):
+    """
+    (first word, last word + 1, type) of every entity in a predicted action sequence
+    """
+    entitys = []
+    word_start = -1
+    word_idx = 0
+    for ac_idx in pre_action:
+        action = idx2action[ac_idx]
+        if action.startswith('R'):
+            if word_start >= 0:
+                entitys.append((word_start, word_idx, action.split('-')[1]))
+                word_start = -1
+        else:
+            if action.startswith('S') and word_start < 0:
+                word_start = word_idx
+            elif action.startswith('O'):
+                word_start = -1
+            word_idx += 1
+    return entitys
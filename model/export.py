@@ -0,0 +1,253 @@
+import copy
+from typing import List, Optional, Tuple
+
+import torch
+import torch.nn as nn
+
+import model.transition as transition
+
+
+class ScriptedDecoder(nn.Module):
+    """
+    greedy predict-mode decoder of a TransitionNER in a form torch.jit.script compiles, so the exported
+    file runs without this repository
+
+    the word embedding and the char-level features of every vocabulary word are folded into one
+    token table at export time (in eval mode they only depend on the word id), actions are integer
+    codes throughout and the vocabulary and action names travel inside the module. The transition
+    system is the one of TransitionNER.transition_batch, with the bookkeeping of model.transition.
+    A model with a PagedEmbedding only exports its trainable rows, the words it pages in from the
+    embedding cache are decoded as <unk>
+    """
+    def __init__(self, ner_model, batch_size=1024):
+        super(ScriptedDecoder, self).__init__()
+        ner_model = copy.deepcopy(ner_model).cpu()
+        ner_model.eval()
+        ner_model.disable_char_cache()
+        with torch.no_grad():
+            # the resident rows, a PagedEmbedding keeps the others in its embedding cache
+            words = torch.arange(ner_model.word_embeds.weight.size(0)).long()
+            token_table = torch.cat([ner_model.token_representation(words[start:start + batch_size], pad_word=ner_model.eof_idx)
+                                     for start in range(0, words.size(0), batch_size)], 0)
+        self.register_buffer('token_table', token_table)
+        self.register_buffer('init_buffer', ner_model.init_buffer.data.clone())
+        self.register_buffer('empty_emb', ner_model.empty_emb.data.clone())
+        ner_model.action_mask(torch.zeros(1).long(), torch.zeros(1).long())
+        self.register_buffer('action_mask_table', ner_model.action_mask_table.clone())
+
+        self.lstm = ner_model.lstm
+        self.stack_lstm = ner_model.stack_lstm
+        self.output_lstm = ner_model.output_lstm
+        self.entity_forward_lstm = ner_model.entity_forward_lstm
+        self.entity_backward_lstm = ner_model.entity_backward_lstm
+        self.ac_lstm = ner_model.ac_lstm
+        self.action_embeds = ner_model.action_embeds
+        self.relation_embeds = ner_model.relation_embeds
+        self.lstms_output_2_softmax = ner_model.lstms_output_2_softmax
+        self.output_2_act = ner_model.output_2_act
+        self.entity_2_output = ner_model.entity_2_output
+
+        self.hidden_dim = ner_model.hidden_dim
+        self.rnn_layers = ner_model.rnn_layers
+        self.shift_idx = ner_model.shift_idx
+        self.out_idx = ner_model.out_idx
+        self.eof_idx = ner_model.eof_idx
+        idx2word = ner_model.idx2word
+        self.word2idx = {word: idx for idx, word in idx2word.items() if idx < token_table.size(0)}
+        self.unk_idx = self.word2idx['<unk>']
+        # entity type of every action code, '' for SHIFT, OUT and <pad>
+        entity_types = [''] * len(ner_model.action2idx)
+        for action, idx in ner_model.action2idx.items():
+            if action.startswith('R'):
+                entity_types[idx] = action.split('-')[1]
+        self.entity_types = entity_types
+        self.action_names = [name for name, _ in sorted(ner_model.action2idx.items(), key=lambda kv: kv[1])]
+
+    def encode(self, sentences: List[List[str]]) -> torch.Tensor:
+        """
+        list of token lists -> LongTensor [batch_size, max_len] of word ids padded with <eof>
+        """
+        max_len = 1
+        for sentence in sentences:
+            max_len = max(max_len, len(sentence))
+        batch = torch.full([len(sentences), max_len], self.eof_idx, dtype=torch.long)
+        for row, sentence in enumerate(sentences):
+            for col, word in enumerate(sentence):
+                batch[row, col] = self.word2idx.get(word, self.unk_idx)
+        return batch
+
+    def initial_state(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        initial lstm state of TransitionNER.initial_state in eval mode, h first
+        """
+        return torch.zeros([1, self.hidden_dim]), torch.zeros([1, self.hidden_dim])
+
+    def _embedding(self, h: torch.Tensor, top: torch.Tensor, rows: torch.Tensor, empty: Optional[torch.Tensor]) -> torch.Tensor:
+        depth = top[rows]
+        output = h[rows, depth]
+        if empty is None:
+            return output
+        return torch.where((depth == 0).unsqueeze(1), empty.expand_as(output), output)
+
+    def _put(self, h: torch.Tensor, c: torch.Tensor, top: torch.Tensor, rows: torch.Tensor, state: Tuple[torch.Tensor, torch.Tensor]):
+        """
+        push the new lstm state of rows onto the stack held in h, c and top
+        """
+        depth = top[rows] + 1
+        h[rows, depth] = state[0]
+        c[rows, depth] = state[1]
+        top[rows] = depth
+
+    def forward(self, sentences: torch.Tensor, initial: Optional[Tuple[torch.Tensor, torch.Tensor]] = None) -> List[List[int]]:
+        """
+        predicted action codes of every sentence of a padded batch of word ids, the ids of encode
+        """
+        with torch.no_grad():
+            if initial is None:
+                initial = self.initial_state()
+            init_h, init_c = initial
+            batch_size, seq_len = sentences.size(0), sentences.size(1)
+            hidden = self.hidden_dim
+            sents_len = (sentences != self.eof_idx).long().sum(1)
+            # each sentence reversed within its own length, padding last (see TransitionNER.encode_buffer)
+            positions = torch.arange(seq_len).unsqueeze(0)
+            lengths = sents_len.unsqueeze(1)
+            reverse = torch.where(positions < lengths, lengths - 1 - positions, positions)
+            token_embedds = self.token_table[sentences.gather(1, reverse)]
+            tok_output = self.lstm(token_embedds.transpose(0, 1))[0].transpose(0, 1)
+
+            stack_h = torch.zeros([batch_size, seq_len + 1, hidden])
+            stack_c = torch.zeros([batch_size, seq_len + 1, hidden])
+            output_h = torch.zeros([batch_size, seq_len + 1, hidden])
+            output_c = torch.zeros([batch_size, seq_len + 1, hidden])
+            ent_f_h = torch.zeros([batch_size, seq_len + 1, hidden])
+            ent_f_c = torch.zeros([batch_size, seq_len + 1, hidden])
+            ent_b_h = torch.zeros([batch_size, seq_len + 1, hidden])
+            ent_b_c = torch.zeros([batch_size, seq_len + 1, hidden])
+            for h, c in [(stack_h, stack_c), (output_h, output_c), (ent_f_h, ent_f_c), (ent_b_h, ent_b_c)]:
+                h[:, 0] = init_h
+                c[:, 0] = init_c
+            stack_top = torch.zeros([batch_size], dtype=torch.long)
+            output_top = torch.zeros([batch_size], dtype=torch.long)
+            ent_f_top = torch.zeros([batch_size], dtype=torch.long)
+            ent_b_top = torch.zeros([batch_size], dtype=torch.long)
+
+            ac_h = torch.zeros([self.rnn_layers, batch_size, hidden])
+            ac_c = torch.zeros([self.rnn_layers, batch_size, hidden])
+            act_h = init_h.expand(batch_size, hidden)
+            buffer_pos = torch.zeros_like(sents_len)
+            rows = torch.arange(batch_size)
+            step_predicts: List[torch.Tensor] = []
+
+            active = rows[sents_len > 0]
+            step = 0
+            while active.size(0) > 0:
+                # score the actions of the unfinished sentences
+                if step == 0:
+                    act_emb = init_h.expand(active.size(0), hidden)
+                else:
+                    act_emb = act_h[active]
+                buffer_size, buffer_emb = transition.buffer_front(tok_output, self.init_buffer, sents_len, buffer_pos, active)
+                lstms_output = torch.cat([buffer_emb, self._embedding(stack_h, stack_top, active, self.empty_emb),
+                                          self._embedding(output_h, output_top, active, self.empty_emb), act_emb], 1)
+                hidden_output = torch.tanh(self.lstms_output_2_softmax(lstms_output))
+                mask = self.action_mask_table[2 * (buffer_size > 0).long() + (stack_top[active] > 0).long()]
+                action = torch.max(self.output_2_act(hidden_output) + mask, 1)[1]
+
+                # feed the chosen actions to the action lstm
+                act_out, ac_state = self.ac_lstm(self.action_embeds(action).unsqueeze(0), (ac_h[:, active], ac_c[:, active]))
+                ac_h = ac_h.index_copy(1, active, ac_state[0])
+                ac_c = ac_c.index_copy(1, active, ac_state[1])
+                act_h = act_h.index_copy(0, active, act_out[0])
+
+                step_predict = torch.full([batch_size], -1, dtype=torch.long)
+                step_predict[active] = action
+                step_predicts.append(step_predict)
+
+                # SHIFT, OUT and REDUCE as in TransitionNER._apply_actions, on the stacks held in tensors
+                shift_rows, out_rows, reduce_rows, is_reduce = transition.split_actions(active, action, self.shift_idx, self.out_idx)
+                shift_input = transition.pop_buffer(token_embedds, sents_len, buffer_pos, shift_rows)
+                output_inputs = [transition.pop_buffer(token_embedds, sents_len, buffer_pos, out_rows)]
+
+                if reduce_rows.size(0) > 0:
+                    entity_len = stack_top[reduce_rows]
+                    for j in range(int(entity_len.max())):
+                        sub_rows, f_input, b_input = transition.entity_words(token_embedds, sents_len, buffer_pos, reduce_rows, entity_len, j)
+                        top = ent_f_top[sub_rows]
+                        self._put(ent_f_h, ent_f_c, ent_f_top, sub_rows, self.entity_forward_lstm(f_input, (ent_f_h[sub_rows, top], ent_f_c[sub_rows, top])))
+                        top = ent_b_top[sub_rows]
+                        self._put(ent_b_h, ent_b_c, ent_b_top, sub_rows, self.entity_backward_lstm(b_input, (ent_b_h[sub_rows, top], ent_b_c[sub_rows, top])))
+                    entity_input = transition.compose_entity(self._embedding(ent_f_h, ent_f_top, reduce_rows, None),
+                                                             self._embedding(ent_b_h, ent_b_top, reduce_rows, None), entity_len)
+                    rel_embedding = self.relation_embeds(action[is_reduce])
+                    output_inputs.append(self.entity_2_output(torch.cat([entity_input, rel_embedding], 1)))
+                    stack_top[reduce_rows] = 0
+
+                if shift_rows.size(0) > 0:
+                    top = stack_top[shift_rows]
+                    self._put(stack_h, stack_c, stack_top, shift_rows, self.stack_lstm(shift_input, (stack_h[shift_rows, top], stack_c[shift_rows, top])))
+                output_rows = torch.cat([out_rows, reduce_rows])
+                if output_rows.size(0) > 0:
+                    top = output_top[output_rows]
+                    self._put(output_h, output_c, output_top, output_rows,
+                              self.output_lstm(torch.cat(output_inputs, 0), (output_h[output_rows, top], output_c[output_rows, top])))
+
+                active = transition.unfinished(active, sents_len, buffer_pos, stack_top[active])
+                step += 1
+
+            predict_actions: List[List[int]] = []
+            if step == 0:
+                for row in range(batch_size):
+                    no_actions: List[int] = []
+                    predict_actions.append(no_actions)
+                return predict_actions
+            step_rows: List[List[int]] = torch.stack(step_predicts, 1).tolist()
+            for row in step_rows:
+                actions: List[int] = []
+                for a in row:
+                    if a >= 0:
+                        actions.append(a)
+                predict_actions.append(actions)
+            return predict_actions
+
+    @torch.jit.export
+    def entities(self, actions: List[int]) -> List[Tuple[int, int, str]]:
+        """
+        (first word, last word + 1, type) of every entity in an action code sequence, as evaluate.get_entities
+        """
+        found: List[Tuple[int, int, str]] = []
+        word_start = -1
+        word_idx = 0
+        for action in actions:
+            if action != self.shift_idx and action != self.out_idx:
+                if word_start >= 0:
+                    found.append((word_start, word_idx, self.entity_types[action]))
+                    word_start = -1
+            else:
+                if action == self.shift_idx and word_start < 0:
+                    word_start = word_idx
+                elif action == self.out_idx:
+                    word_start = -1
+                word_idx += 1
+        return found
+
+    @torch.jit.export
+    def predict(self, sentences: List[List[str]]) -> List[List[Tuple[int, int, str]]]:
+        """
+        entities of every tokenized sentence
+        """
+        if len(sentences) == 0:
+            return []
+        predicted: List[List[Tuple[int, int, str]]] = []
+        for actions in self.forward(self.encode(sentences), None):
+            predicted.append(self.entities(actions))
+        return predicted
+
+
+def export_decoder(ner_model, path):
+    """
+    script the greedy decoder of ner_model and save it to path, load it back with torch.jit.load
+    """
+    scripted = torch.jit.script(ScriptedDecoder(ner_model))
+    scripted.save(path)
+    return scripted
@@ -0,0 +1,115 @@
+import json
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class PagedEmbedding(nn.Module):
+    """
+    word embedding whose rows beyond the first weight.size(0) stay on disk
+
+    ids below weight.size(0) (the words of the corpora) look up the trainable weight, every other id
+    names the row frozen_rows[id - weight.size(0)] (an IntTensor) of the memory-mapped embedding cache written by
+    utils.convert_embedding. Those rows are frozen and paged into an LRU table of hot_size rows on
+    lookup, only the pages of the rows in use are read from disk.
+
+    The hot table is private to every process (it is not a buffer, so share_memory and the state
+    dict leave it out) and the memory map is reopened after unpickling.
+    """
+    def __init__(self, weight, cache_prefix, frozen_rows, hot_size=100000):
+        super(PagedEmbedding, self).__init__()
+        self.weight = nn.Parameter(weight)
+        self.register_buffer('frozen_rows', frozen_rows)
+        self.cache_prefix = cache_prefix
+        self.hot_size = hot_size
+        self.num_embeddings = weight.size(0) + frozen_rows.size(0)
+        self.embedding_dim = weight.size(1)
+        self._matrix = None
+        self.clear()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_matrix'] = None
+        state['hot'] = state['hot_slot'] = state['hot_owner'] = state['hot_used'] = None
+        return state
+
+    @property
+    def matrix(self):
+        if self._matrix is None:
+            with open(self.cache_prefix + '.json', 'r') as f:
+                meta = json.load(f)
+            self._matrix = np.memmap(self.cache_prefix + '.bin', dtype=np.float32, mode='r', shape=(meta['rows'], meta['emb_len']))
+        return self._matrix
+
+    def clear(self):
+        """
+        empty the hot table
+        """
+        self.hot = None
+        self.hot_slot = None
+        self.hot_owner = None
+        self.hot_used = None
+        self.tick = 0
+        self.reads = 0
+
+    def _reset_hot(self, device):
+        self.hot = torch.zeros(self.hot_size, self.embedding_dim, device=device)
+        # hot table slot of every frozen word (-1 when it is not paged in), frozen word in every slot
+        self.hot_slot = torch.full((self.frozen_rows.size(0),), -1, dtype=torch.int32, device=device)
+        self.hot_owner = torch.full((self.hot_size,), -1, dtype=torch.long, device=device)
+        self.hot_used = torch.zeros(self.hot_size, dtype=torch.long, device=device)
+
+    def read_rows(self, frozen):
+        """
+        [n, embedding_dim] rows of the frozen words frozen (LongTensor), read from the memory map
+        """
+        rows = self.frozen_rows[frozen].cpu().numpy()
+        order = np.argsort(rows)
+        vectors = np.empty((rows.shape[0], self.embedding_dim), dtype=np.float32)
+        # in file order, so neighbouring rows share their page reads
+        vectors[order] = self.matrix[rows[order]]
+        self.reads += rows.shape[0]
+        return torch.from_numpy(vectors).to(self.weight.device)
+
+    def lookup(self, frozen):
+        """
+        rows of the frozen words frozen through the hot table, the least recently used slots are reused for
+        the missing ones
+        """
+        if self.hot is None or self.hot.device != self.weight.device:
+            self._reset_hot(self.weight.device)
+        self.tick += 1
+        unique, inverse = torch.unique(frozen, return_inverse=True)
+        if unique.size(0) > self.hot_size:
+            # more distinct words than the table holds, read them straight through
+            return self.read_rows(unique)[inverse]
+        slots = self.hot_slot[unique].long()
+        self.hot_used[slots[slots >= 0]] = self.tick
+        missing = slots < 0
+        if missing.any():
+            new_words = unique[missing]
+            # slots used by this lookup carry the current tick, so they are never among the victims
+            victims = torch.topk(self.hot_used, new_words.size(0), largest=False)[1]
+            evicted = self.hot_owner[victims]
+            self.hot_slot[evicted[evicted >= 0]] = -1
+            self.hot[victims] = self.read_rows(new_words)
+            self.hot_owner[victims] = new_words
+            self.hot_slot[new_words] = victims.int()
+            self.hot_used[victims] = self.tick
+            slots[missing] = victims
+        return self.hot[slots][inverse]
+
+    def forward(self, words):
+        n_trainable = self.weight.size(0)
+        is_frozen = words >= n_trainable
+        embeds = F.embedding(words.masked_fill(is_frozen, 0), self.weight)
+        if not is_frozen.any():
+            return embeds
+        with torch.no_grad():
+            frozen_embeds = self.lookup(words[is_frozen] - n_trainable)
+        return embeds.index_put((is_frozen,), frozen_embeds)
+
+    def extra_repr(self):
+        return '{}, {} (trainable {}, hot {})'.format(self.num_embeddings, self.embedding_dim, self.weight.size(0), self.hot_size)
@@ -0,0 +1,88 @@
+import json
+
+import torch
+
+from model.bundle import load_bundle
+from model.stack_lstm import TransitionNER
+import model.utils as utils
+import model.evaluate as evaluate
+
+
+def load_checkpoint(arg_file, checkpoint, gpu=-1, spelling=False, char_map=None, mode='predict'):
+    """
+    TransitionNER restored from a checkpoint and its arg json, and the checkpoint dict
+
+    models trained with --paged_embedding page their frozen word rows in from the --emb_cache they were trained with
+
+    char_map is only used for checkpoints written before the char map was saved, which otherwise load without spelling only
+    """
+    with open(arg_file, 'r') as f:
+        jd = json.load(f)
+    jd = jd['args']
+
+    checkpoint_file = torch.load(checkpoint, map_location=lambda storage, loc: storage)
+    char_map = checkpoint_file.setdefault('char_map', char_map if char_map is not None else dict())
+    state_dict = checkpoint_file['state_dict']
+    ner_model = TransitionNER(mode, checkpoint_file['a_map'], checkpoint_file['f_map'], checkpoint_file['l_map'], char_map,
+                              checkpoint_file['ner_map'], state_dict['word_embeds.weight'].size(0), len(checkpoint_file['a_map']), jd['embedding_dim'],
+                              jd['action_embedding_dim'], jd['char_embedding_dim'], jd['hidden'], jd['char_hidden'], jd['layers'],
+                              jd['drop_out'], spelling, jd['char_structure'], is_cuda=gpu)
+    if 'word_embeds.frozen_rows' in state_dict:
+        ner_model.page_word_embedding(jd['emb_cache'], state_dict['word_embeds.frozen_rows'], jd['paged_embedding'])
+    ner_model.load_state_dict(state_dict)
+    if gpu >= 0:
+        ner_model.cuda()
+    ner_model.eval()
+    return ner_model, checkpoint_file
+
+
+class Predictor(object):
+    """
+    a TransitionNER restored from a checkpoint (or from the inference bundle directory bundle, see model.bundle) in predict mode,
+    decoding batches of tokenized sentences
+    """
+    def __init__(self, arg_file, checkpoint, gpu=-1, spelling=False, beam_size=1, char_cache=0, char_cache_lru=10000, quantize=False,
+                 bundle='', fused_cells=False, word_count=None):
+
+        self.beam_size = beam_size
+        self.if_cuda = gpu >= 0
+        if self.if_cuda and quantize:
+            raise ValueError('int8 quantized inference runs on the cpu only')
+        if quantize and fused_cells:
+            raise ValueError('fused cells stack the float weights, they cannot be combined with quantize')
+        if self.if_cuda:
+            torch.cuda.set_device(gpu)
+
+        if bundle:
+            self.ner_model, maps = load_bundle(bundle, gpu)
+        else:
+            self.ner_model, maps = load_checkpoint(arg_file, checkpoint, gpu, spelling)
+        self.f_map = maps['f_map']
+        self.a_map = maps['a_map']
+        self.idx2action = {v: k for k, v in self.a_map.items()}
+        self.unk = self.f_map['<unk>']
+        self.collate = utils.PadCollate(self.f_map['<eof>'])
+        if quantize:
+            self.ner_model = self.ner_model.quantize()
+        if char_cache > 0:
+            self.ner_model.enable_char_cache(char_cache, char_cache_lru, word_count)
+        if fused_cells:
+            self.ner_model.enable_fused_cells()
+
+    def encode(self, sentences):
+        """
+        list of token lists -> padded LongTensor [batch_size, max_len] of word ids
+        """
+        features = utils.encode_safe_predict(sentences, self.f_map, self.unk)
+        return self.collate([torch.LongTensor(feature) for feature in features])
+
+    def predict_actions(self, sentences):
+        return evaluate.decode_batch(self.ner_model, self.encode(sentences), self.if_cuda, self.beam_size)
+
+    def predict_entities(self, sentences):
+        """
+        one list of (first word, last word + 1, type) entities per sentence
+        """
+        if not sentences:
+            return []
+        return [evaluate.get_entities(pre_action, self.idx2action) for pre_action in self.predict_actions(sentences)]
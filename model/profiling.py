@@ -0,0 +1,152 @@
+import collections
+import time
+
+import torch
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class NullProfiler(object):
+    """
+    the disabled profiler: timers and counters do nothing
+    """
+    enabled = False
+    _timer = _NullTimer()
+
+    def timer(self, name):
+        return self._timer
+
+    def count(self, name, n=1):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class _Timer(object):
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        if self.profiler.synchronize:
+            torch.cuda.synchronize()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profiler.synchronize:
+            torch.cuda.synchronize()
+        self.profiler.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def _empty_totals():
+    return {'time': collections.defaultdict(float), 'calls': collections.defaultdict(int), 'counts': collections.defaultdict(int)}
+
+
+class Profiler(object):
+    """
+    named wall-clock timers and counters, reported per batch and summed per epoch
+
+        with profiler.timer('transition/score'):
+            ...
+        profiler.count('reduces', n_rows)
+
+    timers are inclusive, a timer running inside another one is counted in both. With synchronize set
+    the cuda stream is drained at the start and end of every timer, so gpu time lands in the right timer
+    """
+    enabled = True
+
+    def __init__(self, synchronize=False):
+        self.synchronize = synchronize
+        self.batch = _empty_totals()
+        self.epoch = _empty_totals()
+        self.epoch_batches = 0
+        self.epoch_wall = 0
+        self.batch_start = time.perf_counter()
+
+    def timer(self, name):
+        return _Timer(self, name)
+
+    def add_time(self, name, seconds):
+        self.batch['time'][name] += seconds
+        self.batch['calls'][name] += 1
+
+    def count(self, name, n=1):
+        self.batch['counts'][name] += int(n)
+
+    def reset_batch(self):
+        """
+        drop whatever was measured since the last batch, and start timing the next one now
+        """
+        self.batch = _empty_totals()
+        self.batch_start = time.perf_counter()
+
+    def end_batch(self):
+        """
+        close the running batch, fold it into the epoch totals and return its report
+        """
+        wall = time.perf_counter() - self.batch_start
+        report = _report(self.batch, wall)
+        report['batch'] = self.epoch_batches
+        for kind, values in self.batch.items():
+            for name, value in values.items():
+                self.epoch[kind][name] += value
+        self.epoch_batches += 1
+        self.epoch_wall += wall
+        self.reset_batch()
+        return report
+
+    def end_epoch(self):
+        """
+        report of the batches closed since the last call; wall time is the sum of the batch wall times
+        """
+        report = _report(self.epoch, self.epoch_wall)
+        report['batches'] = self.epoch_batches
+        self.epoch = _empty_totals()
+        self.epoch_batches = 0
+        self.epoch_wall = 0
+        return report
+
+    def batches(self, iterable, on_batch=None):
+        """
+        yield from iterable and close a batch each time the consumer asks for the next item,
+        passing its report to on_batch
+
+        measurements taken before the first item is pulled (an evaluation pass between two epochs,
+        say) are dropped
+        """
+        self.reset_batch()
+        for item in iterable:
+            yield item
+            report = self.end_batch()
+            if on_batch is not None:
+                on_batch(report)
+
+
+def _report(totals, wall):
+    return {'wall': wall,
+            'time': dict(totals['time']),
+            'calls': dict(totals['calls']),
+            'counts': dict(totals['counts'])}
+
+
+def format_report(report, top=8):
+    """
+    one line summary of a report: the slowest timers with their share of the wall time, then the counters
+    """
+    wall = max(report['wall'], 1e-9)
+    timers = sorted(report['time'].items(), key=lambda kv: -kv[1])[:top]
+    parts = ['%s %.3fs (%.1f%%)' % (name, seconds, 100 * seconds / wall) for name, seconds in timers]
+    parts += ['%s %d' % (name, n) for name, n in sorted(report['counts'].items())]
+    return 'wall %.3fs: %s' % (report['wall'], ', '.join(parts))
@@ -1,3 +1,5 @@
+import collections
+import itertools
 import logging
 import torch
 import torch.autograd as autograd
@@ -5,6 +7,9 @@ import torch.nn as nn
 import numpy as np
 
 import model.utils as utils
+import model.profiling as profiling
+import model.transition as transition
+from model.paged_embedding import PagedEmbedding
 
 
 class StackRNN(object):
@@ -18,7 +23,6 @@ class StackRNN(object):
             self.empty = p_empty_embedding
 
     def push(self, expr, extra=None):
-        self.dropout(self.s[-1][0][0])
         self.s.append((self.cell(expr, self.s[-1][0]), extra))
 
     def pop(self):
@@ -51,10 +55,8 @@ class StackRNN_2Layer(object):
             self.empty = p_empty_embedding
 
     def push(self, expr, extra=None):
-        self.dropout(self.layer1[-1][0][0])
         self.layer1.append((self.cell1(expr, self.layer1[-1][0]), extra))
         mid_h = self.get_output(self.layer1[-1][0])
-        self.dropout(self.layer2[-1][0][0])
         self.layer2.append((self.cell2(mid_h, self.layer2[-1][0]), extra))
 
     def pop(self):
@@ -78,6 +80,293 @@ class StackRNN_2Layer(object):
         return len(self.layer1) - 1
 
 
+class BatchStackRNN(object):
+    """
+    stack-LSTM for a whole batch, states kept in preallocated [batch, max_depth + 1, hidden] buffers
+
+    slot 0 of every row holds the initial state and top[b] is the depth of row b, so push, pop and
+    embedding work on a LongTensor of rows at once
+    """
+    def __init__(self, cell, initial_state, get_output, p_empty_embedding, batch_size, max_depth):
+        self.cell = cell
+        self.get_output = get_output
+        self.empty = p_empty_embedding
+        hidden_size = initial_state[0].size(1)
+        self.h = initial_state[0].data.new(batch_size, max_depth + 1, hidden_size).zero_()
+        self.c = initial_state[1].data.new(batch_size, max_depth + 1, hidden_size).zero_()
+        self.h[:, 0] = initial_state[0].data
+        self.c[:, 0] = initial_state[1].data
+        self.top = initial_state[0].data.new(batch_size).long().zero_()
+        # with track_projection, proj[b, d] holds the projection of the output at depth d (of the empty embedding at 0)
+        self.proj = None
+
+    def track_projection(self, empty_projection):
+        self.proj = self.h.new(self.h.size(0), self.h.size(1), empty_projection.size(-1)).zero_()
+        self.proj[:, 0] = empty_projection
+
+    def state(self, rows):
+        top = self.top[rows]
+        return self.h[rows, top], self.c[rows, top]
+
+    def put(self, rows, state, proj=None):
+        """
+        push a state computed outside of the stack (and the projection of its output)
+        """
+        top = self.top[rows] + 1
+        self.h[rows, top] = state[0]
+        self.c[rows, top] = state[1]
+        if proj is not None:
+            self.proj[rows, top] = proj
+        self.top[rows] = top
+
+    def push(self, rows, expr):
+        self.put(rows, self.cell(expr, self.state(rows)))
+
+    def pop(self, rows):
+        self.top[rows] = self.top[rows] - 1
+
+    def clear(self, rows):
+        self.top[rows] = 0
+
+    def embedding(self, rows):
+        top = self.top[rows]
+        output = self.get_output((self.h[rows, top], self.c[rows, top]))
+        if self.empty is None:
+            return output
+        return torch.where((top == 0).unsqueeze(1), self.empty.expand_as(output), output)
+
+    def projection(self, rows):
+        return self.proj[rows, self.top[rows]]
+
+    def size(self, rows):
+        return self.top[rows]
+
+
+def fused_lstm_step(inputs, h, c, weight, bias):
+    """
+    LSTM cell updates of several cells in one baddbmm: inputs [n_cells, n, input_size], h and c [n_cells, n, hidden],
+    weight [n_cells, input_size + hidden, 4 * hidden] ([weight_ih, weight_hh] of each cell, transposed) and bias
+    [n_cells, 1, 4 * hidden] (bias_ih + bias_hh); the gates are in the i, f, g, o order of nn.LSTMCell
+    """
+    gates = torch.baddbmm(bias, torch.cat([inputs, h], 2), weight)
+    hidden = h.size(2)
+    ifo = torch.sigmoid(gates)
+    c = ifo[:, :, hidden:2 * hidden] * c + ifo[:, :, :hidden] * torch.tanh(gates[:, :, 2 * hidden:3 * hidden])
+    return ifo[:, :, 3 * hidden:] * torch.tanh(c), c
+
+
+class FusedCells(object):
+    """
+    cell updates of a greedy TransitionNER decoding after enable_fused_cells
+
+    the cells due at a step (stack for SHIFT rows, output for OUT and REDUCE rows, action for every row) run
+    as one fused_lstm_step, and the two entity lstms as another. The scoring layer is split by its input blocks:
+    the buffer block is applied to tok_output once per batch and the other blocks to every new lstm output as it
+    is pushed, so a step only sums four projections. The reordered sums change scores in the last float bits, so
+    the decoded actions are those of the separate cells except at a step whose two best actions are tied to that
+    precision
+    """
+    def __init__(self, ner_model, stack, output, ent_f, ent_b, tok_output, token_dim, lstm_initial):
+        self.model = ner_model
+        self.stack = stack
+        self.output = output
+        self.ent_f = ent_f
+        self.ent_b = ent_b
+        with torch.no_grad():
+            self.weights = ner_model._fused_weights()
+            batch_size, seq_len, hidden_dim = tok_output.size()
+            cell_proj = self.weights['cell_proj']
+            stack.track_projection(ner_model.empty_emb.detach().mm(cell_proj[0]))
+            output.track_projection(ner_model.empty_emb.detach().mm(cell_proj[1]))
+            # the scoring bias is folded into the buffer projection
+            self.buffer_proj = torch.addmm(self.weights['proj_bias'], tok_output.reshape(-1, hidden_dim),
+                                           self.weights['buffer_proj']).view(batch_size, seq_len, hidden_dim)
+            self.empty_buffer_proj = torch.addmm(self.weights['proj_bias'], ner_model.init_buffer, self.weights['buffer_proj'])
+            self.ac_h = tok_output.new_zeros(batch_size, hidden_dim)
+            self.ac_c = tok_output.new_zeros(batch_size, hidden_dim)
+            self.act_proj = lstm_initial[0].mm(cell_proj[2]).expand(batch_size, hidden_dim).clone()
+        self.cell_input = max(token_dim, ner_model.action_embeds.embedding_dim)
+
+    def score(self, rows, sents_len, buffer_pos):
+        with self.model.profiler.timer('transition/score'):
+            buffer_size, b_proj = transition.buffer_front(self.buffer_proj, self.empty_buffer_proj, sents_len, buffer_pos, rows)
+            hidden_output = torch.tanh(b_proj + self.stack.projection(rows) + self.output.projection(rows) + self.act_proj[rows])
+            return self.model.output_2_act(hidden_output) + self.model.action_mask(self.stack.size(rows), buffer_size)
+
+    def push_entity(self, rows, f_input, b_input):
+        f_h, f_c = self.ent_f.state(rows)
+        b_h, b_c = self.ent_b.state(rows)
+        h, c = fused_lstm_step(torch.stack([f_input, b_input], 0), torch.stack([f_h, b_h], 0), torch.stack([f_c, b_c], 0),
+                               self.weights['entity_weight'], self.weights['entity_bias'])
+        self.ent_f.put(rows, (h[0], c[0]))
+        self.ent_b.put(rows, (h[1], c[1]))
+
+    def push(self, rows, action, shift_rows, shift_input, output_rows, output_input):
+        """
+        push shift_input onto the stack of shift_rows, output_input onto the output of output_rows and action onto
+        the action lstm of every row
+        """
+        with self.model.profiler.timer('transition/cells'):
+            # cell 0 is the stack lstm, 1 the output lstm and 2 the action lstm, rows past the count of a cell are padding
+            n_shift, n_output, n_rows = shift_rows.size(0), output_rows.size(0), rows.size(0)
+            hidden_dim = self.ac_h.size(1)
+            inputs = shift_input.new_zeros(3, n_rows, self.cell_input)
+            h = shift_input.new_zeros(3, n_rows, hidden_dim)
+            c = shift_input.new_zeros(3, n_rows, hidden_dim)
+            inputs[0, :n_shift, :shift_input.size(1)] = shift_input
+            h[0, :n_shift], c[0, :n_shift] = self.stack.state(shift_rows)
+            inputs[1, :n_output, :output_input.size(1)] = output_input
+            h[1, :n_output], c[1, :n_output] = self.output.state(output_rows)
+            act_input = self.model.action_embeds(action)
+            inputs[2, :, :act_input.size(1)] = act_input
+            h[2], c[2] = self.ac_h[rows], self.ac_c[rows]
+            h, c = fused_lstm_step(inputs, h, c, self.weights['cell_weight'], self.weights['cell_bias'])
+            proj = torch.bmm(h, self.weights['cell_proj'])
+            self.stack.put(shift_rows, (h[0, :n_shift], c[0, :n_shift]), proj[0, :n_shift])
+            self.output.put(output_rows, (h[1, :n_output], c[1, :n_output]), proj[1, :n_output])
+            self.ac_h[rows] = h[2]
+            self.ac_c[rows] = c[2]
+            self.act_proj[rows] = proj[2]
+
+
+class BeamStackRNN(object):
+    """
+    stack-LSTM whose rows share history: every push appends a (h, c, parent) node to a pool and a row
+    only points at its top node, so rows forked from the same parent share all earlier states and
+    reordering rows moves pointers instead of copying states
+
+    meant for decoding under torch.no_grad
+    """
+    def __init__(self, cell, initial_state, get_output, p_empty_embedding, n_rows, capacity):
+        self.cell = cell
+        self.get_output = get_output
+        self.empty = p_empty_embedding
+        hidden_size = initial_state[0].size(1)
+        self.h = initial_state[0].data.new(capacity + 1, hidden_size).zero_()
+        self.c = initial_state[1].data.new(capacity + 1, hidden_size).zero_()
+        self.h[0] = initial_state[0].data[0]
+        self.c[0] = initial_state[1].data[0]
+        self.parent = initial_state[0].data.new(capacity + 1).long().zero_()
+        self.depth = initial_state[0].data.new(capacity + 1).long().zero_()
+        self.n_nodes = 1
+        self.top = initial_state[0].data.new(n_rows).long().zero_()
+
+    def _reserve(self, n):
+        if self.n_nodes + n <= self.h.size(0):
+            return
+        extra = max(n, self.h.size(0))
+        self.h = torch.cat([self.h, self.h.new(extra, self.h.size(1)).zero_()], 0)
+        self.c = torch.cat([self.c, self.c.new(extra, self.c.size(1)).zero_()], 0)
+        self.parent = torch.cat([self.parent, self.parent.new(extra).zero_()], 0)
+        self.depth = torch.cat([self.depth, self.depth.new(extra).zero_()], 0)
+
+    def push(self, rows, expr):
+        top = self.top[rows]
+        state = self.cell(expr, (self.h[top], self.c[top]))
+        self._reserve(rows.size(0))
+        nodes = torch.arange(self.n_nodes, self.n_nodes + rows.size(0)).long().to(top.device)
+        self.h[nodes] = state[0]
+        self.c[nodes] = state[1]
+        self.parent[nodes] = top
+        self.depth[nodes] = self.depth[top] + 1
+        self.top[rows] = nodes
+        self.n_nodes += rows.size(0)
+
+    def pop(self, rows):
+        self.top[rows] = self.parent[self.top[rows]]
+
+    def clear(self, rows):
+        self.top[rows] = 0
+
+    def reorder(self, index):
+        self.top = self.top[index]
+
+    def embedding(self, rows):
+        top = self.top[rows]
+        output = self.get_output((self.h[top], self.c[top]))
+        if self.empty is None:
+            return output
+        return torch.where((top == 0).unsqueeze(1), self.empty.expand_as(output), output)
+
+    def size(self, rows):
+        return self.depth[self.top[rows]]
+
+
+class CharRepresentationCache(object):
+    """
+    eval-mode store of char-level word representations
+
+    the words of head_words (a LongTensor of word ids) live in a dense table filled on first use, the remaining
+    words share an LRU area of lru_size entries. The whole store is dropped whenever the signature of the char
+    weights it was computed from changes.
+    """
+    def __init__(self, head_words, lru_size):
+        self.head_words = head_words
+        self.head_size = head_words.size(0)
+        self.lru_size = lru_size
+        self.lru = collections.OrderedDict()
+        # row of the dense table for every word id up to the largest head word, -1 outside the head
+        self.slot = torch.LongTensor(int(head_words.max()) + 1 if self.head_size > 0 else 0).fill_(-1)
+        self.slot[head_words] = torch.arange(self.head_size).long()
+        self.head = None
+        self.head_filled = torch.zeros(self.head_size).bool()
+        self.signature = None
+
+    def clear(self):
+        self.lru.clear()
+        self.head = None
+        self.head_filled.zero_()
+
+    def slots(self, words):
+        slots = torch.LongTensor(words.size(0)).fill_(-1)
+        in_range = words < self.slot.size(0)
+        slots[in_range] = self.slot[words[in_range]]
+        return slots
+
+    def lookup(self, words, encode, signature):
+        if signature != self.signature:
+            self.clear()
+            self.signature = signature
+        slots = self.slots(words)
+        is_head = slots >= 0
+        head_slots = slots[is_head]
+        tail_words = words[~is_head].tolist()
+
+        missing = words[is_head][~self.head_filled[head_slots]].tolist()
+        missing += [w for w in tail_words if w not in self.lru]
+        fresh = dict()
+        if len(missing) > 0:
+            missing = torch.LongTensor(sorted(set(missing)))
+            with torch.no_grad():
+                encoded = encode(missing).data
+            if self.head is None:
+                self.head = encoded.new(self.head_size, encoded.size(1)).zero_()
+            missing_slots = self.slots(missing)
+            in_head = missing_slots >= 0
+            if in_head.any():
+                self.head[missing_slots[in_head].to(encoded.device)] = encoded[in_head.to(encoded.device)]
+                self.head_filled[missing_slots[in_head]] = True
+            fresh = dict(zip(missing[~in_head].tolist(), encoded[(~in_head).to(encoded.device)]))
+
+        char_rep = self.head.new(words.size(0), self.head.size(1))
+        if head_slots.size(0) > 0:
+            char_rep[is_head.to(char_rep.device)] = self.head[head_slots.to(char_rep.device)]
+        if len(tail_words) > 0:
+            tail_rep = []
+            for w in tail_words:
+                if w in fresh:
+                    tail_rep.append(fresh[w])
+                else:
+                    self.lru.move_to_end(w)
+                    tail_rep.append(self.lru[w])
+            char_rep[(~is_head).to(char_rep.device)] = torch.stack(tail_rep, 0)
+            for w, rep in fresh.items():
+                self.lru[w] = rep
+            while len(self.lru) > self.lru_size:
+                self.lru.popitem(last=False)
+        return char_rep
+
+
 class TransitionNER(nn.Module):
 
     def __init__(self, mode, action2idx, word2idx, label2idx, char2idx, ner_map, vocab_size, action_size, embedding_dim, action_embedding_dim, char_embedding_dim,
@@ -101,6 +390,10 @@ class TransitionNER(nn.Module):
         self.idx2word = {v: k for k, v in word2idx.items()}
         self.idx2char = {v: k for k, v in char2idx.items()}
         self.ner_map = ner_map
+        self.shift_idx = action2idx["SHIFT"]
+        self.out_idx = action2idx["OUT"]
+        self.reduce_idx = [action2idx[ner_action] for ner_action in ner_map.keys()]
+        self.eof_idx = word2idx['<eof>']
 
         self.word_embeds = nn.Embedding(vocab_size, embedding_dim)
         self.action_embeds = nn.Embedding(action_size, action_embedding_dim)
@@ -118,6 +411,7 @@ class TransitionNER(nn.Module):
                 self.pad_char_embeds = nn.Parameter(torch.zeros(1, char_hidden_dim ))
                 self.unk_char_embeds = nn.Parameter(torch.randn(1, char_hidden_dim), requires_grad=True)
                 self.conv1d = nn.Conv1d(char_embedding_dim, char_hidden_dim, 3, padding=2)
+            self.char_table = utils.CharTable(word2idx, char2idx)
         else:
             self.tok_embedding_dim = self.embedding_dim
 
@@ -136,7 +430,8 @@ class TransitionNER(nn.Module):
         self.dropout_e = nn.Dropout(p=dropout_ratio)
         self.dropout = nn.Dropout(p=dropout_ratio)
 
-        self.init_buffer = utils.xavier_init(self.gpu_triger,1,hidden_dim)
+        # drawn once, and saved with the parameters so that a reloaded model sees the same empty buffer
+        self.register_buffer('init_buffer', utils.xavier_init(self.gpu_triger,1,hidden_dim))
         self.empty_emb = nn.Parameter(torch.randn(1, hidden_dim))
         self.lstms_output_2_softmax = nn.Linear(hidden_dim * 4, hidden_dim)
         self.output_2_act = nn.Linear(hidden_dim, len(ner_map)+2)
@@ -144,12 +439,31 @@ class TransitionNER(nn.Module):
 
         self.batch_size = 1
         self.seq_length = 1
+        self.char_cache = None
+        self.action_mask_table = None
+        self.profiler = profiling.NULL_PROFILER
+        self.fused_cells = False
+        self.fused_weights = None
 
 
 
     def _rnn_get_output(self, state):
         return state[0]
 
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        # checkpoints written before init_buffer was saved keep the one drawn when the model was built
+        state_dict.setdefault(prefix + 'init_buffer', self.init_buffer)
+        super(TransitionNER, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+
+    def initial_state(self):
+        """
+        initial (h, c) of the stack, output and entity lstms: a random xavier draw in training, its mean (zeros) in eval
+        mode, so a decoded sentence depends neither on the draw nor on the other sentences of its batch
+        """
+        if self.training:
+            return utils.xavier_init(self.gpu_triger, 1, self.hidden_dim), utils.xavier_init(self.gpu_triger, 1, self.hidden_dim)
+        return utils.init_varaible_zero(self.gpu_triger, 1, self.hidden_dim), utils.init_varaible_zero(self.gpu_triger, 1, self.hidden_dim)
+
     def get_possible_actions(self, stack, buffer):
         valid_actions = []
         if len(buffer) > 0:
@@ -189,6 +503,14 @@ class TransitionNER(nn.Module):
         self.word_embeds.weight = nn.Parameter(pre_embeddings)
 
 
+    def page_word_embedding(self, cache_prefix, frozen_rows, hot_size):
+        """
+        keep the current word embedding rows trainable and page the words beyond them in from the frozen rows
+        frozen_rows of the embedding cache cache_prefix, see PagedEmbedding
+        """
+        self.word_embeds = PagedEmbedding(self.word_embeds.weight.data, cache_prefix, frozen_rows, hot_size)
+        self.vocab_size = self.word_embeds.num_embeddings
+
     def rand_init(self, init_word_embedding=False, init_action_embedding=True, init_relation_embedding=True):
 
         if init_word_embedding:
@@ -215,18 +537,182 @@ class TransitionNER(nn.Module):
         utils.init_lstm_cell(self.entity_forward_lstm)
         utils.init_lstm_cell(self.entity_backward_lstm)
 
+    def char_representation(self, words, pad_word=None):
+        """
+        char-level features of a LongTensor of word ids, all words encoded by one char_bi_lstm / conv1d call
+
+        <unk> (and words without any known character) get unk_char_embeds, pad_word gets pad_char_embeds
+        """
+        flat = words.data.contiguous().view(-1).cpu()
+        unique, inverse = torch.unique(flat, return_inverse=True)
+        char_len = self.char_table.lengths(unique)[inverse]
+        to_encode = (flat != 0) & (char_len > 0)
+        char_rep = self.unk_char_embeds.expand(flat.size(0), self.unk_char_embeds.size(1))
+        if pad_word is not None:
+            is_pad = flat == pad_word
+            to_encode = to_encode & ~is_pad
+            char_rep = torch.where(utils.varible(is_pad.unsqueeze(1), self.gpu_triger), self.pad_char_embeds.expand_as(char_rep), char_rep)
+        encode_idx = to_encode.nonzero().view(-1)
+        if encode_idx.size(0) > 0:
+            if self.char_cache is not None and not self.training:
+                encoded = self.char_cache.lookup(flat[encode_idx], self.encode_chars, self._char_weights_signature())
+            else:
+                encoded = self.encode_chars(flat[encode_idx])
+            char_rep = char_rep.index_copy(0, utils.varible(encode_idx, self.gpu_triger), encoded)
+        return char_rep.view(*(tuple(words.size()) + (char_rep.size(1),)))
+
+    def enable_char_cache(self, head_size, lru_size=10000, word_count=None):
+        """
+        cache char-level representations in eval mode: head_size words in a dense table, up to lru_size other
+        words in an LRU area
+
+        the dense table holds the head_size most frequent words of word_count (word -> count in the training corpus),
+        or the words of the lowest ids when no counts are given
+        """
+        if not self.use_spelling:
+            return
+        words = torch.arange(1, self.char_table.size).long()
+        words = words[self.char_table.lengths(words) > 0]
+        if word_count is not None:
+            counts = [(word_count.get(self.idx2word[idx], 0), idx) for idx in words.tolist()]
+            # stable sort: equally frequent words keep the order of their ids
+            words = torch.LongTensor([idx for count, idx in sorted(counts, key=lambda c: -c[0]) if count > 0])
+        self.char_cache = CharRepresentationCache(words[:head_size], lru_size)
+
+    def disable_char_cache(self):
+        self.char_cache = None
+
+    def enable_profiler(self, profiler):
+        """
+        time the phases of forward / forward_batch / beam_search and count transitions with a profiling.Profiler
+        """
+        self.profiler = profiler
+
+    def disable_profiler(self):
+        self.profiler = profiling.NULL_PROFILER
+
+    def enable_fused_cells(self):
+        """
+        greedy decoding in eval mode updates the stack, output and action lstms of a step with one batched matmul
+        (and both entity lstms with another), lstms_output_2_softmax folded into per-lstm projections of their outputs
+        """
+        if self.rnn_layers != 1:
+            raise ValueError('fused cells need a single layer ac_lstm, the model has %d' % self.rnn_layers)
+        if not all(type(m) is nn.LSTMCell for m in [self.stack_lstm, self.output_lstm, self.entity_forward_lstm, self.entity_backward_lstm]) \
+                or type(self.ac_lstm) is not nn.LSTM or type(self.lstms_output_2_softmax) is not nn.Linear:
+            raise ValueError('fused cells need the float lstm and linear modules, not quantized ones')
+        self.fused_cells = True
+
+    def disable_fused_cells(self):
+        self.fused_cells = False
+        self.fused_weights = None
+
+    def quantize(self):
+        """
+        copy of the model for cpu inference with int8 weights in every LSTM, LSTMCell and Linear module,
+        their activations are quantized on the fly at each call
+        """
+        quantized = torch.quantization.quantize_dynamic(self, {nn.LSTM, nn.LSTMCell, nn.Linear}, dtype=torch.qint8)
+        quantized.disable_fused_cells()
+        return quantized
+
+    def fill_char_cache(self, batch_size=4096):
+        """
+        encode every word of the dense part of the char cache up front
+        """
+        if self.char_cache is None:
+            return
+        is_training = self.training
+        self.eval()
+        words = self.char_cache.head_words
+        for start in range(0, words.size(0), batch_size):
+            self.char_cache.lookup(words[start:start + batch_size], self.encode_chars, self._char_weights_signature())
+        self.train(is_training)
+
+    def _char_weights_signature(self):
+        char_module = self.char_bi_lstm if self.char_structure == 'lstm' else self.conv1d
+        return tuple((p.data_ptr(), p._version) for p in itertools.chain(self.char_embeds.parameters(), char_module.parameters()))
+
+    def _fused_parameters(self):
+        return [self.stack_lstm.weight_ih, self.stack_lstm.weight_hh, self.stack_lstm.bias_ih, self.stack_lstm.bias_hh,
+                self.output_lstm.weight_ih, self.output_lstm.weight_hh, self.output_lstm.bias_ih, self.output_lstm.bias_hh,
+                self.ac_lstm.weight_ih_l0, self.ac_lstm.weight_hh_l0, self.ac_lstm.bias_ih_l0, self.ac_lstm.bias_hh_l0,
+                self.entity_forward_lstm.weight_ih, self.entity_forward_lstm.weight_hh, self.entity_forward_lstm.bias_ih, self.entity_forward_lstm.bias_hh,
+                self.entity_backward_lstm.weight_ih, self.entity_backward_lstm.weight_hh, self.entity_backward_lstm.bias_ih, self.entity_backward_lstm.bias_hh,
+                self.lstms_output_2_softmax.weight, self.lstms_output_2_softmax.bias]
+
+    def _stacked_cell_weights(self, cells):
+        """
+        [n_cells, input_size + hidden, 4 * hidden] weights and [n_cells, 1, 4 * hidden] biases of fused_lstm_step for the
+        (weight_ih, weight_hh, bias_ih, bias_hh) of every cell, inputs narrower than the widest are zero-padded
+        """
+        input_size = max(w_ih.size(1) for w_ih, _, _, _ in cells)
+        weights = []
+        for w_ih, w_hh, _, _ in cells:
+            w_ih = torch.cat([w_ih, w_ih.new_zeros(w_ih.size(0), input_size - w_ih.size(1))], 1)
+            weights.append(torch.cat([w_ih, w_hh], 1).t())
+        return torch.stack(weights, 0).contiguous(), torch.stack([b_ih + b_hh for _, _, b_ih, b_hh in cells], 0).unsqueeze(1)
+
+    def _fused_weights(self):
+        """
+        stacked weights of the fused decoding, rebuilt whenever one of the parameters changes
+        """
+        signature = tuple((p.data_ptr(), p._version) for p in self._fused_parameters())
+        if self.fused_weights is None or self.fused_weights['signature'] != signature:
+            with torch.no_grad():
+                (s_ih, s_hh, s_bih, s_bhh, o_ih, o_hh, o_bih, o_bhh, a_ih, a_hh, a_bih, a_bhh,
+                 f_ih, f_hh, f_bih, f_bhh, b_ih, b_hh, b_bih, b_bhh, proj, proj_bias) = [p.detach() for p in self._fused_parameters()]
+                cell_weight, cell_bias = self._stacked_cell_weights([(s_ih, s_hh, s_bih, s_bhh), (o_ih, o_hh, o_bih, o_bhh), (a_ih, a_hh, a_bih, a_bhh)])
+                entity_weight, entity_bias = self._stacked_cell_weights([(f_ih, f_hh, f_bih, f_bhh), (b_ih, b_hh, b_bih, b_bhh)])
+                # lstms_output_2_softmax reads [buffer, stack, output, action], one column block each
+                blocks = [block.t().contiguous() for block in proj.split(self.hidden_dim, 1)]
+                self.fused_weights = {'signature': signature, 'cell_weight': cell_weight, 'cell_bias': cell_bias,
+                                      'entity_weight': entity_weight, 'entity_bias': entity_bias,
+                                      'buffer_proj': blocks[0], 'proj_bias': proj_bias, 'cell_proj': torch.stack(blocks[1:], 0)}
+        return self.fused_weights
+
+    def encode_chars(self, words):
+        chars, char_len = self.char_table.lookup(words)
+        max_len = chars.size(1)
+        chars = utils.varible(chars.long(), self.gpu_triger)
+        chars_embeds = self.dropout_e(self.char_embeds(chars))  # [n_words, max_len, char_embedding_dim]
+        if self.char_structure == 'lstm':
+            packed = nn.utils.rnn.pack_padded_sequence(chars_embeds, char_len.long(), batch_first=True, enforce_sorted=False)
+            _, hidden = self.char_bi_lstm(packed)
+            return torch.cat([hidden[0][-2], hidden[0][-1]], 1)
+        elif self.char_structure == 'cnn':
+            positions = torch.arange(max_len + 2).unsqueeze(0)
+            char_mask = utils.varible((positions[:, :max_len] < char_len.unsqueeze(1)).unsqueeze(2), self.gpu_triger)
+            char = (chars_embeds * char_mask.float()).transpose(1, 2)
+            char = self.conv1d(char)
+            out_mask = utils.varible((positions >= (char_len + 2).unsqueeze(1)).unsqueeze(1), self.gpu_triger)
+            char, _ = char.masked_fill(out_mask, float('-inf')).max(dim=2)
+            return torch.tanh(char)
+
+    def token_representation(self, sentences, pad_word=None):
+        """
+        word embedding of every token, followed by its char-level features when use_spelling is set
+        """
+        with self.profiler.timer('embedding'):
+            word_embeds = self.dropout_e(self.word_embeds(sentences))
+        if not self.use_spelling:
+            return word_embeds
+        with self.profiler.timer('char'):
+            char_rep = self.char_representation(sentences, pad_word)
+        return torch.cat([word_embeds, char_rep], -1)
+
     def forward(self, sentence, actions=None, hidden=None):
 
         sentence = sentence.squeeze(0)
         self.set_seq_size(sentence)
-        word_embeds = self.dropout_e(self.word_embeds(sentence))
+        token_embedding = self.token_representation(sentence)
         if self.mode == 'train':
             actions = actions.squeeze(0)
             action_embeds = self.dropout_e(self.action_embeds(actions))
             relation_embeds = self.dropout_e(self.relation_embeds(actions))
         action_count = 0
 
-        lstm_initial = (utils.xavier_init(self.gpu_triger, 1, self.hidden_dim), utils.xavier_init(self.gpu_triger, 1, self.hidden_dim))
+        lstm_initial = self.initial_state()
 
         buffer = StackRNN(self.buffer_lstm, lstm_initial, self.dropout, self._rnn_get_output, self.empty_emb)
         stack = StackRNN(self.stack_lstm, lstm_initial, self.dropout, self._rnn_get_output, self.empty_emb)
@@ -236,283 +722,343 @@ class TransitionNER(nn.Module):
         ent_b = StackRNN(self.entity_backward_lstm, lstm_initial, self.dropout, self._rnn_get_output, self.empty_emb)
 
         pre_actions = []
-        losses = []
+        step_logits = []
         right = 0
 
-        sentence_array = sentence.data.cpu().numpy()
-        token_embedding = list()
-
-        for word_idx in range(len(sentence_array)):
-            if self.use_spelling:
-                if sentence_array[word_idx] == 0:
-                    tok_rep = torch.cat([word_embeds[word_idx].unsqueeze(0), self.unk_char_embeds], 1)
-                else:
-                    word = sentence_array[word_idx]
-                    chars_in_word = [self.char2idx[char] for char in self.idx2word[word]]
-                    chars_Tensor = utils.varible(torch.from_numpy(np.array(chars_in_word)), self.gpu_triger)
-                    chars_embeds = self.dropout_e(self.char_embeds(chars_Tensor))
-                    if self.char_structure == 'lstm':
-                        char_o, hidden = self.char_bi_lstm(chars_embeds.unsqueeze(1), hidden)
-                        char_out = torch.chunk(hidden[0].squeeze(1), 2, 0)
-                        tok_rep = torch.cat([word_embeds[word_idx].unsqueeze(0), char_out[0], char_out[1]], 1)
-                    elif self.char_structure == 'cnn':
-                        char = chars_embeds.unsqueeze(0)
-                        char = char.transpose(1, 2)
-                        char, _ = self.conv1d(char).max(dim=2)
-                        char = torch.tanh(char)
-                        tok_rep = torch.cat([word_embeds[word_idx].unsqueeze(0), char], 1)
-            else:
-                tok_rep = word_embeds[word_idx].unsqueeze(0)
-            if word_idx == 0:
-                token_embedding = tok_rep
-            else:
-                token_embedding = torch.cat([token_embedding, tok_rep], 0)
-
-        for i in range(token_embedding.size()[0]):
-            tok_embed = token_embedding[token_embedding.size()[0]-1-i].unsqueeze(0)
-            tok = sentence.data[token_embedding.size()[0]-1-i]
-            buffer.push(tok_embed, (tok_embed, self.idx2word[tok]))
-
-        while len(buffer) > 0 or len(stack) > 0:
-            valid_actions = self.get_possible_actions(stack, buffer)
-            log_probs = None
-            if len(valid_actions)>1:
+        self.profiler.count('sentences')
+        self.profiler.count('tokens', token_embedding.size(0))
+        with self.profiler.timer('buffer_lstm'):
+            for i in range(token_embedding.size()[0]):
+                tok_embed = token_embedding[token_embedding.size()[0]-1-i].unsqueeze(0)
+                tok = sentence.data[token_embedding.size()[0]-1-i]
+                buffer.push(tok_embed, (tok_embed, self.idx2word[utils.to_scalar(tok)]))
 
+        with self.profiler.timer('transition'):
+            while len(buffer) > 0 or len(stack) > 0:
                 lstms_output = torch.cat([buffer.embedding(), stack.embedding(), output.embedding(), action.embedding()], 1)
                 hidden_output = torch.tanh(self.lstms_output_2_softmax(self.dropout(lstms_output)))
-                if self.gpu_triger is True:
-                    logits = self.output_2_act(hidden_output)[0][torch.autograd.Variable(torch.LongTensor(valid_actions)).cuda()]
-                else:
-                    logits = self.output_2_act(hidden_output)[0][torch.autograd.Variable(torch.LongTensor(valid_actions))]
-                valid_action_tbl = {a: i for i, a in enumerate(valid_actions)}
-                log_probs = torch.nn.functional.log_softmax(logits)
-                action_idx = torch.max(log_probs.cpu(), 0)[1][0].data.numpy()[0]
-                action_predict = valid_actions[action_idx]
+                sizes = utils.varible(torch.LongTensor([len(stack), len(buffer)]), self.gpu_triger)
+                logits = self.output_2_act(hidden_output) + self.action_mask(sizes[:1], sizes[1:])
+                action_predict = utils.to_scalar(torch.max(logits, 1)[1])
                 pre_actions.append(action_predict)
-                if self.mode == 'train':
-                    if log_probs is not None:
-                        losses.append(log_probs[valid_action_tbl[actions.data[action_count]]])
-
-            if self.mode == 'train':
-                real_action = self.idx2action[actions.data[action_count]]
-                act_embedding = action_embeds[action_count].unsqueeze(0)
-                rel_embedding = relation_embeds[action_count].unsqueeze(0)
-            elif self.mode == 'predict':
-                real_action = self.idx2action[action_predict]
-                action_predict_tensor = utils.varible(torch.from_numpy(np.array([action_predict])), self.gpu_triger)
-                action_embeds = self.dropout_e(self.action_embeds(action_predict_tensor))
-                relation_embeds = self.dropout_e(self.relation_embeds(action_predict_tensor))
-                act_embedding = action_embeds[0].unsqueeze(0)
-                rel_embedding = relation_embeds[0].unsqueeze(0)
-
-            if real_action == self.idx2action[action_predict]:
-                right += 1
-            action.push(act_embedding,(act_embedding, real_action))
-            if real_action.startswith('S'):
-                assert len(buffer) > 0
-                tok_buffer_embedding, buffer_token = buffer.pop()
-                stack.push(tok_buffer_embedding, (tok_buffer_embedding, buffer_token))
-            elif real_action.startswith('O'):
-                assert len(buffer) > 0
-                tok_buffer_embedding, buffer_token = buffer.pop()
-                output.push(tok_buffer_embedding, (tok_buffer_embedding, buffer_token))
-            elif real_action.startswith('R'):
-                ent =''
-                entity = []
-                assert len(stack) > 0
-                while len(stack) > 0:
-                    tok_stack_embedding, stack_token = stack.pop()
-                    entity.append([tok_stack_embedding, stack_token])
-                if len(entity) > 1:
-
-                    for i in range(len(entity)):
-                        ent_f.push(entity[i][0], (entity[i][0],entity[i][1]))
-                        ent_b.push(entity[len(entity)-i-1][0], (entity[len(entity)-i-1][0], entity[len(entity)-i-1][1]))
-                        ent += entity[i][1]
-                        ent += ' '
-                    entity_input = self.dropout(torch.cat([ent_f.embedding(), ent_b.embedding()], 1))
-                else:
-                    ent_f.push(entity[0][0], (entity[0][0], entity[0][1]))
-                    ent_b.push(entity[0][0], (entity[0][0], entity[0][1]))
-                    ent = entity[0][1]
-                    entity_input = self.dropout(torch.cat([ent_f.embedding(), ent_b.embedding()], 1))
-                ent_f.clear()
-                ent_b.clear()
-                output_input = self.entity_2_output(torch.cat([entity_input, rel_embedding], 1))
-                output.push(output_input, (entity_input, ent))
-            action_count += 1
-
-        if len(losses) > 0:
-            loss = -torch.sum(torch.cat(losses))
-        else:
-            loss = -1
-
-        return loss, pre_actions, right if len(losses) > 0 else None
-
-    def forward_batch(self, sentences, actions=None, hidden=None):
-
-        self.set_batch_seq_size(sentences) #sentences [batch_size, max_len]
-        word_embeds = self.dropout_e(self.word_embeds(sentences)) #[batch_size, max_len, embeddind_size]
-        if self.mode == 'train':
-            action_embeds = self.dropout_e(self.action_embeds(actions))
-            relation_embeds = self.dropout_e(self.relation_embeds(actions))
-            action_output, _ = self.ac_lstm(action_embeds.transpose(0, 1))
-            action_output = action_output.transpose(0, 1)
-
-        lstm_initial = (utils.xavier_init(self.gpu_triger, 1, self.hidden_dim), utils.xavier_init(self.gpu_triger, 1, self.hidden_dim))
-        buffer = [[] for i in range(self.batch_size)]
-        losses = [[] for i in range(self.batch_size)]
-        right = [0 for i in range(self.batch_size)]
-        predict_actions = [[] for i in range(self.batch_size)]
-        stack = [StackRNN(self.stack_lstm, lstm_initial, self.dropout, self._rnn_get_output, self.empty_emb) for i in range(self.batch_size)]
-        output = [StackRNN(self.output_lstm, lstm_initial, self.dropout, self._rnn_get_output, self.empty_emb) for i in range(self.batch_size)]
-        ent_f = [StackRNN(self.entity_forward_lstm, lstm_initial, self.dropout, self._rnn_get_output, self.empty_emb) for i in range(self.batch_size)]
-        ent_b = [StackRNN(self.entity_backward_lstm, lstm_initial, self.dropout, self._rnn_get_output, self.empty_emb) for i in range(self.batch_size)]
-        if self.mode == 'predict':
-            action = [StackRNN(self.action_lstm, lstm_initial, self.dropout, self._rnn_get_output, self.empty_emb) for i in range(self.batch_size)]
-        sentence_array = sentences.data.cpu().numpy()
-        sents_len = []
-        token_embedds = None
-        for sent_idx in range(len(sentence_array)):
-            count_words = 0
-            token_embedding = None
-            for word_idx in reversed(range(len(sentence_array[sent_idx]))):
-                if self.use_spelling:
-                    if sentence_array[sent_idx][word_idx] == 1 :
-                        tok_rep = torch.cat([word_embeds[sent_idx][word_idx].unsqueeze(0), self.pad_char_embeds], 1)
-                    elif sentence_array[sent_idx][word_idx] == 0 :
-                        count_words += 1
-                        tok_rep = torch.cat([word_embeds[sent_idx][word_idx].unsqueeze(0), self.unk_char_embeds], 1)
-                    else:
-                        count_words += 1
-                        word = sentence_array[sent_idx][word_idx]
-                        chars_in_word = [self.char2idx[char] for char in self.idx2word[word]]
-                        chars_Tensor = utils.varible(torch.from_numpy(np.array(chars_in_word)), self.gpu_triger)
-                        chars_embeds = self.dropout_e(self.char_embeds(chars_Tensor))
-                        if self.char_structure == 'lstm':
-                            char_o, hidden = self.char_bi_lstm(chars_embeds.unsqueeze(1), hidden)
-                            char_out = torch.chunk(hidden[0].squeeze(1), 2, 0)
-                            tok_rep = torch.cat([word_embeds[sent_idx][word_idx].unsqueeze(0), char_out[0], char_out[1]], 1)
-                        elif self.char_structure == 'cnn':
-                            char = chars_embeds.unsqueeze(0)
-                            char = char.transpose(1, 2)
-                            char, _ = self.conv1d(char).max(dim=2)
-                            char = torch.tanh(char)
-                            tok_rep = torch.cat([word_embeds[sent_idx][word_idx].unsqueeze(0), char], 1)
-                else:
-                    if sentence_array[sent_idx][word_idx] != 1:
-                        count_words += 1
-                    tok_rep = word_embeds[sent_idx][word_idx].unsqueeze(0)
-                if token_embedding is None:
-                    token_embedding = tok_rep
-                else:
-                    token_embedding = torch.cat([token_embedding, tok_rep], 0)
-
-            sents_len.append(count_words)
-            if token_embedds is None:
-                token_embedds = token_embedding.unsqueeze(0)
-            else:
-                token_embedds = torch.cat([token_embedds, token_embedding.unsqueeze(0)], 0)
-
-        tokens = token_embedds.transpose(0, 1)
-        tok_output, hidden = self.lstm(tokens)  #[max_len, batch_size, hidden_dim]
-        tok_output = tok_output.transpose(0, 1)
-
-        for idx in range(tok_output.size(0)):
-            emd_idx =sents_len[idx]-1
-            buffer[idx].append([self.init_buffer])
-            for word_idx in range(tok_output.size(1)-sents_len[idx], tok_output.size(1)):
-                buffer[idx].append([tok_output[idx][word_idx].unsqueeze(0), token_embedds[idx][word_idx].unsqueeze(0), self.idx2word[sentence_array[idx][emd_idx]]])
-                emd_idx -= 1
-
-        for batch_idx in range(self.batch_size):
-
-            action_count = 0
-            while len(buffer[batch_idx]) > 1 or len(stack[batch_idx]) > 0:
-                valid_actions = self.get_possible_actions(stack[batch_idx], buffer[batch_idx])
-                log_probs = None
-                if len(valid_actions) > 1:
-                    if self.mode == 'train':
-                        if action_count == 0:
-                            lstms_output = torch.cat(
-                                [buffer[batch_idx][-1][0], stack[batch_idx].embedding(), output[batch_idx].embedding(),
-                                 lstm_initial[0]], 1)
-                        else:
-                            lstms_output = torch.cat(
-                                [buffer[batch_idx][-1][0], stack[batch_idx].embedding(), output[batch_idx].embedding(),
-                                 action_output[batch_idx][action_count-1].unsqueeze(0)], 1)
-                    elif self.mode == 'predict':
-                        lstms_output = torch.cat(
-                            [buffer[batch_idx][-1][0], stack[batch_idx].embedding(), output[batch_idx].embedding(),
-                             action[batch_idx].embedding(),], 1)
-
-                    hidden_output = torch.tanh(self.lstms_output_2_softmax(self.dropout(lstms_output)))
-                    if self.gpu_triger is True:
-                        logits = self.output_2_act(hidden_output)[0][
-                            torch.autograd.Variable(torch.LongTensor(valid_actions)).cuda()]
-                    else:
-                        logits = self.output_2_act(hidden_output)[0][
-                            torch.autograd.Variable(torch.LongTensor(valid_actions))]
-                    valid_action_tbl = {a: i for i, a in enumerate(valid_actions)}
-                    log_probs = torch.nn.functional.log_softmax(logits)
-                    action_idx = torch.max(log_probs.cpu(), 0)[1][0].data.numpy()[0]
-                    action_predict = valid_actions[action_idx]
-                    predict_actions[batch_idx].append(action_predict)
-                    if self.mode == 'train':
-                        if log_probs is not None:
-                            losses[batch_idx].append(log_probs[valid_action_tbl[actions.data[batch_idx][action_count]]])
 
                 if self.mode == 'train':
-                    real_action = self.idx2action[actions.data[batch_idx][action_count]]
-                    rel_embedding = relation_embeds[batch_idx][action_count].unsqueeze(0)
+                    step_logits.append(logits)
+                    real_action = self.idx2action[utils.to_scalar(actions.data[action_count])]
+                    act_embedding = action_embeds[action_count].unsqueeze(0)
+                    rel_embedding = relation_embeds[action_count].unsqueeze(0)
                 elif self.mode == 'predict':
                     real_action = self.idx2action[action_predict]
-                    action_predict_tensor = utils.varible(torch.from_numpy(np.array([action_predict])), self.gpu_triger)
+                    action_predict_tensor = utils.varible(torch.LongTensor([action_predict]), self.gpu_triger)
                     action_embeds = self.dropout_e(self.action_embeds(action_predict_tensor))
                     relation_embeds = self.dropout_e(self.relation_embeds(action_predict_tensor))
                     act_embedding = action_embeds[0].unsqueeze(0)
                     rel_embedding = relation_embeds[0].unsqueeze(0)
-                    action[batch_idx].push(act_embedding, (act_embedding, real_action))
 
                 if real_action == self.idx2action[action_predict]:
-                    right[batch_idx] += 1
+                    right += 1
+                action.push(act_embedding,(act_embedding, real_action))
                 if real_action.startswith('S'):
-                    assert len(buffer[batch_idx]) > 0
-                    _, tok_buffer_embedding, buffer_token = buffer[batch_idx].pop()
-                    stack[batch_idx].push(tok_buffer_embedding, (tok_buffer_embedding, buffer_token))
+                    assert len(buffer) > 0
+                    tok_buffer_embedding, buffer_token = buffer.pop()
+                    stack.push(tok_buffer_embedding, (tok_buffer_embedding, buffer_token))
                 elif real_action.startswith('O'):
-                    assert len(buffer[batch_idx]) > 0
-                    _, tok_buffer_embedding, buffer_token = buffer[batch_idx].pop()
-                    output[batch_idx].push(tok_buffer_embedding, (tok_buffer_embedding, buffer_token))
+                    assert len(buffer) > 0
+                    tok_buffer_embedding, buffer_token = buffer.pop()
+                    output.push(tok_buffer_embedding, (tok_buffer_embedding, buffer_token))
                 elif real_action.startswith('R'):
-                    ent = ''
+                    ent =''
                     entity = []
-                    assert len(stack[batch_idx]) > 0
-                    while len(stack[batch_idx]) > 0:
-                        tok_stack_embedding, stack_token = stack[batch_idx].pop()
+                    assert len(stack) > 0
+                    while len(stack) > 0:
+                        tok_stack_embedding, stack_token = stack.pop()
                         entity.append([tok_stack_embedding, stack_token])
                     if len(entity) > 1:
 
                         for i in range(len(entity)):
-                            ent_f[batch_idx].push(entity[i][0], (entity[i][0], entity[i][1]))
-                            ent_b[batch_idx].push(entity[len(entity) - i - 1][0],
-                                       (entity[len(entity) - i - 1][0], entity[len(entity) - i - 1][1]))
+                            ent_f.push(entity[i][0], (entity[i][0],entity[i][1]))
+                            ent_b.push(entity[len(entity)-i-1][0], (entity[len(entity)-i-1][0], entity[len(entity)-i-1][1]))
                             ent += entity[i][1]
                             ent += ' '
-                        entity_input = self.dropout(torch.cat([ent_b[batch_idx].embedding(), ent_f[batch_idx].embedding()], 1))
+                        entity_input = self.dropout(torch.cat([ent_f.embedding(), ent_b.embedding()], 1))
                     else:
-                        ent_f[batch_idx].push(entity[0][0], (entity[0][0], entity[0][1]))
-                        ent_b[batch_idx].push(entity[0][0], (entity[0][0], entity[0][1]))
+                        ent_f.push(entity[0][0], (entity[0][0], entity[0][1]))
+                        ent_b.push(entity[0][0], (entity[0][0], entity[0][1]))
                         ent = entity[0][1]
-                        entity_input = self.dropout(torch.cat([ent_f[batch_idx].embedding(), ent_b[batch_idx].embedding()], 1))
-                    ent_f[batch_idx].clear()
-                    ent_b[batch_idx].clear()
+                        entity_input = self.dropout(torch.cat([ent_f.embedding(), ent_b.embedding()], 1))
+                    ent_f.clear()
+                    ent_b.clear()
                     output_input = self.entity_2_output(torch.cat([entity_input, rel_embedding], 1))
-                    output[batch_idx].push(output_input, (entity_input, ent))
+                    output.push(output_input, (entity_input, ent))
+                    self.profiler.count('reduces')
+                    self.profiler.count('pushes', 2 * len(entity))
                 action_count += 1
+        self.profiler.count('steps', action_count)
+        self.profiler.count('pushes', action_count)
 
-        loss = 0
-        for idx in range(self.batch_size):
-            loss += -torch.sum(torch.cat(losses[idx]))
+        if self.mode == 'train':
+            with self.profiler.timer('loss'):
+                loss = torch.nn.functional.cross_entropy(torch.cat(step_logits, 0), actions[:action_count], reduction='sum')
+            return loss, pre_actions, right
+
+        return -1, pre_actions, None
+
+    def forward_batch(self, sentences, actions=None, hidden=None):
 
-        return loss, predict_actions, right if len(losses) > 0 else None
+        self.set_batch_seq_size(sentences) #sentences [batch_size, max_len]
+        action_output = None
+        if self.mode != 'train':
+            actions = None
+        if actions is not None:
+            with self.profiler.timer('action_lstm'):
+                action_embeds = self.dropout_e(self.action_embeds(actions))
+                action_output, _ = self.ac_lstm(action_embeds.transpose(0, 1))
+                action_output = action_output.transpose(0, 1)
+        token_embedds, tok_output, sents_len, lstm_initial = self.encode_buffer(sentences)
+
+        return self.transition_batch(token_embedds, tok_output, sents_len, lstm_initial, actions, action_output)
+
+    def encode_buffer(self, sentences):
+        """
+        token representations of a padded batch and the buffer lstm run over them
+
+        the buffer is read from the end of the sentence, so both are returned with each sentence
+        reversed within its own length (padding last): word k of sentence b sits at position
+        sents_len[b]-1-k, and the buffer lstm reaches every word before any padding
+        """
+        token_embedds = self.token_representation(sentences, pad_word=self.eof_idx) #[batch_size, max_len, tok_embedding_dim]
+        lstm_initial = self.initial_state()
+        sents_len = (sentences.data != self.eof_idx).long().sum(1)
+        token_embedds = utils.reverse_padded(token_embedds, sents_len)
+        with self.profiler.timer('buffer_lstm'):
+            tok_output, _ = self.lstm(token_embedds.transpose(0, 1))  #[max_len, batch_size, hidden_dim]
+        if self.profiler.enabled:
+            self.profiler.count('sentences', sentences.size(0))
+            self.profiler.count('tokens', sents_len.sum())
+            self.profiler.count('padded_tokens', sentences.numel())
+        return token_embedds, tok_output.transpose(0, 1), sents_len, lstm_initial
+
+    def transition_batch(self, token_embedds, tok_output, sents_len, lstm_initial, actions=None, action_output=None):
+        """
+        run the transition system for every sentence of the batch in lockstep
+
+        every step scores all unfinished sentences at once and applies the pushes of each action
+        type with a single cell call. Given the gold actions (and their ac_lstm output) the system
+        follows them and the loss is returned, otherwise it decodes greedily (with FusedCells if
+        enable_fused_cells was called and the model is in eval mode)
+        """
+        batch_size, seq_len = tok_output.size(0), tok_output.size(1)
+        stack = BatchStackRNN(self.stack_lstm, lstm_initial, self._rnn_get_output, self.empty_emb, batch_size, seq_len)
+        output = BatchStackRNN(self.output_lstm, lstm_initial, self._rnn_get_output, self.empty_emb, batch_size, seq_len)
+        # the entity lstms are never reset inside a sentence, each entity starts from the state the previous one left
+        ent_f = BatchStackRNN(self.entity_forward_lstm, lstm_initial, self._rnn_get_output, None, batch_size, seq_len)
+        ent_b = BatchStackRNN(self.entity_backward_lstm, lstm_initial, self._rnn_get_output, None, batch_size, seq_len)
+        cells = None
+        if self.fused_cells and actions is None and not self.training:
+            cells = FusedCells(self, stack, output, ent_f, ent_b, tok_output, token_embedds.size(2), lstm_initial)
+        elif actions is None:
+            ac_h = utils.init_varaible_zero(self.gpu_triger, self.rnn_layers, batch_size, self.hidden_dim)
+            ac_c = utils.init_varaible_zero(self.gpu_triger, self.rnn_layers, batch_size, self.hidden_dim)
+            act_h = lstm_initial[0].expand(batch_size, self.hidden_dim)
+
+        buffer_pos = torch.zeros_like(sents_len)
+        rows = utils.varible(torch.arange(batch_size).long(), self.gpu_triger)
+        right = torch.zeros_like(sents_len)
+        step_predicts = []
+        step_logits = []
+        step_targets = []
+
+        active = rows[sents_len > 0]
+        step = 0
+        with self.profiler.timer('transition'), torch.set_grad_enabled(torch.is_grad_enabled() and cells is None):
+            while active.size(0) > 0:
+                if cells is not None:
+                    logits = cells.score(active, sents_len, buffer_pos)
+                else:
+                    if step == 0:
+                        act_emb = lstm_initial[0].expand(active.size(0), self.hidden_dim)
+                    elif actions is not None:
+                        act_emb = action_output[active, step - 1]
+                    else:
+                        act_emb = act_h[active]
+                    logits = self._score_actions(active, tok_output, sents_len, buffer_pos, stack, output, act_emb)
+                action_predict = torch.max(logits, 1)[1]
+
+                if actions is not None:
+                    real_action = actions[active, step]
+                    step_logits.append(logits)
+                    step_targets.append(real_action)
+                else:
+                    real_action = action_predict
+                    if cells is None:
+                        ac_h, ac_c, act_h = self._push_action(active, real_action, ac_h, ac_c, act_h)
+
+                step_predict = rows.new(batch_size).fill_(-1)
+                step_predict[active] = action_predict
+                step_predicts.append(step_predict)
+                right[active] += (real_action == action_predict).long()
+
+                self._apply_actions(active, real_action, token_embedds, sents_len, buffer_pos, stack, output, ent_f, ent_b, cells)
+                self.profiler.count('steps', active.size(0))
+
+                active = transition.unfinished(active, sents_len, buffer_pos, stack.size(active))
+                step += 1
+        self.profiler.count('batch_steps', step)
+
+        predict_actions = [[a for a in row if a >= 0] for row in torch.stack(step_predicts, 1).tolist()] if step > 0 else [[] for _ in range(batch_size)]
+        if len(step_logits) > 0:
+            with self.profiler.timer('loss'):
+                loss = torch.nn.functional.cross_entropy(torch.cat(step_logits, 0), torch.cat(step_targets, 0), reduction='sum')
+        else:
+            loss = -1
+
+        return loss, predict_actions, right.tolist()
+
+    def beam_search(self, sentences, beam_size):
+        """
+        beam-search decoding of a padded batch, returns the best action sequence of every sentence
+
+        each sentence keeps beam_size hypothesis slots; one scoring call per step covers the slots
+        of all sentences and one topk per sentence picks the next ones. Hypotheses forked from the
+        same parent share its stack / output / entity states through BeamStackRNN, so reordering
+        the beam only moves pointers. A finished hypothesis competes with its score frozen.
+        """
+        with torch.no_grad():
+            token_embedds, tok_output, sents_len, lstm_initial = self.encode_buffer(sentences)
+            batch_size, seq_len = tok_output.size(0), tok_output.size(1)
+            n_slots = batch_size * beam_size
+            slot_sent = utils.varible(torch.arange(batch_size).long().unsqueeze(1).expand(batch_size, beam_size).contiguous().view(-1), self.gpu_triger)
+            token_embedds = token_embedds[slot_sent]
+            tok_output = tok_output[slot_sent]
+            sents_len = sents_len[slot_sent]
+
+            stack = BeamStackRNN(self.stack_lstm, lstm_initial, self._rnn_get_output, self.empty_emb, n_slots, n_slots * seq_len)
+            output = BeamStackRNN(self.output_lstm, lstm_initial, self._rnn_get_output, self.empty_emb, n_slots, n_slots * seq_len)
+            ent_f = BeamStackRNN(self.entity_forward_lstm, lstm_initial, self._rnn_get_output, None, n_slots, n_slots * seq_len)
+            ent_b = BeamStackRNN(self.entity_backward_lstm, lstm_initial, self._rnn_get_output, None, n_slots, n_slots * seq_len)
+            ac_h = utils.init_varaible_zero(self.gpu_triger, self.rnn_layers, n_slots, self.hidden_dim)
+            ac_c = utils.init_varaible_zero(self.gpu_triger, self.rnn_layers, n_slots, self.hidden_dim)
+            act_h = lstm_initial[0].expand(n_slots, self.hidden_dim)
+
+            rows = utils.varible(torch.arange(n_slots).long(), self.gpu_triger)
+            buffer_pos = torch.zeros_like(sents_len)
+            score = lstm_initial[0].data.new(batch_size, beam_size).fill_(float('-inf'))
+            score[:, 0] = 0
+            score = score.view(-1)
+            action_size = self.output_2_act.out_features
+            # column action_size of the candidates keeps a finished hypothesis as it is
+            stay = action_size
+            sent_offset = rows[::beam_size].unsqueeze(1)
+            parents = []
+            chosen = []
+
+            step = 0
+            while True:
+                finished = (buffer_pos >= sents_len) & (stack.size(rows) == 0)
+                live = (score > float('-inf')) & ~finished
+                if not live.any():
+                    break
+                act_emb = lstm_initial[0].expand(n_slots, self.hidden_dim) if step == 0 else act_h
+                logits = self._score_actions(rows, tok_output, sents_len, buffer_pos, stack, output, act_emb)
+                candidates = score.unsqueeze(1) + torch.nn.functional.log_softmax(logits, 1)
+                candidates = candidates.masked_fill(~live.unsqueeze(1), float('-inf'))
+                kept = score.masked_fill(live, float('-inf')).unsqueeze(1)
+                candidates = torch.cat([candidates, kept], 1).view(batch_size, beam_size * (action_size + 1))
+                top_score, top_idx = candidates.topk(beam_size, 1)
+                parent = (top_idx // (action_size + 1) + sent_offset).view(-1)
+                action = (top_idx % (action_size + 1)).view(-1)
+                score = top_score.view(-1)
+                parents.append(parent)
+                chosen.append(action)
+
+                for rnn in (stack, output, ent_f, ent_b):
+                    rnn.reorder(parent)
+                buffer_pos = buffer_pos[parent]
+                ac_h, ac_c, act_h = ac_h[:, parent], ac_c[:, parent], act_h[parent]
+
+                expand = rows[(score > float('-inf')) & (action != stay)]
+                if expand.size(0) > 0:
+                    ac_h, ac_c, act_h = self._push_action(expand, action[expand], ac_h, ac_c, act_h)
+                    self._apply_actions(expand, action[expand], token_embedds, sents_len, buffer_pos, stack, output, ent_f, ent_b)
+                    self.profiler.count('steps', expand.size(0))
+                step += 1
+            self.profiler.count('batch_steps', step)
+
+            best = rows[::beam_size]
+            sequence = []
+            for parent, action in zip(reversed(parents), reversed(chosen)):
+                sequence.append(action[best])
+                best = parent[best]
+            if len(sequence) == 0:
+                return [[] for _ in range(batch_size)]
+            sequence = torch.stack(sequence[::-1], 1).tolist()
+            return [[a for a in row if a != stay] for row in sequence]
+
+    def _score_actions(self, rows, tok_output, sents_len, buffer_pos, stack, output, act_emb):
+        with self.profiler.timer('transition/score'):
+            buffer_size, buffer_emb = transition.buffer_front(tok_output, self.init_buffer, sents_len, buffer_pos, rows)
+            lstms_output = torch.cat([buffer_emb, stack.embedding(rows), output.embedding(rows), act_emb], 1)
+            hidden_output = torch.tanh(self.lstms_output_2_softmax(self.dropout(lstms_output)))
+            return self.output_2_act(hidden_output) + self.action_mask(stack.size(rows), buffer_size)
+
+    def _push_action(self, rows, action, ac_h, ac_c, act_h):
+        with self.profiler.timer('transition/action_lstm'):
+            act_input = self.dropout_e(self.action_embeds(action)).unsqueeze(0)
+            act_out, (new_h, new_c) = self.ac_lstm(act_input, (ac_h[:, rows], ac_c[:, rows]))
+            return ac_h.index_copy(1, rows, new_h), ac_c.index_copy(1, rows, new_c), act_h.index_copy(0, rows, act_out[0])
+
+    def _apply_actions(self, rows, real_action, token_embedds, sents_len, buffer_pos, stack, output, ent_f, ent_b, cells=None):
+        """
+        SHIFT moves the front of the buffer onto the stack, OUT onto the output, and REDUCE composes
+        the whole stack into an entity pushed onto the output; buffer_pos is updated in place
+
+        the cells are stepped one lstm at a time, or by cells (a FusedCells) with the action lstm included
+        """
+        shift_rows, out_rows, reduce_rows, is_reduce = transition.split_actions(rows, real_action, self.shift_idx, self.out_idx)
+        shift_input = transition.pop_buffer(token_embedds, sents_len, buffer_pos, shift_rows)
+        output_inputs = [transition.pop_buffer(token_embedds, sents_len, buffer_pos, out_rows)]
+
+        if reduce_rows.size(0) > 0:
+            with self.profiler.timer('transition/entity'):
+                entity_len = stack.size(reduce_rows)
+                for j in range(int(entity_len.max())):
+                    sub_rows, f_input, b_input = transition.entity_words(token_embedds, sents_len, buffer_pos, reduce_rows, entity_len, j)
+                    if cells is None:
+                        ent_f.push(sub_rows, f_input)
+                        ent_b.push(sub_rows, b_input)
+                    else:
+                        cells.push_entity(sub_rows, f_input, b_input)
+                entity_input = self.dropout(transition.compose_entity(ent_f.embedding(reduce_rows), ent_b.embedding(reduce_rows), entity_len))
+                rel_embedding = self.dropout_e(self.relation_embeds(real_action[is_reduce]))
+                output_inputs.append(self.entity_2_output(torch.cat([entity_input, rel_embedding], 1)))
+                stack.clear(reduce_rows)
+            if self.profiler.enabled:
+                self.profiler.count('reduces', reduce_rows.size(0))
+                self.profiler.count('pushes', 2 * entity_len.sum())
+
+        output_rows = torch.cat([out_rows, reduce_rows])
+        if cells is not None:
+            cells.push(rows, real_action, shift_rows, shift_input, output_rows, torch.cat(output_inputs, 0))
+        else:
+            if shift_rows.size(0) > 0:
+                with self.profiler.timer('transition/stack'):
+                    stack.push(shift_rows, shift_input)
+            if output_rows.size(0) > 0:
+                with self.profiler.timer('transition/output'):
+                    output.push(output_rows, torch.cat(output_inputs, 0))
+        if self.profiler.enabled:
+            self.profiler.count('pushes', rows.size(0))
+
+    def action_mask(self, stack_size, buffer_size):
+        """
+        additive mask over the output_2_act scores of each row: 0 for the actions its stack and buffer sizes allow, -inf otherwise
+        """
+        if self.action_mask_table is None or self.action_mask_table.device != stack_size.device:
+            # row 2 * (buffer not empty) + (stack not empty)
+            table = torch.FloatTensor(4, self.output_2_act.out_features).fill_(float('-inf'))
+            table[2:, self.shift_idx] = 0
+            table[0::2, self.out_idx] = 0
+            for reduce_idx in self.reduce_idx:
+                table[1::2, reduce_idx] = 0
+            self.action_mask_table = table.to(stack_size.device)
+        return self.action_mask_table[2 * (buffer_size > 0).long() + (stack_size > 0).long()]
@@ -0,0 +1,80 @@
+import json
+import os
+
+import torch
+
+from model.bundle import ALIGNMENT, load_bundle, prune_vocabulary, save_bundle
+from model.predictor import Predictor
+import model.utils as utils
+
+
+def write_bundle(workload, ner_model, path, spelling=True, keep_words=None):
+    work = workload
+    return save_bundle(path, ner_model, dict(vars(work.args), layers=1), spelling, work.f_map, work.l_map, work.a_map, work.ner_map,
+                       work.char_map, keep_words)
+
+
+def decode(ner_model, f_map, sentences):
+    features = utils.encode_safe_predict(sentences, f_map, f_map['<unk>'])
+    with torch.no_grad():
+        return ner_model.forward_batch(utils.PadCollate(f_map['<eof>'])([torch.LongTensor(f) for f in features]))[1]
+
+
+def test_prune_vocabulary():
+    f_map = {'<unk>': 0, 'a': 1, 'b': 2, 'c': 3, 'd': 4, '<eof>': 5}
+    word_count = {'a': 5, 'b': 1, 'c': 3, 'e': 9}
+    assert prune_vocabulary(f_map, word_count, 2) == {'a', 'c', '<unk>', '<eof>'}
+    assert prune_vocabulary(f_map, word_count, 1, max_words=1) == {'a', '<unk>', '<eof>'}
+
+
+def test_bundle_round_trip(workload, trained_model, tmp_path):
+    path = str(tmp_path / 'bundle')
+    assert write_bundle(workload, trained_model, path) == len(workload.f_map)
+    with open(os.path.join(path, 'config.json')) as f:
+        assert all(meta['offset'] % ALIGNMENT == 0 for meta in json.load(f)['tensors'].values())
+
+    loaded, maps = load_bundle(path)
+    assert maps['f_map'] == workload.f_map and maps['a_map'] == workload.a_map and maps['char_map'] == workload.char_map
+    assert not loaded.training
+    state = trained_model.state_dict()
+    assert sorted(loaded.state_dict()) == sorted(state)
+    for name, tensor in loaded.state_dict().items():
+        assert torch.equal(tensor, state[name]), name
+    for start in range(0, len(workload.features), 16):
+        batch = workload.features[start:start + 16]
+        assert decode(loaded, maps['f_map'], batch) == decode(trained_model, workload.f_map, batch)
+
+
+def test_bundle_weights_view_the_mapped_file(workload, trained_model, tmp_path):
+    path = str(tmp_path / 'bundle')
+    write_bundle(workload, trained_model, path)
+    with open(os.path.join(path, 'config.json')) as f:
+        tensors = json.load(f)['tensors']
+    loaded = load_bundle(path)[0]
+    state = loaded.state_dict()
+    # every tensor sits at its offset of weights.bin from the same mapped base address
+    base = state['word_embeds.weight'].data_ptr() - tensors['word_embeds.weight']['offset']
+    assert all(state[name].data_ptr() - base == meta['offset'] for name, meta in tensors.items())
+
+
+def test_pruned_bundle(workload, trained_model, tmp_path):
+    word_count = dict()
+    utils.generate_corpus(workload.conll_lines, word_count)
+    word_count = {word.lower(): count for word, count in word_count.items()}
+    keep_words = prune_vocabulary(workload.f_map, word_count, min_count=2)
+    path = str(tmp_path / 'bundle')
+    assert write_bundle(workload, trained_model, path, keep_words=keep_words) == len(keep_words) < len(workload.f_map)
+
+    loaded, maps = load_bundle(path)
+    assert set(maps['f_map']) == keep_words
+    assert sorted(maps['f_map'].values()) == list(range(len(keep_words)))
+    # the kept rows in the original order
+    kept = sorted(keep_words, key=lambda word: workload.f_map[word])
+    assert [maps['f_map'][word] for word in kept] == list(range(len(kept)))
+    assert torch.equal(loaded.word_embeds.weight.data, trained_model.word_embeds.weight.data[[workload.f_map[word] for word in kept]])
+
+    # a pruned word decodes as <unk> did in the full model
+    sentences = [['<unk>' if word.lower() not in keep_words else word for word in sentence] for sentence in workload.features[:32]]
+    expected = decode(trained_model, workload.f_map, sentences)
+    assert decode(loaded, maps['f_map'], workload.features[:32]) == expected
+    assert Predictor(None, None, bundle=path).predict_actions(workload.features[:32]) == expected
@@ -0,0 +1,49 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# every process reports (its random draw, the gradients it steps with) to rank 0, which prints them
+SCRIPT = '''
+import json, sys
+import torch
+import torch.distributed as dist
+from model.data_parallel import DataParallel
+
+torch.manual_seed(0)
+dp = DataParallel(3, int(sys.argv[1]))
+draw = torch.rand(4).tolist()
+used, zero_grad, unused = torch.nn.Parameter(torch.ones(3)), torch.nn.Parameter(torch.ones(2)), torch.nn.Parameter(torch.ones(2))
+if dp.rank == 0:
+    ((used * 2).sum() + (zero_grad * 0).sum()).backward()
+elif dp.rank == 1:
+    (used * used).sum().backward()
+loss = dp.all_reduce([used, zero_grad, unused], dp.rank + 0.5)
+grads = [None if p.grad is None else p.grad.tolist() for p in (used, zero_grad, unused)]
+reports = [None] * 3
+dist.all_gather_object(reports, {'draw': draw, 'loss': loss, 'grads': grads})
+if dp.rank == 0:
+    print(json.dumps(reports))
+dp.close()
+'''
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_processes_draw_apart_and_step_the_same_gradients():
+    output = subprocess.check_output([sys.executable, '-c', SCRIPT, str(free_port())], cwd=ROOT, timeout=120)
+    reports = json.loads(output.decode('utf-8').strip().split('\n')[-1])
+    assert len(reports) == 3
+    draws = [tuple(report['draw']) for report in reports]
+    assert len(set(draws)) == 3
+    for report in reports:
+        assert report['loss'] == 0.5 + 1.5 + 2.5
+        # 2 from rank 0 plus 2 * used from rank 1, zeros for a gradient only rank 0 had, none for an unused parameter
+        assert report['grads'] == [[4.0, 4.0, 4.0], [0.0, 0.0], None]
@@ -0,0 +1,88 @@
+import model.evaluate as evaluate
+
+
+class GoldDecoder(object):
+    """
+    stands in for a model that decodes the gold actions of the batches it is given, in order
+    """
+    def __init__(self, batches, action_pad, corrupt=None):
+        self.batches = iter(batches)
+        self.action_pad = action_pad
+        self.corrupt = corrupt
+
+    def eval(self):
+        pass
+
+    def forward_batch(self, feature):
+        _, _, action = next(self.batches)
+        pre_actions = [[a for a in row if a != self.action_pad] for row in action.tolist()]
+        if self.corrupt is not None:
+            pre_actions = [self.corrupt(row) for row in pre_actions]
+        return -1, pre_actions, None
+
+
+def test_get_entities(workload):
+    a_map = workload.a_map
+    idx2action = {v: k for k, v in a_map.items()}
+    actions = ['SHIFT', 'SHIFT', 'REDUCE-PER', 'OUT', 'SHIFT', 'REDUCE-LOC', 'OUT']
+    assert evaluate.get_entities([a_map[a] for a in actions], idx2action) == [(0, 2, 'PER'), (3, 4, 'LOC')]
+    gold = [a_map[a] for a in actions]
+    predicted = [a_map[a] for a in ['SHIFT', 'SHIFT', 'REDUCE-PER', 'OUT', 'OUT', 'OUT']]
+    assert evaluate.to_entity(gold, predicted, idx2action) == (2, 1, 1)
+
+
+def test_f1_of_the_gold_actions(workload):
+    pad = workload.a_map['<pad>']
+    f1, pre, rec, acc = evaluate.calc_f1_score(GoldDecoder(workload.batches(), pad), [workload.batches()], workload.a_map, False)
+    assert (f1, pre, rec, acc) == (1, 1, 1, 1)
+    out = workload.a_map['OUT']
+    all_out = GoldDecoder(workload.batches(), pad, lambda row: [out] * sum(1 for a in row if a in (out, workload.a_map['SHIFT'])))
+    f1, pre, rec, acc = evaluate.calc_f1_score(all_out, [workload.batches()], workload.a_map, False)
+    assert (f1, pre, rec) == (0, 0, 0) and 0 < acc < 1
+
+
+def test_accuracy_counts_the_gold_actions(workload):
+    """
+    the padding of the gold rows is neither matched nor counted
+    """
+    pad = workload.a_map['<pad>']
+    lengths = [n for _, _, action in workload.batches() for n in (action != pad).sum(1).tolist()]
+    # predictions one action short of the gold ones
+    truncated = GoldDecoder(workload.batches(), pad, lambda row: row[:-1])
+    acc = evaluate.calc_f1_score(truncated, [workload.batches()], workload.a_map, False)[3]
+    assert acc == sum(n - 1 for n in lengths) / float(sum(lengths))
+
+
+def test_f1_of_greedy_decoding(workload, trained_model):
+    """
+    scored on each sentence's own greedy decoding, not on the gold history
+    """
+    idx2action = {v: k for k, v in workload.a_map.items()}
+    n_gold = n_predicted = n_correct = 0
+    for feature, _, action in workload.batches():
+        for row in range(feature.size(0)):
+            words = feature[row][feature[row] != workload.f_map['<eof>']]
+            pre_action = evaluate.decode_batch(trained_model, words.unsqueeze(0), False)[0]
+            gold, predicted, correct = evaluate.to_entity(action[row].tolist(), pre_action, idx2action)
+            n_gold, n_predicted, n_correct = n_gold + gold, n_predicted + predicted, n_correct + correct
+    f1, pre, rec, _ = evaluate.calc_f1_score(trained_model, [workload.batches()], workload.a_map, False)
+    assert n_correct > 0
+    assert pre == n_correct / float(n_predicted) and rec == n_correct / float(n_gold)
+    assert abs(f1 - 2 * pre * rec / (pre + rec)) < 1e-12
+    assert not trained_model.training
+
+
+def test_accuracy_following_the_gold_actions(workload, trained_model):
+    pad = workload.a_map['<pad>']
+    trained_model.mode = 'train'
+    try:
+        acc = evaluate.calc_score(trained_model, [workload.batches()], False)
+        correct = total = 0
+        for feature, _, action in workload.batches():
+            right = trained_model.forward_batch(feature, action)[2]
+            correct += sum(right)
+            total += int((action != pad).sum())
+    finally:
+        trained_model.mode = 'predict'
+    assert 0 < acc < 1
+    assert acc == correct / float(total)
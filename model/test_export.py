@@ -0,0 +1,105 @@
+import json
+import os
+import subprocess
+import sys
+from typing import Tuple
+
+import pytest
+import torch
+
+import model.evaluate as evaluate
+from model.export import ScriptedDecoder, export_decoder
+from model.test_paged_embedding import frozen_sentences, paged, paged_model
+import model.transition as transition
+import model.utils as utils
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='module')
+def scripted(trained_model):
+    return torch.jit.script(ScriptedDecoder(trained_model))
+
+
+def test_scripted_decoding_alone_and_in_a_padded_batch(workload, scripted, sentences):
+    collate = utils.PadCollate(workload.f_map['<eof>'])
+    initial = scripted.initial_state()
+    batch = sentences[:30] + [max(sentences, key=len)]
+    together = scripted(collate([torch.LongTensor(s) for s in batch]), initial)
+    for sentence, actions in zip(batch, together):
+        assert scripted(collate([torch.LongTensor(sentence)]), initial)[0] == actions
+
+
+@pytest.mark.parametrize('model_name', ['trained_model', 'word_model'])
+def test_exported_file_decodes_like_the_model(request, workload, sentences, tmp_path, model_name):
+    ner_model = request.getfixturevalue(model_name)
+    path = str(tmp_path / 'decoder.pt')
+    export_decoder(ner_model, path)
+    loaded = torch.jit.load(path)
+    collate = utils.PadCollate(workload.f_map['<eof>'])
+    idx2action = {v: k for k, v in workload.a_map.items()}
+    for start in range(0, len(sentences), 16):
+        batch = collate([torch.LongTensor(s) for s in sentences[start:start + 16]])
+        with torch.no_grad():
+            expected = ner_model.forward_batch(batch)[1]
+        assert loaded(batch, None) == expected
+        tokens = workload.features[start:start + 16]
+        features = utils.encode_safe_predict(tokens, workload.f_map, workload.f_map['<unk>'])
+        with torch.no_grad():
+            pre_actions = ner_model.forward_batch(collate([torch.LongTensor(f) for f in features]))[1]
+        assert loaded.predict(tokens) == [evaluate.get_entities(a, idx2action) for a in pre_actions]
+    assert loaded.predict([]) == []
+
+
+def test_exported_file_runs_without_the_repository(workload, trained_model, tmp_path):
+    path = str(tmp_path / 'decoder.pt')
+    expected = export_decoder(trained_model, path).predict(workload.features[:8])
+    # -I: isolated mode, neither the repository nor the working directory is importable
+    script = 'import json, sys, torch; print(json.dumps(torch.jit.load(sys.argv[1]).predict(json.loads(sys.argv[2]))))'
+    output = subprocess.check_output([sys.executable, '-I', '-c', script, path, json.dumps(workload.features[:8])], cwd=str(tmp_path))
+    assert [[tuple(entity) for entity in entities] for entities in json.loads(output.decode('utf-8'))] == expected
+
+
+def pop_next_word(token_embedds: torch.Tensor, sents_len: torch.Tensor, buffer_pos: torch.Tensor, rows: torch.Tensor) -> torch.Tensor:
+    """
+    transition.pop_buffer returning the word after the front of the buffer (the front itself when it is the last one)
+    """
+    front = token_embedds[rows, (sents_len[rows] - 2 - buffer_pos[rows]).clamp(min=0)]
+    buffer_pos[rows] = buffer_pos[rows] + 1
+    return front
+
+
+def test_exported_decoder_follows_a_change_of_the_transitions(monkeypatch, workload, trained_model, checkpoint, sentences, tmp_path):
+    collate = utils.PadCollate(workload.f_map['<eof>'])
+    batches = [collate([torch.LongTensor(s) for s in sentences[start:start + 16]]) for start in range(0, len(sentences), 16)]
+    with torch.no_grad():
+        original = [trained_model.forward_batch(batch)[1] for batch in batches]
+    monkeypatch.setattr(transition, 'pop_buffer', pop_next_word)
+    with torch.no_grad():
+        changed = [trained_model.forward_batch(batch)[1] for batch in batches]
+    assert changed != original
+    # exported in a fresh process, torch.jit reuses the ScriptedDecoder compiled earlier in this one
+    path = str(tmp_path / 'decoder.pt')
+    script = ('import sys; import model.transition as transition; from model.export import export_decoder; '
+              'from model.predictor import Predictor; from model.test_export import pop_next_word; '
+              'transition.pop_buffer = pop_next_word; export_decoder(Predictor(sys.argv[1], sys.argv[2], -1, True).ner_model, sys.argv[3])')
+    subprocess.check_call([sys.executable, '-c', script, checkpoint[0], checkpoint[1], path], cwd=ROOT)
+    loaded = torch.jit.load(path)
+    assert [loaded(batch, None) for batch in batches] == changed
+
+
+def test_paged_model_exports_its_resident_rows(workload, paged):
+    embedding, f_map = paged[:2]
+    ner_model = paged_model(workload, embedding, f_map)
+    scripted = torch.jit.script(ScriptedDecoder(ner_model))
+    n_resident = embedding.weight.size(0)
+    assert scripted.token_table.size(0) == n_resident < len(f_map)
+    # the paged-in words are decoded as <unk>
+    sentences = frozen_sentences(workload, embedding, f_map)
+    resident = [[word if f_map.get(word, n_resident) < n_resident else '<unk>' for word in sentence] for sentence in sentences]
+    features = utils.encode_safe_predict(resident, f_map, f_map['<unk>'])
+    idx2action = {v: k for k, v in workload.a_map.items()}
+    with torch.no_grad():
+        pre_actions = ner_model.forward_batch(utils.PadCollate(f_map['<eof>'])([torch.LongTensor(f) for f in features]))[1]
+    assert scripted.predict(sentences) == [evaluate.get_entities(a, idx2action) for a in pre_actions]
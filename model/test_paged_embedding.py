@@ -0,0 +1,122 @@
+import copy
+import itertools
+import pickle
+
+import pytest
+import torch
+import torch.nn as nn
+
+from model.paged_embedding import PagedEmbedding
+from model.predictor import load_checkpoint
+from model.stack_lstm import TransitionNER
+import model.utils as utils
+
+
+@pytest.fixture
+def paged(workload, tmp_path):
+    """
+    (PagedEmbedding over the corpus rows and the cached out-of-corpus rows, its word ids, the in-memory word ids and embedding)
+    """
+    corpus_words = set(itertools.chain.from_iterable(workload.features))
+    cache_prefix = str(tmp_path / 'emb')
+    emb_len = workload.args.embedding_dim
+    torch.manual_seed(0)
+    f_map, embedding = utils.load_embedding_wlm(workload.emb_file, ' ', {'<eof>': 0}, corpus_words, True, 'unk', emb_len,
+                                                shrink_to_corpus=True, cache_prefix=cache_prefix)
+    frozen_rows = utils.append_cache_words(f_map, utils.load_embedding_cache(workload.emb_file, ' ', cache_prefix)[0], 'unk')
+    torch.manual_seed(0)
+    full_map, full_embedding = utils.load_embedding_wlm(workload.emb_file, ' ', {'<eof>': 0}, corpus_words, True, 'unk', emb_len)
+    return PagedEmbedding(embedding, cache_prefix, frozen_rows, hot_size=8), f_map, full_map, full_embedding
+
+
+def test_paged_rows_match_the_in_memory_embedding(paged):
+    embedding, f_map, full_map, full_embedding = paged
+    assert embedding.num_embeddings == len(f_map) == len(full_map)
+    assert embedding.frozen_rows.size(0) > embedding.hot_size
+    words = sorted(f_map, key=f_map.get)
+    ids = torch.LongTensor([f_map[word] for word in words])
+    expected = full_embedding[[full_map[word] for word in words]]
+    with torch.no_grad():
+        # one id at a time through the hot table, then all of them at once (more than it holds)
+        for idx in torch.randperm(ids.size(0), generator=torch.Generator().manual_seed(0)).tolist():
+            assert torch.equal(embedding(ids[idx:idx + 1]), expected[idx:idx + 1])
+        assert torch.equal(embedding(ids.unsqueeze(0)), expected.unsqueeze(0))
+
+
+def test_hot_rows_are_read_once(paged):
+    embedding = paged[0]
+    frozen = torch.LongTensor([embedding.weight.size(0) + idx for idx in [0, 3, 5, 3, 0]])
+    first = embedding(frozen)
+    assert embedding.reads == 3
+    assert torch.equal(embedding(frozen.view(5, 1)).squeeze(1), first)
+    assert embedding.reads == 3
+    # 8 new words evict all of them
+    embedding(torch.arange(embedding.weight.size(0) + 10, embedding.weight.size(0) + 18))
+    assert torch.equal(embedding(frozen), first)
+    assert embedding.reads == 3 + 8 + 3
+
+
+def test_only_corpus_rows_are_trained(paged):
+    embedding = paged[0]
+    assert [name for name, _ in embedding.named_parameters()] == ['weight']
+    assert sorted(embedding.state_dict()) == ['frozen_rows', 'weight']
+    words = torch.LongTensor([[1, embedding.weight.size(0) + 2]])
+    embedding(words).sum().backward()
+    assert embedding.weight.grad[1].abs().sum() > 0
+    assert embedding.weight.grad[torch.arange(embedding.weight.size(0)) != 1].abs().sum() == 0
+
+
+def test_pickled_embedding_reopens_the_cache(paged):
+    embedding = paged[0]
+    words = torch.arange(embedding.num_embeddings - 20, embedding.num_embeddings)
+    expected = embedding(words)
+    restored = pickle.loads(pickle.dumps(embedding))
+    assert restored.hot is None and restored._matrix is None
+    assert torch.equal(restored(words), expected)
+
+
+def paged_model(workload, embedding, f_map):
+    """
+    random TransitionNER in eval mode paging the words of f_map beyond the corpus in through embedding
+    """
+    args = workload.args
+    torch.manual_seed(4)
+    ner_model = TransitionNER('predict', workload.a_map, f_map, workload.l_map, workload.char_map, workload.ner_map,
+                              embedding.weight.size(0), len(workload.a_map), args.embedding_dim, args.action_embedding_dim,
+                              args.char_embedding_dim, args.hidden, args.char_hidden, 1, args.drop_out, True, args.char_structure, is_cuda=-1)
+    ner_model.rand_init(init_word_embedding=False)
+    ner_model.load_pretrained_embedding(embedding.weight.data.clone())
+    ner_model.page_word_embedding(embedding.cache_prefix, embedding.frozen_rows, 8)
+    return ner_model.eval()
+
+
+def frozen_sentences(workload, embedding, f_map):
+    """
+    the synthetic sentences, each following seven out-of-corpus words
+    """
+    frozen_words = sorted(f_map, key=f_map.get)[embedding.weight.size(0):]
+    return [frozen_words[start:start + 7] + list(workload.features[start // 7]) for start in range(0, 140, 7)]
+
+
+def test_paged_model_decodes_like_the_in_memory_model(workload, paged, tmp_path):
+    embedding, f_map, full_map, full_embedding = paged
+    args = workload.args
+    ner_model = paged_model(workload, embedding, f_map)
+    in_memory = copy.deepcopy(ner_model)
+    in_memory.word_embeds = nn.Embedding.from_pretrained(full_embedding[[full_map[w] for w in sorted(f_map, key=f_map.get)]])
+
+    sentences = frozen_sentences(workload, embedding, f_map)
+    features = utils.encode_safe_predict(sentences, f_map, f_map['<unk>'])
+    batch = utils.PadCollate(f_map['<eof>'])([torch.LongTensor(f) for f in features])
+    with torch.no_grad():
+        expected = in_memory.forward_batch(batch)[1]
+        assert ner_model.forward_batch(batch)[1] == expected
+
+    prefix = str(tmp_path / 'paged')
+    utils.save_checkpoint({'epoch': 0, 'state_dict': ner_model.state_dict(), 'optimizer': None, 'f_map': f_map, 'l_map': workload.l_map,
+                           'a_map': workload.a_map, 'char_map': workload.char_map, 'ner_map': workload.ner_map},
+                          {'track_list': [], 'args': dict(vars(args), layers=1, emb_cache=embedding.cache_prefix, paged_embedding=8)}, prefix)
+    reloaded = load_checkpoint(prefix + '.json', prefix + '.model', spelling=True)[0]
+    assert isinstance(reloaded.word_embeds, PagedEmbedding)
+    with torch.no_grad():
+        assert reloaded.forward_batch(batch)[1] == expected
@@ -0,0 +1,54 @@
+import pytest
+
+from model.profiling import NullProfiler, Profiler
+from model.test_stack_lstm import decode, pad
+
+
+PHASES = ['embedding', 'char', 'buffer_lstm', 'transition', 'transition/score', 'transition/action_lstm', 'transition/stack',
+          'transition/entity', 'transition/output']
+
+
+def profiled(ner_model, batch, beam_size=1):
+    """
+    decoded actions of batch and the profiler report of the call
+    """
+    profiler = Profiler()
+    ner_model.enable_profiler(profiler)
+    try:
+        actions = decode(ner_model, batch, beam_size)
+    finally:
+        ner_model.disable_profiler()
+    return actions, profiler.end_batch()
+
+
+def test_counters_match_the_decoded_actions(workload, trained_model, sentences):
+    shift, out = workload.a_map['SHIFT'], workload.a_map['OUT']
+    batch = sentences[:24]
+    padded = pad(workload, batch)
+    actions, report = profiled(trained_model, padded)
+    assert sorted(report['time']) == sorted(PHASES)
+    assert all(seconds >= 0 for seconds in report['time'].values())
+
+    n_shift = sum(a == shift for row in actions for a in row)
+    n_reduce = sum(a not in (shift, out) for row in actions for a in row)
+    counts = report['counts']
+    assert counts['sentences'] == len(batch)
+    assert counts['tokens'] == sum(len(s) for s in batch)
+    assert counts['padded_tokens'] == padded.numel()
+    assert counts['steps'] == sum(len(row) for row in actions)
+    assert counts['batch_steps'] == max(len(row) for row in actions)
+    assert counts['reduces'] == n_reduce
+    # one stack or output push per action, and every shifted word is pushed on both entity lstms when reduced
+    assert counts['pushes'] == counts['steps'] + 2 * n_shift
+
+
+@pytest.mark.parametrize('beam_size', [1, 3])
+def test_profiling_leaves_predictions_unchanged(workload, trained_model, sentences, beam_size):
+    padded = pad(workload, sentences[:24])
+    assert isinstance(trained_model.profiler, NullProfiler)
+    plain = decode(trained_model, padded, beam_size)
+    actions, report = profiled(trained_model, padded, beam_size)
+    assert actions == plain
+    assert report['counts']['steps'] > 0
+    assert isinstance(trained_model.profiler, NullProfiler)
+    assert decode(trained_model, padded, beam_size) == plain
@@ -0,0 +1,242 @@
+import collections
+import itertools
+
+import pytest
+import torch
+import torch.nn as nn
+
+from conftest import build_model
+from model.stack_lstm import BatchStackRNN, StackRNN
+import model.evaluate as evaluate
+import model.utils as utils
+
+
+def pad(workload, batch):
+    """
+    LongTensor of word-id lists padded with <eof>, the way construct_dataset pads them
+    """
+    max_len = max(len(sentence) for sentence in batch)
+    return torch.LongTensor([sentence + [workload.f_map['<eof>']] * (max_len - len(sentence)) for sentence in batch])
+
+
+def decode(ner_model, batch, beam_size=1):
+    with torch.no_grad():
+        if beam_size > 1:
+            return ner_model.beam_search(batch, beam_size)
+        return ner_model.forward_batch(batch)[1]
+
+
+def test_reverse_padded():
+    batch = torch.LongTensor([[1, 2, 3, 0], [4, 5, 0, 0], [0, 0, 0, 0]])
+    reversed_batch = utils.reverse_padded(batch.unsqueeze(2), torch.LongTensor([3, 2, 0])).squeeze(2)
+    assert reversed_batch.tolist() == [[3, 2, 1, 0], [5, 4, 0, 0], [0, 0, 0, 0]]
+
+
+def test_encode_buffer_ignores_padding(workload, trained_model, sentences):
+    batch = sentences[:24]
+    with torch.no_grad():
+        _, tok_output, sents_len, _ = trained_model.encode_buffer(pad(workload, batch))
+        assert sents_len.tolist() == [len(s) for s in batch]
+        for row, sentence in enumerate(batch):
+            _, alone, _, _ = trained_model.encode_buffer(pad(workload, [sentence]))
+            assert torch.allclose(tok_output[row, :len(sentence)], alone[0], atol=1e-6)
+
+
+@pytest.mark.parametrize('beam_size', [1, 3])
+@pytest.mark.parametrize('model_name', ['trained_model', 'word_model'])
+def test_decoding_alone_and_in_a_padded_batch(request, workload, sentences, model_name, beam_size):
+    ner_model = request.getfixturevalue(model_name)
+    # every sentence next to the longest one, so most rows carry padding
+    longest = max(sentences, key=len)
+    batch = [s for s in sentences[:30]] + [longest]
+    together = decode(ner_model, pad(workload, batch), beam_size)
+    for sentence, actions in zip(batch, together):
+        assert decode(ner_model, pad(workload, [sentence]), beam_size)[0] == actions
+
+
+def test_eval_initial_state_is_deterministic(trained_model):
+    h, c = trained_model.initial_state()
+    assert h.abs().sum() == 0 and c.abs().sum() == 0
+    trained_model.train()
+    try:
+        assert trained_model.initial_state()[0].abs().sum() > 0
+    finally:
+        trained_model.eval()
+
+
+def test_init_buffer_is_saved(workload, trained_model):
+    reloaded = build_model(workload)
+    assert not torch.equal(reloaded.init_buffer, trained_model.init_buffer)
+    reloaded.load_state_dict(trained_model.state_dict())
+    assert torch.equal(reloaded.init_buffer, trained_model.init_buffer)
+    # checkpoints saved without it keep the buffer drawn at construction
+    state = {name: tensor for name, tensor in trained_model.state_dict().items() if name != 'init_buffer'}
+    fresh = build_model(workload)
+    drawn = fresh.init_buffer.clone()
+    fresh.load_state_dict(state)
+    assert torch.equal(fresh.init_buffer, drawn)
+
+
+def test_gold_transitions_batched_and_alone(workload, trained_model):
+    eof, action_pad = workload.f_map['<eof>'], workload.a_map['<pad>']
+    trained_model.mode = 'train'
+    try:
+        with torch.no_grad():
+            for feature, _, action in itertools.islice(workload.batches(), 3):
+                loss, predicts, right = trained_model.forward_batch(feature, action)
+                losses = []
+                for row in range(feature.size(0)):
+                    n_words, n_actions = int((feature[row] != eof).sum()), int((action[row] != action_pad).sum())
+                    row_loss, row_predicts, row_right = trained_model.forward_batch(feature[row:row + 1, :n_words], action[row:row + 1, :n_actions])
+                    assert len(predicts[row]) == n_actions
+                    assert row_predicts[0] == predicts[row]
+                    assert row_right[0] == right[row]
+                    losses.append(row_loss.item())
+                assert loss.item() == pytest.approx(sum(losses), rel=1e-5)
+    finally:
+        trained_model.mode = 'predict'
+
+
+def test_decoded_transitions_consume_every_word(trained_model, workload, sentences):
+    shift, out = workload.a_map['SHIFT'], workload.a_map['OUT']
+    for start in range(0, len(sentences), 16):
+        batch = sentences[start:start + 16]
+        for sentence, actions in zip(batch, decode(trained_model, pad(workload, batch))):
+            buffer_size, stack_size = len(sentence), 0
+            for action in actions:
+                if action == shift:
+                    assert buffer_size > 0
+                    buffer_size, stack_size = buffer_size - 1, stack_size + 1
+                elif action == out:
+                    assert buffer_size > 0 and stack_size == 0
+                    buffer_size -= 1
+                else:
+                    assert stack_size > 0
+                    stack_size = 0
+            assert buffer_size == 0 and stack_size == 0
+
+
+def test_batch_stack_rnn_matches_stack_rnn():
+    torch.manual_seed(0)
+    hidden, batch_size, max_depth = 6, 4, 8
+    cell = nn.LSTMCell(5, hidden)
+    initial = (torch.randn(1, hidden), torch.randn(1, hidden))
+    empty = torch.randn(1, hidden)
+    batch = BatchStackRNN(cell, initial, lambda state: state[0], empty, batch_size, max_depth)
+    stacks = [StackRNN(cell, initial, None, lambda state: state[0], empty) for _ in range(batch_size)]
+    with torch.no_grad():
+        for _ in range(40):
+            rows = torch.nonzero(torch.rand(batch_size) < 0.6).view(-1)
+            if rows.size(0) == 0:
+                continue
+            push = [row for row in rows.tolist() if len(stacks[row]) < max_depth and (len(stacks[row]) == 0 or torch.rand(1).item() < 0.6)]
+            pop = [row for row in rows.tolist() if row not in push]
+            if push:
+                expr = torch.randn(len(push), 5)
+                batch.push(torch.LongTensor(push), expr)
+                for idx, row in enumerate(push):
+                    stacks[row].push(expr[idx:idx + 1])
+            if pop:
+                batch.pop(torch.LongTensor(pop))
+                for row in pop:
+                    stacks[row].pop()
+            every_row = torch.arange(batch_size)
+            assert batch.size(every_row).tolist() == [len(stack) for stack in stacks]
+            assert torch.allclose(batch.embedding(every_row), torch.cat([stack.embedding() for stack in stacks]), atol=1e-6)
+        batch.clear(torch.LongTensor([0, 2]))
+        assert batch.size(torch.LongTensor([0, 2])).tolist() == [0, 0]
+        assert torch.equal(batch.embedding(torch.LongTensor([0])), empty)
+
+
+@pytest.mark.parametrize('char_structure', ['lstm', 'cnn'])
+def test_token_representation_of_a_padded_batch(workload, sentences, char_structure):
+    torch.manual_seed(3)
+    ner_model = build_model(workload, char_structure=char_structure).eval()
+    eof = workload.f_map['<eof>']
+    batch = sentences[:20]
+    with torch.no_grad():
+        together = ner_model.token_representation(pad(workload, batch), pad_word=eof)
+        for row, sentence in enumerate(batch):
+            # the per-word assembly it replaces
+            words = [torch.cat([ner_model.word_embeds(torch.LongTensor([word])), ner_model.char_representation(torch.LongTensor([word]))], 1)
+                     for word in sentence]
+            assert torch.allclose(together[row, :len(sentence)], torch.cat(words, 0), atol=1e-6)
+            assert torch.equal(together[row, len(sentence):, ner_model.embedding_dim:],
+                               ner_model.pad_char_embeds.expand(together.size(1) - len(sentence), -1))
+
+
+def test_action_mask_allows_the_possible_actions(trained_model):
+    n_actions = trained_model.output_2_act.out_features
+    for stack_size, buffer_size in itertools.product([0, 1, 3], [0, 1, 5]):
+        mask = trained_model.action_mask(torch.LongTensor([stack_size]), torch.LongTensor([buffer_size]))[0]
+        possible = trained_model.get_possible_actions([None] * stack_size, [None] * buffer_size)
+        assert [a for a in range(n_actions) if mask[a] == 0] == sorted(possible)
+        assert all(mask[a] == float('-inf') for a in range(n_actions) if a not in possible)
+
+
+def test_masked_loss_is_the_nll_over_possible_actions(trained_model):
+    torch.manual_seed(0)
+    stack_size, buffer_size = torch.LongTensor([0, 2, 0, 4]), torch.LongTensor([3, 0, 0, 1])
+    logits = torch.randn(4, trained_model.output_2_act.out_features)
+    targets = []
+    expected = 0
+    for row in range(4):
+        possible = sorted(trained_model.get_possible_actions([None] * int(stack_size[row]), [None] * int(buffer_size[row])))
+        targets.append(possible[-1])
+        expected -= torch.log_softmax(logits[row, possible], 0)[-1]
+    masked = logits + trained_model.action_mask(stack_size, buffer_size)
+    loss = torch.nn.functional.cross_entropy(masked, torch.LongTensor(targets), reduction='sum')
+    assert loss.item() == pytest.approx(expected.item(), rel=1e-6)
+
+
+def test_quantized_model_finds_mostly_the_same_entities(workload, trained_model, sentences):
+    idx2action = {v: k for k, v in workload.a_map.items()}
+    quantized = trained_model.quantize()
+    agree = total = 0
+    for start in range(0, len(sentences), 16):
+        batch = pad(workload, sentences[start:start + 16])
+        for float_actions, int8_actions in zip(evaluate.decode_batch(trained_model, batch, False), evaluate.decode_batch(quantized, batch, False)):
+            float_entities = set(evaluate.get_entities(float_actions, idx2action))
+            int8_entities = set(evaluate.get_entities(int8_actions, idx2action))
+            agree += len(float_entities & int8_entities)
+            total += max(len(float_entities), len(int8_entities))
+    assert total > 0
+    assert agree >= 0.8 * total
+
+
+@pytest.mark.parametrize('model_name', ['trained_model', 'word_model'])
+def test_fused_cells_decode_the_actions_of_the_separate_cells(request, workload, sentences, model_name):
+    ner_model = request.getfixturevalue(model_name)
+    batches = [pad(workload, sentences[start:start + 16]) for start in range(0, len(sentences), 16)]
+    separate = [decode(ner_model, batch) for batch in batches]
+    ner_model.enable_fused_cells()
+    try:
+        fused = [decode(ner_model, batch) for batch in batches]
+        assert ner_model.fused_weights is not None
+    finally:
+        ner_model.disable_fused_cells()
+    assert fused == separate
+
+
+def test_char_cache_returns_the_encoded_representations(workload, sentences):
+    torch.manual_seed(4)
+    ner_model = build_model(workload).eval()
+    idx2word = {v: k for k, v in workload.f_map.items()}
+    word_count = collections.Counter(idx2word[w] for sentence in sentences for w in sentence)
+    words = torch.LongTensor([w for sentence in sentences[:40] for w in sentence])
+    with torch.no_grad():
+        expected = ner_model.char_representation(words)
+        ner_model.enable_char_cache(10, 5, word_count)
+        cache = ner_model.char_cache
+        # the dense table holds the most frequent words
+        counts = sorted(word_count[idx2word[w]] for w in cache.head_words.tolist())
+        assert counts[0] >= max(word_count[idx2word[w]] for w in range(1, len(idx2word)) if w not in cache.head_words.tolist())
+        for _ in range(2):
+            assert torch.allclose(ner_model.char_representation(words), expected, atol=1e-6)
+            assert cache.head_filled.all() and len(cache.lru) == 5
+        # updated char weights drop the cached representations
+        ner_model.char_embeds.weight.add_(1)
+        updated = ner_model.char_representation(words)
+        ner_model.disable_char_cache()
+        assert torch.allclose(ner_model.char_representation(words), updated, atol=1e-6)
+        assert not torch.allclose(updated, expected, atol=1e-6)
@@ -0,0 +1,155 @@
+import itertools
+import os
+
+import numpy as np
+import pytest
+import torch
+
+import model.utils as utils
+
+
+@pytest.mark.parametrize('shrink_to_corpus', [False, True])
+def test_embedding_cache_loads_the_text_embedding(workload, tmp_path, shrink_to_corpus):
+    corpus_words = set(itertools.chain.from_iterable(workload.features))
+    feature_map = {word: idx for idx, word in enumerate(['<eof>'] + sorted(corpus_words)[::2])}
+    loaded = []
+    for cache_prefix in [None, str(tmp_path / 'emb')]:
+        # the same random rows for the words missing from the file
+        torch.manual_seed(0)
+        loaded.append(utils.load_embedding_wlm(workload.emb_file, ' ', feature_map, corpus_words, True, 'unk', workload.args.embedding_dim,
+                                               shrink_to_corpus=shrink_to_corpus, cache_prefix=cache_prefix))
+    (text_dict, text_embedding), (cache_dict, cache_embedding) = loaded
+    assert cache_dict == text_dict
+    assert torch.equal(cache_embedding, text_embedding)
+
+
+def test_embedding_cache_is_converted_once(workload, tmp_path):
+    emb_file = str(tmp_path / 'emb.txt')
+    with open(workload.emb_file, 'r') as fin, open(emb_file, 'w') as fout:
+        fout.write(fin.read())
+    cache_prefix = str(tmp_path / 'emb')
+    words, matrix = utils.load_embedding_cache(emb_file, ' ', cache_prefix)
+    assert isinstance(matrix, np.memmap)
+    assert matrix.shape == (workload.emb_rows, workload.args.embedding_dim)
+    with open(emb_file, 'r') as f:
+        first = f.readline().split(' ')
+    assert words[0] == first[0]
+    assert np.allclose(matrix[0], [float(t) for t in first[1:]])
+
+    converted = os.stat(cache_prefix + '.bin').st_mtime_ns
+    utils.load_embedding_cache(emb_file, ' ', cache_prefix)
+    assert os.stat(cache_prefix + '.bin').st_mtime_ns == converted
+
+    # a changed embedding file makes the cache stale
+    with open(emb_file, 'a') as f:
+        f.write('zzznew ' + ' '.join(['0.5'] * workload.args.embedding_dim) + '\n')
+    words, matrix = utils.load_embedding_cache(emb_file, ' ', cache_prefix)
+    assert words[-1] == 'zzznew' and matrix.shape[0] == workload.emb_rows + 1
+    assert np.all(matrix[-1] == 0.5)
+
+
+def test_corpus_cache_key(tmp_path):
+    content = [str(tmp_path / name) for name in ['train.txt', 'dev.txt', 'test.txt']]
+    stamped = str(tmp_path / 'emb.txt')
+    for path in content + [stamped]:
+        with open(path, 'w') as f:
+            f.write(path + '\n')
+    settings = {'mini_count': 1, 'caseless': True}
+    key = utils.corpus_cache_key(content, [stamped], settings)
+    assert utils.corpus_cache_key(content, [stamped], dict(reversed(list(settings.items())))) == key
+    # the content files count by their bytes, not their timestamps
+    os.utime(content[0], (0, 0))
+    assert utils.corpus_cache_key(content, [stamped], settings) == key
+
+    with open(content[2], 'a') as f:
+        f.write('more\n')
+    changed_test = utils.corpus_cache_key(content, [stamped], settings)
+    changed_setting = utils.corpus_cache_key(content, [stamped], dict(settings, mini_count=2))
+    os.utime(stamped, (0, 0))
+    changed_stamp = utils.corpus_cache_key(content, [stamped], settings)
+    assert len({key, changed_test, changed_setting, changed_stamp}) == 4
+
+
+CONLL = """-DOCSTART- -X- O O
+
+John NNP B-PER
+Smith NNP I-PER
+lives VBZ O
+in IN O
+New NNP B-LOC
+York NNP I-LOC
+Paris NNP B-LOC
+
+EU NNP B-ORG
+
+"""
+
+
+def test_generate_corpus_oracle():
+    word_count = {'John': 2}
+    features, labels, actions, f_map, l_map, a_map, char_map, ner_map, singleton = \
+        utils.generate_corpus(iter(CONLL.splitlines(True)), word_count)
+    assert features == [['John', 'Smith', 'lives', 'in', 'New', 'York', 'Paris'], ['EU']]
+    assert labels == [['B-PER', 'I-PER', 'O', 'O', 'B-LOC', 'I-LOC', 'B-LOC'], ['B-ORG']]
+    assert actions == [['SHIFT', 'SHIFT', 'REDUCE-PER', 'OUT', 'OUT', 'SHIFT', 'SHIFT', 'REDUCE-LOC', 'SHIFT', 'REDUCE-LOC'],
+                       ['SHIFT', 'REDUCE-ORG']]
+    assert f_map == {'<unk>': 0, 'John': 1, 'Smith': 2, 'lives': 3, 'in': 4, 'New': 5, 'York': 6, 'Paris': 7, 'EU': 8, '<eof>': 9}
+    assert l_map == {'B-PER': 0, 'I-PER': 1, 'O': 2, 'B-LOC': 3, 'I-LOC': 4, 'B-ORG': 5, '<pad>': 6}
+    assert a_map == {'OUT': 0, 'SHIFT': 1, 'REDUCE-PER': 2, 'REDUCE-LOC': 3, 'REDUCE-ORG': 4, '<pad>': 5}
+    assert ner_map == {'REDUCE-PER': 0, 'REDUCE-LOC': 1, 'REDUCE-ORG': 2}
+    assert list(char_map)[:6] == ['<start>', '<end>', 'J', 'o', 'h', 'n']
+    assert word_count['John'] == 3 and word_count['EU'] == 1
+    assert 'John' not in singleton and 'EU' in singleton
+
+
+def test_read_conll_chunks_and_workers(workload):
+    expected = utils.read_conll(workload.conll_lines, {'extra': 1})
+    for workers, chunk_lines in [(1, 7), (2, 50), (3, 1)]:
+        assert utils.read_conll(iter(workload.conll_lines), {'extra': 1}, workers, chunk_lines) == expected
+    assert utils.generate_corpus(iter(workload.conll_lines), dict(), True, 0, workers=2) == workload.read_corpus()
+
+
+def test_transition_collate_pads_each_field():
+    samples = [(torch.LongTensor([5, 6, 7]), torch.LongTensor([1, 1, 2]), torch.LongTensor([1, 0, 0, 3])),
+               (torch.LongTensor([8]), torch.LongTensor([2]), torch.LongTensor([0]))]
+    features, labels, actions = utils.TransitionCollate(9, 4, 6)(samples)
+    assert features.tolist() == [[5, 6, 7], [8, 9, 9]]
+    assert labels.tolist() == [[1, 1, 2], [2, 4, 4]]
+    assert actions.tolist() == [[1, 0, 0, 3], [0, 6, 6, 6]]
+
+
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_token_budget_sampler(shuffle):
+    lengths = [int(n) for n in torch.randint(1, 40, (200,), generator=torch.Generator().manual_seed(0))] + [90]
+    torch.manual_seed(1)
+    sampler = utils.TokenBudgetSampler(lengths, max_tokens=80, max_sentences=8, shuffle=shuffle)
+    epochs = [list(sampler), list(sampler)]
+    for batches in epochs:
+        assert len(batches) == len(sampler)
+        assert sorted(itertools.chain.from_iterable(batches)) == list(range(len(lengths)))
+        for batch in batches:
+            assert len(batch) <= 8
+            # a sentence longer than the budget still gets a batch of its own
+            assert len(batch) == 1 or len(batch) * max(lengths[idx] for idx in batch) <= 80
+    assert [90] in [[lengths[idx] for idx in batch] for batch in epochs[0]]
+    assert (epochs[0] != epochs[1]) == shuffle
+
+
+def test_transition_collate_replaces_singletons():
+    singleton_mask = utils.build_singleton_mask(['b', 'c'], {'<unk>': 0, 'a': 1, 'b': 2, 'c': 3, '<eof>': 4})
+    samples = [(torch.LongTensor([1, 2, 3, 2]), torch.LongTensor([0] * 4), torch.LongTensor([0] * 4))]
+    assert utils.TransitionCollate(4, 0, 0, 0, singleton_mask, 0)(samples)[0].tolist() == [[1, 2, 3, 2]]
+    assert utils.TransitionCollate(4, 0, 0, 0, singleton_mask, 1)(samples)[0].tolist() == [[1, 0, 0, 0]]
+    # the padding is never replaced
+    samples.append((torch.LongTensor([1]), torch.LongTensor([0]), torch.LongTensor([0])))
+    assert utils.TransitionCollate(4, 0, 0, 0, singleton_mask, 1)(samples)[0].tolist() == [[1, 0, 0, 0], [1, 4, 4, 4]]
+
+
+def test_char_table_holds_the_words_looked_up():
+    table = utils.CharTable({'<unk>': 0, 'ab': 1, 'b?c': 2, '??': 3, '<eof>': 4}, {'a': 1, 'b': 2, 'c': 3})
+    assert table.size == 5 and table.chars == {}
+    chars, lengths = table.lookup(torch.LongTensor([2, 1, 3, 2]))
+    assert chars.tolist() == [[2, 3], [1, 2], [0, 0], [2, 3]]
+    assert lengths.tolist() == [2, 2, 0, 2]
+    assert sorted(table.chars) == [1, 2, 3]
+    assert table.lengths(torch.LongTensor([3, 9])).tolist() == [0, 0]
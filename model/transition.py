@@ -0,0 +1,66 @@
+"""
+bookkeeping of the transition system, shared by TransitionNER and the TorchScript decoder of model.export
+
+token_embedds and tok_output hold every sentence reversed within its own length (see TransitionNER.encode_buffer),
+so the front of the buffer of row b sits at sents_len[b] - 1 - buffer_pos[b]. The functions only index and
+update tensors, they are annotated so that torch.jit.script compiles them into the exported decoder
+"""
+from typing import Tuple
+
+import torch
+
+
+def split_actions(rows: torch.Tensor, action: torch.Tensor, shift_idx: int, out_idx: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    rows taking a SHIFT, an OUT and a REDUCE action, and the REDUCE mask over action
+    """
+    is_shift = action == shift_idx
+    is_out = action == out_idx
+    is_reduce = ~(is_shift | is_out)
+    return rows[is_shift], rows[is_out], rows[is_reduce], is_reduce
+
+
+def buffer_front(buffer: torch.Tensor, empty: torch.Tensor, sents_len: torch.Tensor, buffer_pos: torch.Tensor,
+                 rows: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    buffer sizes of rows and the row of buffer ([batch, max_len, dim]) at the front of each buffer, empty for the
+    rows whose buffer is empty
+    """
+    buffer_size = sents_len[rows] - buffer_pos[rows]
+    front = buffer[rows, (buffer_size - 1).clamp(min=0)]
+    return buffer_size, torch.where((buffer_size == 0).unsqueeze(1), empty.expand_as(front), front)
+
+
+def pop_buffer(token_embedds: torch.Tensor, sents_len: torch.Tensor, buffer_pos: torch.Tensor, rows: torch.Tensor) -> torch.Tensor:
+    """
+    token at the front of the buffer of rows, buffer_pos moves past it in place
+    """
+    front = token_embedds[rows, sents_len[rows] - 1 - buffer_pos[rows]]
+    buffer_pos[rows] = buffer_pos[rows] + 1
+    return front
+
+
+def entity_words(token_embedds: torch.Tensor, sents_len: torch.Tensor, buffer_pos: torch.Tensor, rows: torch.Tensor,
+                 entity_len: torch.Tensor, j: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    rows whose entity (the stack of length entity_len, reduced after it left the buffer) has more than j words,
+    word j of each for ent_f, which reads the entity from the top of the stack down, and for ent_b, bottom up
+    """
+    in_entity = entity_len > j
+    sub_rows = rows[in_entity]
+    sub_pos = sents_len[sub_rows] - buffer_pos[sub_rows]
+    return sub_rows, token_embedds[sub_rows, sub_pos + j], token_embedds[sub_rows, sub_pos - 1 + entity_len[in_entity] - j]
+
+
+def compose_entity(ent_f_emb: torch.Tensor, ent_b_emb: torch.Tensor, entity_len: torch.Tensor) -> torch.Tensor:
+    """
+    entity representation from the last outputs of the entity lstms
+    """
+    return torch.where((entity_len > 1).unsqueeze(1), torch.cat([ent_b_emb, ent_f_emb], 1), torch.cat([ent_f_emb, ent_b_emb], 1))
+
+
+def unfinished(rows: torch.Tensor, sents_len: torch.Tensor, buffer_pos: torch.Tensor, stack_size: torch.Tensor) -> torch.Tensor:
+    """
+    rows with words left on the buffer or on the stack, stack_size given for every row of rows
+    """
+    return rows[(buffer_pos[rows] < sents_len[rows]) | (stack_size > 0)]
@@ -1,10 +1,13 @@
+import hashlib
 import itertools
 import json
+import multiprocessing
+import os
 
 import numpy as np
 import torch.nn as nn
 import torch.nn.init
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 
 class TransitionDataset_P(Dataset):
 
@@ -17,6 +20,91 @@ class TransitionDataset_P(Dataset):
     def __len__(self):
         return len(self.data_tensor)
 
+class PadCollate(object):
+    """
+    collate_fn stacking variable-length sentences of a TransitionDataset_P into one batch padded with pad
+    """
+    def __init__(self, pad):
+        self.pad = pad
+
+    def __call__(self, features):
+        max_len = max(max(len(feature) for feature in features), 1)
+        batch = torch.LongTensor(len(features), max_len).fill_(self.pad)
+        for idx, feature in enumerate(features):
+            batch[idx, :len(feature)] = feature
+        return batch
+
+class TransitionCollate(object):
+    """
+    collate_fn padding the sentences and labels of a TransitionDataset batch to its longest sentence and the
+    actions to its longest action sequence
+
+    with a singleton_mask (see build_singleton_mask), each occurrence of a singleton word is replaced by unk
+    with probability singleton_rate, drawn anew for every batch
+    """
+    def __init__(self, word_pad, label_pad, action_pad, unk=None, singleton_mask=None, singleton_rate=0):
+        self.word_pad = word_pad
+        self.label_pad = label_pad
+        self.action_pad = action_pad
+        self.unk = unk
+        self.singleton_mask = singleton_mask
+        self.singleton_rate = singleton_rate
+
+    def __call__(self, samples):
+        max_len = max(max(len(feature) for feature, _, _ in samples), 1)
+        max_act = max(max(len(action) for _, _, action in samples), 1)
+        features = torch.LongTensor(len(samples), max_len).fill_(self.word_pad)
+        labels = torch.LongTensor(len(samples), max_len).fill_(self.label_pad)
+        actions = torch.LongTensor(len(samples), max_act).fill_(self.action_pad)
+        for idx, (feature, label, action) in enumerate(samples):
+            features[idx, :len(feature)] = feature
+            labels[idx, :len(label)] = label
+            actions[idx, :len(action)] = action
+        if self.singleton_mask is not None and self.singleton_rate > 0:
+            drop = self.singleton_mask[features] & (torch.rand(features.size()) < self.singleton_rate)
+            features[drop] = self.unk
+        return features, labels, actions
+
+class TokenBudgetSampler(Sampler):
+    """
+    batch sampler grouping sentences of equal or close action length into batches of at most max_sentences
+    sentences whose padded size (sentences x longest action sequence) stays within max_tokens
+
+    with shuffle, sentences of the same length are shuffled before batching and the batch order is shuffled
+    every epoch, drawing from generator when given
+    """
+    def __init__(self, lengths, max_tokens, max_sentences, shuffle=True, generator=None):
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self.max_sentences = max_sentences
+        self.shuffle = shuffle
+        self.generator = generator
+        self.n_batches = len(self._batches(list(range(len(lengths)))))
+
+    def _batches(self, order):
+        order = sorted(order, key=lambda idx: self.lengths[idx])
+        batches = list()
+        batch = list()
+        for idx in order:
+            # sorted by length, so the sentence joining the batch is its longest one
+            if batch and (len(batch) >= self.max_sentences or (len(batch) + 1) * self.lengths[idx] > self.max_tokens):
+                batches.append(batch)
+                batch = list()
+            batch.append(idx)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(len(self.lengths), generator=self.generator).tolist()
+            batches = self._batches(order)
+            return iter([batches[idx] for idx in torch.randperm(len(batches), generator=self.generator).tolist()])
+        return iter(self._batches(list(range(len(self.lengths)))))
+
+    def __len__(self):
+        return self.n_batches
+
 class TransitionDataset(Dataset):
 
     def __init__(self, data_tensor, label_tensor, action_tensor):
@@ -33,6 +121,42 @@ class TransitionDataset(Dataset):
     def __len__(self):
         return len(self.data_tensor)
 
+class CharTable(object):
+    """
+    char ids of the words of word_dict, looked up the first time a word id is used instead of tabulated for the
+    whole vocabulary, so only the words of the batches seen so far are held
+
+    characters missing from char_dict are dropped, a word left without characters has length 0
+    """
+    def __init__(self, word_dict, char_dict):
+        self.idx2word = {idx: word for word, idx in word_dict.items()}
+        self.char_dict = char_dict
+        self.size = max(word_dict.values()) + 1
+        self.chars = dict()
+
+    def word_chars(self, idx):
+        chars = self.chars.get(idx)
+        if chars is None:
+            chars = [self.char_dict[char] for char in self.idx2word.get(idx, '') if char in self.char_dict]
+            self.chars[idx] = chars
+        return chars
+
+    def lengths(self, words):
+        """
+        IntTensor of the number of chars of every word id of the LongTensor words
+        """
+        return torch.IntTensor([len(self.word_chars(idx)) for idx in words.tolist()])
+
+    def lookup(self, words):
+        """
+        [n_words, longest word] IntTensor of the char ids of the word ids words padded with 0, and their lengths
+        """
+        lines = [self.word_chars(idx) for idx in words.tolist()]
+        lengths = torch.IntTensor([len(line) for line in lines])
+        chars = torch.IntTensor(len(lines), max(int(lengths.max()) if len(lines) > 0 else 0, 1)).zero_()
+        chars[torch.arange(chars.size(1)).unsqueeze(0) < lengths.unsqueeze(1)] = torch.IntTensor(list(itertools.chain.from_iterable(lines)))
+        return chars, lengths
+
 
 zip = getattr(itertools, 'izip', zip)
 
@@ -76,19 +200,15 @@ def encode2char_safe(input_lines, char_dict):
     return forw_lines
 
 
-def encode_safe(input_lines, word_dict, unk, singleton, singleton_rate):
-    lines = list()
-    for sentence in input_lines:
-        line = list()
-        for word in sentence:
-            if word in singleton and torch.rand(1).numpy()[0] < singleton_rate:
-                line.append(unk)
-            elif word in word_dict:
-                line.append(word_dict[word])
-            else:
-                line.append(unk)
-        lines.append(line)
-    return lines
+def build_singleton_mask(singleton, word_dict):
+    """
+    bool mask over word ids, true for the words of singleton
+    """
+    mask = torch.zeros(len(word_dict)).bool()
+    ids = [word_dict[word] for word in singleton if word in word_dict]
+    if ids:
+        mask[torch.LongTensor(ids)] = True
+    return mask
 
 def encode_safe_predict(input_lines, word_dict, unk):
     lines = list(map(lambda t: list(map(lambda m: word_dict.get(m, unk), t)), input_lines))
@@ -114,17 +234,33 @@ def shrink_features(feature_map, features, thresholds):
     feature_map['<eof>'] = len(feature_map)
     return feature_map
 
-def generate_corpus(lines: object, word_count, if_shrink_feature: object = False, thresholds: object = 1) -> object:
-
-    feature_map = dict()
-    char_map = {"<start>": 0, "<end>": 1}
-    label_map = dict()
-    action_map = {"OUT": 0, "SHIFT": 1}
-    ner_map =dict()
+def _is_sentence_break(line):
+    return line.isspace() or (len(line) > 10 and line[0:10] == '-DOCSTART-')
 
+def _split_corpus(lines, chunk_lines):
+    """
+    cut a stream of lines into chunks of at least chunk_lines lines, each ending on a sentence break
+    """
+    chunk = list()
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= chunk_lines and _is_sentence_break(line):
+            yield chunk
+            chunk = list()
+    if len(chunk) > 0:
+        yield chunk
+
+def _read_conll_chunk(lines):
+    """
+    BIO -> SHIFT / OUT / REDUCE-X oracle over a chunk of whole sentences, with the word counts, labels and
+    ner actions of the chunk in order of first occurrence
+    """
     features = list()
     actions = list()
     labels = list()
+    word_count = dict()
+    label_set = dict()
+    ner_set = dict()
 
     tmp_fl = list()
     tmp_ll = list()
@@ -132,31 +268,22 @@ def generate_corpus(lines: object, word_count, if_shrink_feature: object = False
     count_ner = 0
     ner_label = ""
     for line in lines:
-        if not (line.isspace() or (len(line) > 10 and line[0:10] == '-DOCSTART-')):
+        if not _is_sentence_break(line):
             line = line.rstrip('\n').split()
             tmp_fl.append(line[0])
             if line[0] in word_count:
                 word_count[line[0]] += 1
             else:
                 word_count[line[0]] = 1
-            for char_idx in range(len(line[0])):
-                if line[0][char_idx] not in char_map:
-                    char_map[line[0][char_idx]] = len(char_map)
             tmp_ll.append(line[-1])
-
-            if line[0] not in feature_map:
-                feature_map[line[0]] = len(feature_map) + 1 #0 is for unk
-            if line[-1] not in label_map:
-                label_map[line[-1]] = len(label_map)
+            label_set[line[-1]] = None
 
             if len(line[-1].split('-')) > 1:
                 if line[-1].split('-')[0] == "B" and not ner_label == "":
                     tmp_al.append(ner_label)
                     count_ner += 1
                 ner_label = "REDUCE-"+line[-1].split('-')[1]
-                if ner_label not in action_map:
-                    ner_map[ner_label] = len(ner_map)
-                    action_map[ner_label] = len(action_map)
+                ner_set[ner_label] = None
                 tmp_al.append("SHIFT")
             else:
                 if not ner_label == "":
@@ -186,6 +313,65 @@ def generate_corpus(lines: object, word_count, if_shrink_feature: object = False
         labels.append(tmp_ll)
         actions.append(tmp_al)
 
+    return features, labels, actions, word_count, list(label_set), list(ner_set)
+
+def read_conll(lines, word_count, workers=1, chunk_lines=100000):
+    """
+    single pass over a stream of CoNLL lines, chunked on sentence breaks and parsed in a pool of workers processes
+    when workers > 1; word_count is updated in place
+
+    returns features, labels, actions, word_count and the words, labels and ner actions of the corpus in order of first occurrence
+    """
+    chunks = _split_corpus(lines, chunk_lines)
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        parsed = pool.imap(_read_conll_chunk, chunks)
+    else:
+        pool = None
+        parsed = map(_read_conll_chunk, chunks)
+
+    features = list()
+    labels = list()
+    actions = list()
+    corpus_count = dict()
+    label_set = dict()
+    ner_set = dict()
+    try:
+        for chunk_features, chunk_labels, chunk_actions, chunk_count, chunk_label_set, chunk_ner_set in parsed:
+            features.extend(chunk_features)
+            labels.extend(chunk_labels)
+            actions.extend(chunk_actions)
+            for k, v in chunk_count.items():
+                corpus_count[k] = corpus_count.get(k, 0) + v
+            label_set.update(dict.fromkeys(chunk_label_set))
+            ner_set.update(dict.fromkeys(chunk_ner_set))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    for k, v in corpus_count.items():
+        word_count[k] = word_count.get(k, 0) + v
+    return features, labels, actions, word_count, list(corpus_count), list(label_set), list(ner_set)
+
+def generate_corpus(lines: object, word_count, if_shrink_feature: object = False, thresholds: object = 1, workers=1) -> object:
+
+    features, labels, actions, word_count, words, label_list, ner_list = read_conll(lines, word_count, workers)
+
+    feature_map = {word: (idx + 1) for idx, word in enumerate(words)} #0 is for unk
+    char_map = {"<start>": 0, "<end>": 1}
+    for word in words:
+        for char in word:
+            if char not in char_map:
+                char_map[char] = len(char_map)
+    label_map = {label: idx for idx, label in enumerate(label_list)}
+    action_map = {"OUT": 0, "SHIFT": 1}
+    ner_map = dict()
+    for ner_label in ner_list:
+        if ner_label not in action_map:
+            ner_map[ner_label] = len(ner_map)
+            action_map[ner_label] = len(action_map)
+
     if if_shrink_feature:
         feature_map = shrink_features(feature_map, features, thresholds)
     else:
@@ -205,59 +391,9 @@ def generate_corpus(lines: object, word_count, if_shrink_feature: object = False
     return features, labels, actions, feature_map, label_map, action_map, char_map, ner_map, singleton
 
 
-def read_corpus_ner(lines, word_count):
-
-    features = list()
-    actions = list()
-    labels = list()
-    tmp_fl = list()
-    tmp_ll = list()
-    tmp_al = list()
-    count_ner = 0
-    ner_label = ""
-    for line in lines:
-        if not (line.isspace() or (len(line) > 10 and line[0:10] == '-DOCSTART-')):
-            line = line.rstrip('\n').split()
-            tmp_fl.append(line[0])
-            if line[0] in word_count:
-                word_count[line[0]] += 1
-            else:
-                word_count[line[0]] = 1
-            tmp_ll.append(line[-1])
-            if len(line[-1].split('-')) > 1:
-                if line[-1].split('-')[0] == "B" and not ner_label == "":
-                    tmp_al.append(ner_label)
-                    count_ner += 1
-                ner_label = "REDUCE-"+line[-1].split('-')[1]
-                tmp_al.append("SHIFT")
-            else:
-                if not ner_label == "":
-                    tmp_al.append(ner_label)
-                    count_ner += 1
-                    ner_label = ""
-                tmp_al.append("OUT")
-
-        elif len(tmp_fl) > 0:
-            if not ner_label =="":
-                tmp_al.append(ner_label)
-                count_ner += 1
-                ner_label = ""
-            assert len(tmp_ll) == len(tmp_fl)
-            assert len(tmp_al) == len(tmp_fl)+count_ner
-            features.append(tmp_fl)
-            labels.append(tmp_ll)
-            actions.append(tmp_al)
-            count_ner = 0
-            tmp_al = list()
-            tmp_fl = list()
-            tmp_ll = list()
-    if len(tmp_fl) > 0:
-        assert len(tmp_ll) == len(tmp_fl)
-        assert len(tmp_al) == len(tmp_fl)+count_ner
-        features.append(tmp_fl)
-        labels.append(tmp_ll)
-        actions.append(tmp_al)
+def read_corpus_ner(lines, word_count, workers=1):
 
+    features, labels, actions, word_count = read_conll(lines, word_count, workers)[:4]
     return features, labels, actions, word_count
 
 def read_corpus_predict(lines):
@@ -268,6 +404,28 @@ def read_corpus_predict(lines):
 
     return features
 
+def iter_corpus_predict(lines):
+    """
+    lazy read_corpus_predict
+    """
+    for line in lines:
+        yield line.rstrip('\n').split()
+
+def iter_batches_predict(features, word_dict, batch_size):
+    """
+    encode an iterable of token lists into padded LongTensor batches of batch_size sentences, holding one batch at a time
+    """
+    collate = PadCollate(word_dict['<eof>'])
+    unk = word_dict['<unk>']
+    batch = []
+    for feature in features:
+        batch.append(torch.LongTensor([word_dict.get(word, unk) for word in feature]))
+        if len(batch) == batch_size:
+            yield collate(batch)
+            batch = []
+    if batch:
+        yield collate(batch)
+
 
 
 def shrink_embedding(feature_map, word_dict, word_embedding, caseless):
@@ -280,7 +438,52 @@ def shrink_embedding(feature_map, word_dict, word_embedding, caseless):
     new_embedding = word_embedding[new_word_list_ind]
     return new_word_dict, new_embedding
 
-def load_embedding_wlm(emb_file, delimiter, feature_map, full_feature_set, caseless, unk, emb_len, shrink_to_train=False, shrink_to_corpus=False):
+def convert_embedding(emb_file, delimiter, cache_prefix):
+    """
+    one-time conversion of a text embedding file into cache_prefix.bin (float32 rows in file order),
+    cache_prefix.vocab (one word per line) and cache_prefix.json (shape and source stamp, written last)
+    """
+    stamp = os.stat(emb_file)
+    rows = 0
+    emb_len = None
+    with open(emb_file, 'r') as fin, open(cache_prefix + '.bin.tmp', 'wb') as fbin, open(cache_prefix + '.vocab.tmp', 'w') as fvocab:
+        for line in fin:
+            line = line.split(delimiter)
+            if len(line) > 2:
+                vector = np.asarray(list(map(lambda t: float(t), filter(lambda n: n and not n.isspace(), line[1:]))), dtype=np.float32)
+                if emb_len is None:
+                    emb_len = len(vector)
+                elif len(vector) != emb_len:
+                    raise ValueError('%s: vector of %s has %d dimensions, expected %d' % (emb_file, line[0], len(vector), emb_len))
+                vector.tofile(fbin)
+                fvocab.write(line[0] + '\n')
+                rows += 1
+    os.replace(cache_prefix + '.bin.tmp', cache_prefix + '.bin')
+    os.replace(cache_prefix + '.vocab.tmp', cache_prefix + '.vocab')
+    with open(cache_prefix + '.json', 'w') as f:
+        json.dump({'source': os.path.abspath(emb_file), 'size': stamp.st_size, 'mtime': stamp.st_mtime,
+                   'delimiter': delimiter, 'rows': rows, 'emb_len': emb_len or 0}, f)
+
+def load_embedding_cache(emb_file, delimiter, cache_prefix):
+    """
+    words and memory-mapped [rows, emb_len] matrix of an embedding file, (re)converting it when the cache is missing or stale
+    """
+    stamp = os.stat(emb_file)
+    meta = None
+    if os.path.exists(cache_prefix + '.json'):
+        with open(cache_prefix + '.json', 'r') as f:
+            meta = json.load(f)
+    if meta is None or (meta['size'], meta['mtime'], meta['delimiter']) != (stamp.st_size, stamp.st_mtime, delimiter):
+        convert_embedding(emb_file, delimiter, cache_prefix)
+        with open(cache_prefix + '.json', 'r') as f:
+            meta = json.load(f)
+    with open(cache_prefix + '.vocab', 'r') as f:
+        words = f.read().split('\n')[:meta['rows']]
+    if meta['rows'] == 0:
+        return words, np.zeros((0, meta['emb_len']), dtype=np.float32)
+    return words, np.memmap(cache_prefix + '.bin', dtype=np.float32, mode='r', shape=(meta['rows'], meta['emb_len']))
+
+def load_embedding_wlm(emb_file, delimiter, feature_map, full_feature_set, caseless, unk, emb_len, shrink_to_train=False, shrink_to_corpus=False, cache_prefix=None):
 
     if caseless:
         feature_set = set([key.lower() for key in feature_map])
@@ -297,34 +500,61 @@ def load_embedding_wlm(emb_file, delimiter, feature_map, full_feature_set, casel
     rand_embedding_tensor = torch.FloatTensor(in_doc_freq_num, emb_len)
     init_embedding(rand_embedding_tensor)
 
-    indoc_embedding_array = list()
     indoc_word_array = list()
-    outdoc_embedding_array = list()
     outdoc_word_array = list()
 
-    for line in open(emb_file, 'r'):
-        line = line.split(delimiter)
-        if len(line) > 2:
-            vector = list(map(lambda t: float(t), filter(lambda n: n and not n.isspace(), line[1:])))
-
-            if shrink_to_train and line[0] not in feature_set:
+    if cache_prefix:
+        # same selection as the text loop below, as row indices into the memory-mapped matrix
+        emb_words, emb_matrix = load_embedding_cache(emb_file, delimiter, cache_prefix)
+        known_rows = dict()
+        indoc_rows = list()
+        outdoc_rows = list()
+        for row, word in enumerate(emb_words):
+            if shrink_to_train and word not in feature_set:
                 continue
 
-            if line[0] == unk:
-                rand_embedding_tensor[0] = torch.FloatTensor(vector)  # unk is 0
-            elif line[0] in word_dict:
-                rand_embedding_tensor[word_dict[line[0]]] = torch.FloatTensor(vector)
-            elif line[0] in full_feature_set:
-                indoc_embedding_array.append(vector)
-                indoc_word_array.append(line[0])
+            if word == unk:
+                known_rows[0] = row
+            elif word in word_dict:
+                known_rows[word_dict[word]] = row
+            elif word in full_feature_set:
+                indoc_rows.append(row)
+                indoc_word_array.append(word)
             elif not shrink_to_corpus:
-                outdoc_word_array.append(line[0])
-                outdoc_embedding_array.append(vector)
+                outdoc_rows.append(row)
+                outdoc_word_array.append(word)
 
-    embedding_tensor_0 = torch.FloatTensor(np.asarray(indoc_embedding_array))
+        if known_rows:
+            rand_embedding_tensor[torch.LongTensor(list(known_rows.keys()))] = torch.from_numpy(emb_matrix[list(known_rows.values())])
+        embedding_tensor_0 = torch.from_numpy(emb_matrix[indoc_rows])
+        embedding_tensor_1 = torch.from_numpy(emb_matrix[outdoc_rows])
+    else:
+        indoc_embedding_array = list()
+        outdoc_embedding_array = list()
+
+        for line in open(emb_file, 'r'):
+            line = line.split(delimiter)
+            if len(line) > 2:
+                vector = list(map(lambda t: float(t), filter(lambda n: n and not n.isspace(), line[1:])))
+
+                if shrink_to_train and line[0] not in feature_set:
+                    continue
+
+                if line[0] == unk:
+                    rand_embedding_tensor[0] = torch.FloatTensor(vector)  # unk is 0
+                elif line[0] in word_dict:
+                    rand_embedding_tensor[word_dict[line[0]]] = torch.FloatTensor(vector)
+                elif line[0] in full_feature_set:
+                    indoc_embedding_array.append(vector)
+                    indoc_word_array.append(line[0])
+                elif not shrink_to_corpus:
+                    outdoc_word_array.append(line[0])
+                    outdoc_embedding_array.append(vector)
+
+        embedding_tensor_0 = torch.FloatTensor(np.asarray(indoc_embedding_array))
+        embedding_tensor_1 = torch.FloatTensor(np.asarray(outdoc_embedding_array))
 
     if not shrink_to_corpus:
-        embedding_tensor_1 = torch.FloatTensor(np.asarray(outdoc_embedding_array))
         word_emb_len = embedding_tensor_0.size(1)
         assert (word_emb_len == emb_len)
 
@@ -342,40 +572,30 @@ def load_embedding_wlm(emb_file, delimiter, feature_map, full_feature_set, casel
 
     return word_dict, embedding_tensor
 
-def calc_threshold_mean(features):
-
-    lines_len = list(map(lambda t: len(t) + 1, features))
-    average = int(sum(lines_len) / len(lines_len))
-    lower_line = list(filter(lambda t: t < average, lines_len))
-    upper_line = list(filter(lambda t: t >= average, lines_len))
-    lower_average = int(sum(lower_line) / len(lower_line))
-    upper_average = int(sum(upper_line) / len(upper_line))
-    max_len = max(lines_len)
-    return [lower_average, average, upper_average, max_len]
+def append_cache_words(word_dict, emb_words, unk):
+    """
+    give the words of an embedding cache missing from word_dict the next ids, in file order
 
+    returns the IntTensor of their rows in the cache, the frozen_rows of a PagedEmbedding
+    """
+    rows = list()
+    for row, word in enumerate(emb_words):
+        if word != unk and word not in word_dict:
+            word_dict[word] = len(word_dict)
+            rows.append(row)
+    return torch.IntTensor(rows)
 
-def construct_dataset(input_features, input_label, input_action, word_dict, label_dict, action_dict, singleton, singleton_rate, caseless):
+def construct_dataset(input_features, input_label, input_action, word_dict, label_dict, action_dict, caseless):
 
     if caseless:
         input_features = list(map(lambda t: list(map(lambda x: x, t)), input_features))
-    features = encode_safe(input_features, word_dict, word_dict['<unk>'], singleton, singleton_rate)
+    features = encode_safe_predict(input_features, word_dict, word_dict['<unk>'])
     labels = encode(input_label, label_dict)
     actions = encode(input_action, action_dict)
-    thresholds = calc_threshold_mean(actions)
-
-    buckets = [[[], [], []] for _ in range(len(thresholds))]
-    for feature, label, action in zip(features, labels, actions):
-        cur_len = len(action)
-        cur_sent_len = len(feature)
-        idx = 0
-        cur_len_1 = cur_len + 1
-        while thresholds[idx] < cur_len_1:
-            idx += 1
-        buckets[idx][0].append(feature + [word_dict['<eof>']] * (thresholds[idx] - cur_sent_len))
-        buckets[idx][1].append(label + [label_dict['<pad>']] * (thresholds[idx] - cur_sent_len))
-        buckets[idx][2].append(action + [action_dict['<pad>']] * (thresholds[idx] - cur_len))
-
-    dataset = [TransitionDataset(torch.LongTensor(bucket[0]), torch.LongTensor(bucket[1]), torch.LongTensor(bucket[2])) for bucket in buckets]
+
+    # unpadded, TransitionCollate pads each batch to its own longest sentence
+    dataset = TransitionDataset([torch.LongTensor(feature) for feature in features], [torch.LongTensor(label) for label in labels],
+                                [torch.LongTensor(action) for action in actions])
 
     return dataset
 
@@ -391,6 +611,21 @@ def construct_dataset_predict(input_features, word_dict, caseless):
     return dataset
 
 
+def corpus_cache_key(content_files, stamped_files, settings):
+    """
+    sha1 over the contents of content_files, the path, size and mtime of stamped_files and the json of settings
+    """
+    sha = hashlib.sha1()
+    for path in content_files:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+    for path in stamped_files:
+        stamp = os.stat(path)
+        sha.update(json.dumps([os.path.abspath(path), stamp.st_size, stamp.st_mtime]).encode('utf-8'))
+    sha.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    return sha.hexdigest()
+
 def save_checkpoint(state, track_list, filename):
 
     with open(filename+'.json', 'w') as f:
@@ -461,4 +696,15 @@ def repack_vb(if_cuda, feature, label, action):
         fea_v = torch.autograd.Variable(feature)
         label_v = torch.autograd.Variable(label).contiguous()
         action_v = torch.autograd.Variable(action).contiguous()
-    return fea_v, label_v, action_v
\ No newline at end of file
+    return fea_v, label_v, action_v
+
+def reverse_padded(batch, lengths):
+    """
+    reverse the first lengths[b] positions of every row b of a [batch_size, max_len, ...] tensor, the padding
+    after them stays in place
+    """
+    positions = torch.arange(batch.size(1), device=lengths.device).unsqueeze(0)
+    lengths = lengths.unsqueeze(1)
+    index = torch.where(positions < lengths, lengths - 1 - positions, positions)
+    index = index.view(tuple(index.size()) + (1,) * (batch.dim() - 2)).expand_as(batch)
+    return batch.gather(1, index.to(batch.device))
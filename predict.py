@@ -9,6 +9,9 @@ import codecs
 from model.stack_lstm import *
 import model.utils as utils
 import model.evaluate as evaluate
+import model.profiling as profiling
+from model.bundle import load_bundle
+from model.predictor import load_checkpoint
 
 import argparse
 import json
@@ -25,45 +28,48 @@ if __name__ == "__main__":
     parser.add_argument('--spelling', default=False, help='use spelling or not')
     parser.add_argument('--load_check_point', default='./checkpoint/ner_stack_lstm.model',
                         help='checkpoint path')
+    parser.add_argument('--bundle', default='',
+                        help='inference bundle directory written by export.py --format bundle, replaces --load_arg and --load_check_point')
     parser.add_argument('--gpu', type=int, default=0, help='gpu id')
     parser.add_argument('--mode', choices=['train', 'predict'], default='predict', help='mode selection')
     parser.add_argument('--test_file', default='test.txt',
                         help='path to test file, if set to none, would use test_file path in the checkpoint file')
     parser.add_argument('--test_file_out', default='test_out.txt',
                         help='path to test file output, if set to none, would use test_file path in the checkpoint file')
+    parser.add_argument('--beam', type=int, default=1, help='beam width, 1 for greedy decoding')
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help='sentences decoded together, sentences of a batch are padded to the same length')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='decode batches in this many processes sharing the model weights (cpu only), output keeps the input order')
+    parser.add_argument('--char_cache', type=int, default=0,
+                        help='cache char-level representations of this many words in a dense table, the most frequent ones of '
+                             '--train_file, or the lowest word ids without it (0 disables the cache)')
+    parser.add_argument('--char_cache_lru', type=int, default=10000,
+                        help='number of cached char-level representations for the remaining words')
+    parser.add_argument('--train_file', default='', help='training corpus whose word counts choose the words of --char_cache')
+    parser.add_argument('--quantize', action='store_true',
+                        help='run the lstm and linear layers with dynamically quantized int8 weights (cpu only)')
+    parser.add_argument('--fused_cells', action='store_true',
+                        help='greedy decoding updates the stack, output and action lstms of a step with one batched matmul (float weights only)')
+    parser.add_argument('--profile', default='',
+                        help='time the phases of every decoded batch and write per-batch / total reports to this json lines file')
     args = parser.parse_args()
+    if args.quantize and args.gpu >= 0:
+        raise ValueError('int8 quantized inference runs on the cpu only, use --gpu -1')
+    if args.quantize and args.fused_cells:
+        raise ValueError('--fused_cells stacks the float weights, it cannot be combined with --quantize')
+    if args.profile and args.workers > 1:
+        raise ValueError('--profile measures decoding in this process, use --workers 1')
 
-    with open(args.load_arg, 'r') as f:
-        jd = json.load(f)
-    jd = jd['args']
-
-    checkpoint_file = torch.load(args.load_check_point, map_location=lambda storage, loc: storage)
-    f_map = checkpoint_file['f_map']
-    l_map = checkpoint_file['l_map']
-    a_map = checkpoint_file['a_map']
-    ner_map = checkpoint_file['ner_map']
-    char_map = dict()
     if args.gpu >= 0:
         torch.cuda.set_device(args.gpu)
 
-    # load corpus
-    with codecs.open(args.test_file, 'r', 'utf-8') as f:
-        test_lines = f.readlines()
-
-
-    # converting format
-    test_features = utils.read_corpus_predict(test_lines)
-
-    # construct dataset
-    test_dataset = utils.construct_dataset_predict(test_features, f_map, jd['caseless'])
-
-    test_dataset_loader = [torch.utils.data.DataLoader(test_dataset, shuffle=False, drop_last=False)]
-
-    # build model
-    ner_model = TransitionNER(args.mode, a_map, f_map, l_map, char_map, ner_map, len(f_map), len(a_map), jd['embedding_dim'], jd['action_embedding_dim'], jd['char_embedding_dim'], jd['hidden'], jd['char_hidden'],
-                              jd['layers'], jd['drop_out'], args.spelling, jd['char_structure'], is_cuda=args.gpu)
-
-    ner_model.load_state_dict(checkpoint_file['state_dict'])
+    if args.bundle:
+        ner_model, maps = load_bundle(args.bundle, args.gpu, args.mode)
+        f_map, a_map = maps['f_map'], maps['a_map']
+    else:
+        ner_model, checkpoint_file = load_checkpoint(args.load_arg, args.load_check_point, args.gpu, args.spelling, mode=args.mode)
+        f_map, a_map = checkpoint_file['f_map'], checkpoint_file['a_map']
 
     if args.gpu >= 0:
         if_cuda = True
@@ -71,7 +77,33 @@ if __name__ == "__main__":
         ner_model.cuda()
     else:
         if_cuda = False
-    file_out = codecs.open(args.test_file_out, "w+", encoding="utf-8")
-    evaluate.generate_ner(ner_model, file_out, test_dataset_loader, a_map, f_map, args.gpu)
+    if args.quantize:
+        ner_model.eval()
+        ner_model = ner_model.quantize()
+    if args.char_cache > 0:
+        word_count = None
+        if args.train_file:
+            with codecs.open(args.train_file, 'r', 'utf-8') as f:
+                word_count = utils.read_corpus_ner(f, dict())[3]
+        ner_model.enable_char_cache(args.char_cache, args.char_cache_lru, word_count)
+    if args.fused_cells:
+        ner_model.enable_fused_cells()
+    if args.profile:
+        profiler = profiling.Profiler(synchronize=if_cuda)
+        ner_model.enable_profiler(profiler)
+        profile_file = codecs.open(args.profile, 'w', 'utf-8')
+
+    # stream the corpus: read, encode, decode and write one batch at a time
+    with codecs.open(args.test_file, 'r', 'utf-8') as f, codecs.open(args.test_file_out, "w+", encoding="utf-8") as file_out:
+        test_batches = utils.iter_batches_predict(utils.iter_corpus_predict(f), f_map, args.batch_size)
+        if args.profile:
+            test_batches = profiler.batches(test_batches, lambda report: profile_file.write(json.dumps(dict(report, type='batch')) + '\n'))
+        evaluate.generate_ner(ner_model, file_out, [test_batches], a_map, f_map, if_cuda, args.beam, args.workers)
+
+    if args.profile:
+        report = profiler.end_epoch()
+        profile_file.write(json.dumps(dict(report, type='total')) + '\n')
+        profile_file.close()
+        print('profile: ' + profiling.format_report(report))
 
 
@@ -0,0 +1,213 @@
+"""
+HTTP inference service for a trained Stack-LSTM NER model
+
+    python serve.py --load_arg checkpoint/ner_stack_lstm.json --load_check_point checkpoint/ner_stack_lstm.model
+
+POST /predict  {"sentences": [["John", "lives", "in", "New", "York"], ...]}
+           ->  {"entities": [[{"start": 0, "end": 1, "type": "PER", "text": "John"}, ...], ...]}
+GET  /stats    queue depth, request / batch counters and p50 / p99 latency in milliseconds
+
+concurrent requests are gathered into micro-batches of at most --max_batch_size sentences, a batch is
+decoded as soon as it is full or --max_wait_ms after its first request arrived
+"""
+from __future__ import print_function
+import argparse
+import codecs
+import collections
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from model.predictor import Predictor
+import model.utils as utils
+
+
+class PendingRequest(object):
+
+    def __init__(self, sentences):
+        self.sentences = sentences
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.entities = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    """
+    a single worker thread draining a request queue into micro-batches
+    """
+    def __init__(self, predictor, max_batch_size, max_wait_ms, latency_window=10000):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.requests = queue.Queue()
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.sentence_count = 0
+        self.batch_count = 0
+        self.worker = threading.Thread(target=self._run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def submit(self, sentences):
+        request = PendingRequest(sentences)
+        self.requests.put(request)
+        request.done.wait()
+        with self.lock:
+            self.latencies.append(time.time() - request.arrival)
+        if request.error is not None:
+            raise request.error
+        return request.entities
+
+    def _gather(self):
+        batch = [self.requests.get()]
+        n_sentences = len(batch[0].sentences)
+        deadline = batch[0].arrival + self.max_wait
+        while n_sentences < self.max_batch_size:
+            # requests already queued join the batch even once the deadline has passed
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    request = self.requests.get(timeout=timeout)
+                else:
+                    request = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(request)
+            n_sentences += len(request.sentences)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._gather()
+            sentences = [sentence for request in batch for sentence in request.sentences]
+            try:
+                entities = []
+                for start in range(0, len(sentences), self.max_batch_size):
+                    entities.extend(self.predictor.predict_entities(sentences[start:start + self.max_batch_size]))
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+                    request.done.set()
+                continue
+            with self.lock:
+                self.request_count += len(batch)
+                self.sentence_count += len(sentences)
+                self.batch_count += 1
+            offset = 0
+            for request in batch:
+                request.entities = entities[offset:offset + len(request.sentences)]
+                offset += len(request.sentences)
+                request.done.set()
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = {'queue_depth': self.requests.qsize(),
+                     'requests': self.request_count,
+                     'sentences': self.sentence_count,
+                     'batches': self.batch_count,
+                     'mean_batch_size': self.sentence_count / float(max(self.batch_count, 1))}
+        for name, q in (('p50_ms', 0.5), ('p99_ms', 0.99)):
+            stats[name] = 1000 * latencies[min(int(q * len(latencies)), len(latencies) - 1)] if latencies else None
+        return stats
+
+
+def parse_sentences(body):
+    sentences = json.loads(body.decode('utf-8'))['sentences']
+    if not isinstance(sentences, list) or not all(isinstance(s, list) and all(isinstance(w, str) for w in s) for s in sentences):
+        raise ValueError('"sentences" must be a list of token lists')
+    return sentences
+
+
+def make_handler(batcher):
+
+    class Handler(BaseHTTPRequestHandler):
+        disable_nagle_algorithm = True
+
+        def _reply(self, code, content):
+            body = json.dumps(content).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, batcher.stats())
+            else:
+                self._reply(404, {'error': 'unknown path %s' % self.path})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._reply(404, {'error': 'unknown path %s' % self.path})
+                return
+            try:
+                sentences = parse_sentences(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except (ValueError, KeyError, TypeError) as e:
+                self._reply(400, {'error': str(e)})
+                return
+            try:
+                entities = batcher.submit(sentences)
+            except Exception as e:
+                self._reply(500, {'error': str(e)})
+                return
+            self._reply(200, {'entities': [[{'start': start, 'end': end, 'type': ent_type, 'text': ' '.join(sentence[start:end])}
+                                            for start, end, ent_type in sent_entities]
+                                           for sentence, sent_entities in zip(sentences, entities)]})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serving Stack-LSTM')
+    parser.add_argument('--load_arg', default='./checkpoint/ner_stack_lstm.json', help='arg json file path')
+    parser.add_argument('--load_check_point', default='./checkpoint/ner_stack_lstm.model', help='checkpoint path')
+    parser.add_argument('--spelling', default=False, help='use spelling or not')
+    parser.add_argument('--bundle', default='',
+                        help='inference bundle directory written by export.py --format bundle, replaces --load_arg and --load_check_point')
+    parser.add_argument('--gpu', type=int, default=-1, help='gpu id, -1 for cpu')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on')
+    parser.add_argument('--max_batch_size', type=int, default=32, help='maximum number of sentences decoded together')
+    parser.add_argument('--max_wait_ms', type=float, default=5.0,
+                        help='maximum time the first request of a batch waits for others to join it')
+    parser.add_argument('--beam', type=int, default=1, help='beam width, 1 for greedy decoding')
+    parser.add_argument('--char_cache', type=int, default=0,
+                        help='cache char-level representations of this many words in a dense table, the most frequent ones of '
+                             '--train_file, or the lowest word ids without it (0 disables the cache)')
+    parser.add_argument('--char_cache_lru', type=int, default=10000,
+                        help='number of cached char-level representations for the remaining words')
+    parser.add_argument('--train_file', default='', help='training corpus whose word counts choose the words of --char_cache')
+    parser.add_argument('--quantize', action='store_true',
+                        help='run the lstm and linear layers with dynamically quantized int8 weights (cpu only)')
+    parser.add_argument('--fused_cells', action='store_true',
+                        help='greedy decoding updates the stack, output and action lstms of a step with one batched matmul (float weights only)')
+    args = parser.parse_args()
+
+    word_count = None
+    if args.char_cache > 0 and args.train_file:
+        with codecs.open(args.train_file, 'r', 'utf-8') as f:
+            word_count = utils.read_corpus_ner(f, dict())[3]
+    predictor = Predictor(args.load_arg, args.load_check_point, args.gpu, args.spelling, args.beam, args.char_cache, args.char_cache_lru,
+                          args.quantize, args.bundle, args.fused_cells, word_count)
+    batcher = MicroBatcher(predictor, args.max_batch_size, args.max_wait_ms)
+    server = ThreadingServer((args.host, args.port), make_handler(batcher))
+    print('serving on http://%s:%d' % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
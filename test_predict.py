@@ -0,0 +1,44 @@
+import codecs
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_predict(checkpoint, test_file, out_file, *options):
+    arg_file, model_file = checkpoint
+    subprocess.check_call([sys.executable, os.path.join(ROOT, 'predict.py'), '--gpu', '-1', '--spelling', 'True', '--load_arg', arg_file,
+                           '--load_check_point', model_file, '--test_file', test_file, '--test_file_out', out_file] + list(options),
+                          cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    with codecs.open(out_file, 'r', 'utf-8') as f:
+        return f.read()
+
+
+@pytest.fixture(scope='module')
+def one_by_one(workload, checkpoint, tmp_path_factory):
+    return run_predict(checkpoint, workload.predict_file, str(tmp_path_factory.mktemp('predict') / 'out.txt'), '--batch_size', '1')
+
+
+def test_entities_are_found(one_by_one, workload):
+    entity_lines = [line for line in one_by_one.split('\n') if line.startswith('Entities: ') and line.strip() != 'Entities:']
+    assert len(entity_lines) > 0
+    assert one_by_one.count('Entities: ') == len(workload.features)
+
+
+@pytest.mark.parametrize('options', [['--batch_size', '7'], ['--batch_size', '32'], ['--batch_size', '16', '--workers', '2']])
+def test_output_does_not_depend_on_batching(one_by_one, workload, checkpoint, tmp_path, options):
+    assert run_predict(checkpoint, workload.predict_file, str(tmp_path / 'out.txt'), *options) == one_by_one
+
+
+@pytest.mark.parametrize('option, message', [(['--gpu', '0'], 'cpu only'), (['--gpu', '-1', '--fused_cells'], 'cannot be combined with --quantize')])
+def test_quantize_rejects(workload, checkpoint, tmp_path, option, message):
+    arg_file, model_file = checkpoint
+    result = subprocess.run([sys.executable, os.path.join(ROOT, 'predict.py'), '--quantize'] + option + ['--load_arg', arg_file,
+                             '--load_check_point', model_file, '--test_file', workload.predict_file, '--test_file_out', str(tmp_path / 'out.txt')],
+                            cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode != 0
+    assert message in result.stderr
+    assert not (tmp_path / 'out.txt').exists()
@@ -0,0 +1,76 @@
+import json
+import threading
+import urllib.request
+
+import pytest
+
+from model.predictor import Predictor
+from serve import MicroBatcher, ThreadingServer, make_handler
+
+
+@pytest.fixture(scope='module')
+def predictor(checkpoint):
+    return Predictor(checkpoint[0], checkpoint[1], spelling=True)
+
+
+@pytest.fixture(scope='module')
+def alone(predictor, workload):
+    """
+    entities of every sentence decoded on its own
+    """
+    return [predictor.predict_entities([sentence])[0] for sentence in workload.features]
+
+
+def submit_concurrently(submit, sentences, per_request):
+    requests = [sentences[start:start + per_request] for start in range(0, len(sentences), per_request)]
+    responses = [None] * len(requests)
+
+    def send(index):
+        responses[index] = submit(requests[index])
+
+    threads = [threading.Thread(target=send, args=(index,)) for index in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [entities for response in responses for entities in response]
+
+
+def test_entities_are_found(alone):
+    assert any(alone)
+
+
+@pytest.mark.parametrize('per_request', [1, 3])
+def test_micro_batches_match_sentences_alone(predictor, workload, alone, per_request):
+    batcher = MicroBatcher(predictor, max_batch_size=8, max_wait_ms=50)
+    assert submit_concurrently(batcher.submit, workload.features, per_request) == alone
+    stats = batcher.stats()
+    assert stats['sentences'] == len(workload.features)
+    assert stats['mean_batch_size'] > 1
+
+
+def test_http_response_matches_sentence_alone(predictor, workload, alone):
+    server = ThreadingServer(('127.0.0.1', 0), make_handler(MicroBatcher(predictor, max_batch_size=16, max_wait_ms=20)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%d/predict' % server.server_address[1]
+
+    def post(sentences):
+        request = urllib.request.Request(url, json.dumps({'sentences': sentences}).encode('utf-8'), {'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read().decode('utf-8'))['entities']
+
+    try:
+        responses = submit_concurrently(post, workload.features, 4)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert [[(e['start'], e['end'], e['type']) for e in entities] for entities in responses] == \
+        [[tuple(entity) for entity in entities] for entities in alone]
+    for sentence, entities in zip(workload.features, responses):
+        assert all(e['text'] == ' '.join(sentence[e['start']:e['end']]) for e in entities)
+
+
+@pytest.mark.parametrize('option, message', [({'gpu': 0}, 'cpu only'), ({'fused_cells': True}, 'cannot be combined with quantize')])
+def test_quantized_predictor_rejects(checkpoint, option, message):
+    with pytest.raises(ValueError, match=message):
+        Predictor(checkpoint[0], checkpoint[1], quantize=True, **option)
@@ -0,0 +1,107 @@
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+import torch
+
+import train
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_train(workload, checkpoint, *options):
+    args = workload.args
+    output = subprocess.check_output([sys.executable, os.path.join(ROOT, 'train.py'), '--gpu', '-1', '--train_file', workload.conll_file,
+                                      '--dev_file', workload.conll_file, '--test_file', workload.conll_file, '--emb_file', workload.emb_file,
+                                      '--embedding_dim', str(args.embedding_dim), '--hidden', str(args.hidden), '--char_hidden', str(args.char_hidden),
+                                      '--char_embedding_dim', str(args.char_embedding_dim), '--action_embedding_dim', str(args.action_embedding_dim),
+                                      '--batch_tokens', str(args.batch_tokens), '--batch_size', str(args.batch_size), '--lr', '0.01',
+                                      '--checkpoint', checkpoint] + list(options), cwd=ROOT, stderr=subprocess.DEVNULL)
+    return output.decode('utf-8')
+
+
+@pytest.mark.parametrize('eva_matrix', ['a', 'fa'])
+def test_early_stop_keeps_pending_evaluations(workload, tmp_path, eva_matrix):
+    checkpoint = str(tmp_path / 'ner_')
+    # stops after the first epoch, while --async_eval is still scoring it
+    output = run_train(workload, checkpoint, '--epoch', '5', '--patience', '0', '--least_iters', '0', '--async_eval', '--eva_matrix', eva_matrix)
+    assert re.findall(r'epoch: (\d+)\t in', output) == ['0']
+    assert re.findall(r'\(loss: [\d.]+, epoch: (\d+),.*saving\.\.\.', output) == ['0']
+    assert checkpoint + ' dev_' in output
+    saved = torch.load(checkpoint + 'stack_lstm.model', map_location='cpu', weights_only=False)
+    assert saved['epoch'] == 0
+    with open(checkpoint + 'stack_lstm.json') as f:
+        assert len(json.load(f)['track_list']) == 1
+
+
+def test_accuracy_needs_gold_actions(workload, tmp_path):
+    with pytest.raises(subprocess.CalledProcessError):
+        run_train(workload, str(tmp_path / 'ner_'), '--epoch', '1', '--eva_matrix', 'a', '--mode', 'predict')
+
+
+def corpus_args(workload, corpus_cache, **settings):
+    """
+    the train.py arguments prepare_corpus reads, with their defaults and the synthetic corpus as train / dev / test
+    """
+    args = dict(train_file=workload.conll_file, dev_file=workload.conll_file, test_file=workload.conll_file, emb_file=workload.emb_file,
+                emb_cache='', paged_embedding=0, rand_embedding=False, shrink_embedding=False, mini_count=1, caseless=True, unk='unk',
+                embedding_dim=workload.args.embedding_dim, corpus_cache=corpus_cache, corpus_workers=1)
+    args.update(settings)
+    return argparse.Namespace(**args)
+
+
+def assert_same_corpus(corpus, expected):
+    assert sorted(corpus) == sorted(expected)
+    for name in ['f_map', 'l_map', 'a_map', 'char_map', 'ner_map', 'sentences']:
+        assert corpus[name] == expected[name], name
+    assert torch.equal(corpus['embedding'], expected['embedding'])
+    assert torch.equal(corpus['singleton_mask'], expected['singleton_mask'])
+    for split in ['train', 'dev', 'test']:
+        for field in ['data_tensor', 'label_tensor', 'action_tensor']:
+            cached, built = getattr(corpus[split], field), getattr(expected[split], field)
+            assert len(cached) == len(built) and all(torch.equal(a, b) for a, b in zip(cached, built)), (split, field)
+
+
+def test_cached_corpus_matches_a_fresh_build(workload, tmp_path, capsys):
+    cache = str(tmp_path / 'cache')
+    fresh = train.prepare_corpus(corpus_args(workload, cache))
+    assert 'saved preprocessed corpus' in capsys.readouterr().out
+    assert_same_corpus(train.prepare_corpus(corpus_args(workload, cache)), fresh)
+    assert 'loading preprocessed corpus' in capsys.readouterr().out
+    assert len(os.listdir(cache)) == 1
+
+    # other preprocessing flags are another entry
+    train.prepare_corpus(corpus_args(workload, cache, mini_count=2))
+    assert 'saved preprocessed corpus' in capsys.readouterr().out
+    assert len(os.listdir(cache)) == 2
+
+
+@pytest.mark.parametrize('saved_before', [False, True])
+def test_training_resumes_from_a_checkpoint(workload, tmp_path, saved_before):
+    # dev and test hold only the first sentences, so words seen once in the training file are singletons
+    with open(workload.conll_file) as f:
+        first = '\n\n'.join(f.read().split('\n\n')[:20]) + '\n\n'
+    dev_file = str(tmp_path / 'dev.txt')
+    with open(dev_file, 'w') as f:
+        f.write(first)
+    corpora = ['--dev_file', dev_file, '--test_file', dev_file, '--epoch', '1']
+    checkpoint = str(tmp_path / 'ner_')
+    run_train(workload, checkpoint, *corpora)
+    saved = torch.load(checkpoint + 'stack_lstm.model', map_location='cpu', weights_only=False)
+    assert saved['singleton_mask'].any()
+    if saved_before:
+        # checkpoints written before the char map and the singleton mask were saved
+        older = {name: value for name, value in saved.items() if name not in ['char_map', 'singleton_mask']}
+        torch.save(older, checkpoint + 'older.model')
+    resumed = str(tmp_path / 'resumed_')
+    output = run_train(workload, resumed, *corpora, '--load_check_point', checkpoint + ('older.model' if saved_before else 'stack_lstm.model'))
+    # training restarts at the epoch of the checkpoint
+    assert re.findall(r'epoch: (\d+)\t in', output) == [str(saved['epoch'])]
+    resaved = torch.load(resumed + 'stack_lstm.model', map_location='cpu', weights_only=False)
+    for name in ['f_map', 'l_map', 'a_map', 'char_map', 'ner_map']:
+        assert resaved[name] == saved[name], name
+    assert torch.equal(resaved['singleton_mask'], saved['singleton_mask'])
@@ -9,6 +9,8 @@ import codecs
 from model.stack_lstm import *
 import model.utils as utils
 import model.evaluate as evaluate
+from model.data_parallel import DataParallel
+import model.profiling as profiling
 import logging.handlers
 import math
 
@@ -21,15 +23,140 @@ import itertools
 import functools
 
 
+def prepare_corpus(args, checkpoint_file=None):
+    """
+    coding tables, embedding and datasets of the train / dev / test files of args as a dict, with the maps,
+    singleton_mask and frozen_rows of checkpoint_file when resuming from it
+
+    with --corpus_cache the result is saved under a hash of the input files and preprocessing settings and loaded
+    back as long as they are unchanged
+    """
+    cache_file = None
+    if args.corpus_cache and checkpoint_file is None:
+        cache_settings = {'version': 3, 'mini_count': args.mini_count, 'caseless': args.caseless,
+                          'shrink_embedding': args.shrink_embedding, 'rand_embedding': args.rand_embedding,
+                          'emb_file': args.emb_file, 'unk': args.unk, 'embedding_dim': args.embedding_dim,
+                          'paged_embedding': args.paged_embedding > 0}
+        cache_key = utils.corpus_cache_key([args.train_file, args.dev_file, args.test_file],
+                                           [] if args.rand_embedding else [args.emb_file], cache_settings)
+        cache_file = os.path.join(args.corpus_cache, cache_key + '.pt')
+
+    # cache rows of the words appended to f_map beyond the trainable embedding rows, with --paged_embedding
+    frozen_rows = None
+    embedding_tensor = None
+    if cache_file and os.path.isfile(cache_file):
+        print("loading preprocessed corpus: '{}'".format(cache_file))
+        cached = torch.load(cache_file)
+        for split in ['train', 'dev', 'test']:
+            cached[split] = utils.TransitionDataset(*cached[split])
+        print("%d train sentences" % cached['sentences'][0])
+        print("%d dev sentences" % cached['sentences'][1])
+        print("%d test sentences" % cached['sentences'][2])
+        return cached
+
+    # load corpus, converting format while streaming the files
+    print('loading corpus')
+    word_count = dict()
+    with codecs.open(args.dev_file, 'r', 'utf-8') as f:
+        dev_features, dev_labels, dev_actions, word_count = utils.read_corpus_ner(f, word_count, args.corpus_workers)
+    with codecs.open(args.test_file, 'r', 'utf-8') as f:
+        test_features, test_labels, test_actions, word_count = utils.read_corpus_ner(f, word_count, args.corpus_workers)
+
+
+    if checkpoint_file is None:
+        print('constructing coding table')
+    with codecs.open(args.train_file, 'r', 'utf-8') as f:
+        train_features, train_labels, train_actions, f_map, l_map, a_map, char_map, ner_map, singleton = utils.generate_corpus(f, word_count,
+                                                                                                if_shrink_feature=True,
+                                                                                                thresholds=0,
+                                                                                                workers=args.corpus_workers)
+
+    if checkpoint_file is not None:
+        # the coding tables the model was trained with, checkpoints written before the char map was saved use the one just built
+        frozen_rows = checkpoint_file['state_dict'].get('word_embeds.frozen_rows')
+        f_map, l_map, a_map, ner_map = [checkpoint_file[name] for name in ['f_map', 'l_map', 'a_map', 'ner_map']]
+        char_map = checkpoint_file.get('char_map', char_map)
+    else:
+        f_set = {v for v in f_map}
+        f_map = utils.shrink_features(f_map, train_features, args.mini_count)
+
+        dt_f_set = functools.reduce(lambda x, y: x | y, map(lambda t: set(t), dev_features),
+                                    f_set)  # Add word in dev and in test into feature_map
+        dt_f_set = functools.reduce(lambda x, y: x | y, map(lambda t: set(t), test_features), dt_f_set)
+        dt_f_set = functools.reduce(lambda x, y: x | y, map(lambda t: set(t), train_features), dt_f_set)
+
+        if not args.rand_embedding:
+            print("feature size: '{}'".format(len(f_map)))
+            print('loading embedding')
+            f_map = {'<eof>': 0}
+            f_map, embedding_tensor= utils.load_embedding_wlm(args.emb_file, ' ', f_map, dt_f_set,
+                                                                             args.caseless, args.unk,
+                                                                             args.embedding_dim,
+                                                                             shrink_to_corpus=args.shrink_embedding or args.paged_embedding > 0,
+                                                                             cache_prefix=args.emb_cache)
+            if args.paged_embedding > 0:
+                # the other words of the embedding file get ids, their rows stay in the cache
+                emb_words = utils.load_embedding_cache(args.emb_file, ' ', args.emb_cache)[0]
+                frozen_rows = utils.append_cache_words(f_map, emb_words, args.unk)
+            print("embedding size: '{}'".format(len(f_map)))
+
+        l_set = functools.reduce(lambda x, y: x | y, map(lambda t: set(t), dev_labels))
+        l_set = functools.reduce(lambda x, y: x | y, map(lambda t: set(t), test_labels), l_set)
+        for label in l_set:
+            if label not in l_map:
+                l_map[label] = len(l_map)
+
+    print("%d train sentences" % len(train_features))
+    print("%d dev sentences" % len(dev_features))
+    print("%d test sentences" % len(test_features))
+
+    # construct dataset
+    if checkpoint_file is not None and 'singleton_mask' in checkpoint_file:
+        singleton_mask = checkpoint_file['singleton_mask']
+    else:
+        singleton = list(functools.reduce(lambda x, y: x & y, map(lambda t: set(t), [singleton, f_map])))
+        singleton_mask = utils.build_singleton_mask(singleton, f_map)
+    dataset = utils.construct_dataset(train_features, train_labels, train_actions, f_map, l_map, a_map, args.caseless)
+    dev_dataset = utils.construct_dataset(dev_features, dev_labels, dev_actions, f_map, l_map, a_map, args.caseless)
+    test_dataset = utils.construct_dataset(test_features, test_labels, test_actions, f_map, l_map, a_map, args.caseless)
+
+
+    corpus = {'f_map': f_map, 'l_map': l_map, 'a_map': a_map, 'char_map': char_map, 'ner_map': ner_map,
+              'embedding': embedding_tensor,
+              'frozen_rows': frozen_rows,
+              'singleton_mask': singleton_mask,
+              'sentences': [len(train_features), len(dev_features), len(test_features)],
+              'train': dataset, 'dev': dev_dataset, 'test': test_dataset}
+    if cache_file:
+        if not os.path.isdir(args.corpus_cache):
+            os.makedirs(args.corpus_cache)
+        cached = dict(corpus)
+        for split in ['train', 'dev', 'test']:
+            cached[split] = [corpus[split].data_tensor, corpus[split].label_tensor, corpus[split].action_tensor]
+        torch.save(cached, cache_file + '.tmp')
+        os.replace(cache_file + '.tmp', cache_file)
+        print("saved preprocessed corpus: '{}'".format(cache_file))
+    return corpus
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Training transition-based NER system')
     parser.add_argument('--rand_embedding', action='store_true', help='random initialize word embedding')
     parser.add_argument('--emb_file', default='../embedding/sskip.100.vectors',
                         help='path to pre-trained embedding')
+    parser.add_argument('--emb_cache', default='',
+                        help='path prefix of a binary copy of emb_file, created on first use and memory-mapped afterwards (empty: parse the text file every run)')
+    parser.add_argument('--paged_embedding', type=int, default=0,
+                        help='leave the pre-trained rows of words outside the corpora on disk in --emb_cache and page them into a hot table of this many rows (0: hold the whole embedding in memory)')
+    parser.add_argument('--corpus_cache', default='',
+                        help='directory caching preprocessed corpora, coding tables and embedding by a hash of the input files and settings (empty: no cache)')
+    parser.add_argument('--corpus_workers', type=int, default=1, help='processes parsing the CoNLL files')
     parser.add_argument('--train_file', default='../data/conll2003/train.txt', help='path to training file')
     parser.add_argument('--dev_file', default='../data/conll2003/dev.txt', help='path to development file')
     parser.add_argument('--test_file', default='../data/conll2003/test.txt', help='path to test file')
-    parser.add_argument('--batch_size', type=int, default=100, help='batch size (10)')
+    parser.add_argument('--batch_size', type=int, default=100, help='maximum number of sentences in a batch')
+    parser.add_argument('--batch_tokens', type=int, default=2000,
+                        help='maximum padded size of a batch, counted as sentences x longest action sequence')
     parser.add_argument('--gpu', type=int, default=0, help='gpu id, set to -1 if use cpu mode')
     parser.add_argument('--unk', default='unk', help='unknow-token in pre-trained embedding')
     parser.add_argument('--checkpoint', default='./checkpoint/ner_', help='path to checkpoint prefix')
@@ -56,6 +183,13 @@ if __name__ == "__main__":
     parser.add_argument('--clip_grad', type=float, default=5.0, help='grad clip at')
     parser.add_argument('--mini_count', type=float, default=1, help='thresholds to replace rare words with <unk>')
     parser.add_argument('--eva_matrix', choices=['a', 'fa'], default='fa', help='use f1 and accuracy or accuracy alone')
+    parser.add_argument('--async_eval', action='store_true',
+                        help='evaluate on dev / test in a background process (on the cpu) while training goes on')
+    parser.add_argument('--dp_workers', type=int, default=1,
+                        help='data-parallel training processes on the cpu, each batch is split across them')
+    parser.add_argument('--dp_port', type=int, default=29500, help='local port of the data-parallel process group')
+    parser.add_argument('--profile', default='',
+                        help='time the phases of every training batch and write per-batch / per-epoch reports to this json lines file')
     parser.add_argument('--patience', type=int, default=15, help='patience for early stop')
     parser.add_argument('--least_iters', type=int, default=50, help='at least train how many epochs before stop')
     parser.add_argument('--shrink_embedding', action='store_true',
@@ -66,88 +200,55 @@ if __name__ == "__main__":
     print(args)
 
     if_cuda = True if args.gpu >= 0 else False
+    if 'f' not in args.eva_matrix and args.mode != 'train':
+        raise ValueError('--eva_matrix a scores the model following the gold actions, which needs --mode train')
+    if args.paged_embedding > 0 and (not args.emb_cache or args.rand_embedding or args.shrink_embedding):
+        raise ValueError('--paged_embedding pages rows in from --emb_cache, and needs the pre-trained embedding without --shrink_embedding')
 
-    # load corpus
-    print('loading corpus')
-    with codecs.open(args.train_file, 'r', 'utf-8') as f:
-        lines = f.readlines()
-    with codecs.open(args.dev_file, 'r', 'utf-8') as f:
-        dev_lines = f.readlines()
-    with codecs.open(args.test_file, 'r', 'utf-8') as f:
-        test_lines = f.readlines()
-
-    # converting format
-    word_count = dict()
-    dev_features, dev_labels, dev_actions, word_count = utils.read_corpus_ner(dev_lines, word_count)
-    test_features, test_labels, test_actions, word_count = utils.read_corpus_ner(test_lines, word_count)
-
-
+    checkpoint_file = None
     if args.load_check_point:
-        if os.path.isfile(args.load_check_point):
-            print("loading checkpoint: '{}'".format(args.load_check_point))
-            checkpoint_file = torch.load(args.load_check_point)
-            args.start_epoch = checkpoint_file['epoch']
-            f_map = checkpoint_file['f_map']
-            l_map = checkpoint_file['l_map']
-            train_features, train_labels, train_actions = utils.read_corpus_ner(lines)
-        else:
-            print("no checkpoint found at: '{}'".format(args.load_check_point))
-    else:
-        print('constructing coding table')
-
-        train_features, train_labels, train_actions, f_map, l_map, a_map, char_map, ner_map, singleton = utils.generate_corpus(lines, word_count,
-                                                                                                if_shrink_feature=True,
-                                                                                                thresholds=0)
-        f_set = {v for v in f_map}
-        f_map = utils.shrink_features(f_map, train_features, args.mini_count)
-
-        dt_f_set = functools.reduce(lambda x, y: x | y, map(lambda t: set(t), dev_features),
-                                    f_set)  # Add word in dev and in test into feature_map
-        dt_f_set = functools.reduce(lambda x, y: x | y, map(lambda t: set(t), test_features), dt_f_set)
-        dt_f_set = functools.reduce(lambda x, y: x | y, map(lambda t: set(t), train_features), dt_f_set)
-
-        if not args.rand_embedding:
-            print("feature size: '{}'".format(len(f_map)))
-            print('loading embedding')
-            f_map = {'<eof>': 0}
-            f_map, embedding_tensor= utils.load_embedding_wlm(args.emb_file, ' ', f_map, dt_f_set,
-                                                                             args.caseless, args.unk,
-                                                                             args.embedding_dim,
-                                                                             shrink_to_corpus=args.shrink_embedding)
-            print("embedding size: '{}'".format(len(f_map)))
-
-        l_set = functools.reduce(lambda x, y: x | y, map(lambda t: set(t), dev_labels))
-        l_set = functools.reduce(lambda x, y: x | y, map(lambda t: set(t), test_labels), l_set)
-        for label in l_set:
-            if label not in l_map:
-                l_map[label] = len(l_map)
-
-    print("%d train sentences" % len(train_features))
-    print("%d dev sentences" % len(dev_features))
-    print("%d test sentences" % len(test_features))
-
-    # construct dataset
-    singleton = list(functools.reduce(lambda x, y: x & y, map(lambda t: set(t), [singleton, f_map])))
-    dataset = utils.construct_dataset(train_features, train_labels, train_actions, f_map, l_map, a_map, singleton, args.singleton_rate, args.caseless)
-    dev_dataset = utils.construct_dataset(dev_features, dev_labels, dev_actions, f_map, l_map, a_map, singleton, args.singleton_rate, args.caseless)
-    test_dataset = utils.construct_dataset(test_features, test_labels, test_actions, f_map, l_map, a_map, singleton, args.singleton_rate, args.caseless)
-
-    dataset_loader = [torch.utils.data.DataLoader(tup, args.batch_size, shuffle=True, drop_last=False) for tup in dataset]
-    dev_dataset_loader = [torch.utils.data.DataLoader(tup, args.batch_size, shuffle=False, drop_last=False) for tup in dev_dataset]
-    test_dataset_loader = [torch.utils.data.DataLoader(tup, args.batch_size, shuffle=False, drop_last=False) for tup in test_dataset]
+        if not os.path.isfile(args.load_check_point):
+            raise ValueError("no checkpoint found at: '{}'".format(args.load_check_point))
+        print("loading checkpoint: '{}'".format(args.load_check_point))
+        checkpoint_file = torch.load(args.load_check_point)
+        args.start_epoch = checkpoint_file['epoch']
+
+    corpus = prepare_corpus(args, checkpoint_file)
+    f_map, l_map, a_map, char_map, ner_map = [corpus[name] for name in ['f_map', 'l_map', 'a_map', 'char_map', 'ner_map']]
+    embedding_tensor, frozen_rows, singleton_mask = corpus['embedding'], corpus['frozen_rows'], corpus['singleton_mask']
+    dataset, dev_dataset, test_dataset = corpus['train'], corpus['dev'], corpus['test']
+
+    # data-parallel processes must draw the same batches, so they shuffle from generators seeded alike
+    shuffle_generator = None
+    if args.dp_workers > 1:
+        shuffle_generator = torch.Generator()
+        shuffle_generator.manual_seed(int(torch.randint(0, 2 ** 31 - 1, (1,)).item()))
+
+    # singletons of the training set are replaced by <unk> afresh in every batch
+    train_collate = utils.TransitionCollate(f_map['<eof>'], l_map['<pad>'], a_map['<pad>'], f_map['<unk>'], singleton_mask, args.singleton_rate)
+    collate = utils.TransitionCollate(f_map['<eof>'], l_map['<pad>'], a_map['<pad>'])
+    dataset_loader, dev_dataset_loader, test_dataset_loader = [
+        [torch.utils.data.DataLoader(tup, batch_sampler=utils.TokenBudgetSampler([len(action) for action in tup.action_tensor], args.batch_tokens, args.batch_size, shuffle=shuffle, generator=shuffle_generator),
+                                     collate_fn=tup_collate)]
+        for tup, shuffle, tup_collate in [(dataset, True, train_collate), (dev_dataset, False, collate), (test_dataset, False, collate)]]
 
     # build model
     print('building model')
-    ner_model = TransitionNER(args.mode, a_map, f_map, l_map, char_map, ner_map, len(f_map), len(a_map), args.embedding_dim, args.action_embedding_dim, args.char_embedding_dim, args.hidden, args.char_hidden, args.layers, args.drop_out,
+    n_trainable_words = len(f_map) if frozen_rows is None else len(f_map) - frozen_rows.size(0)
+    ner_model = TransitionNER(args.mode, a_map, f_map, l_map, char_map, ner_map, n_trainable_words, len(a_map), args.embedding_dim, args.action_embedding_dim, args.char_embedding_dim, args.hidden, args.char_hidden, args.layers, args.drop_out,
                          args.spelling, args.char_structure, is_cuda=args.gpu)
 
     if args.load_check_point:
+        if frozen_rows is not None:
+            ner_model.page_word_embedding(args.emb_cache, frozen_rows, args.paged_embedding)
         ner_model.load_state_dict(checkpoint_file['state_dict'])
     else:
         if not args.rand_embedding:
             ner_model.load_pretrained_embedding(embedding_tensor)
         print('random initialization')
         ner_model.rand_init(init_word_embedding=args.rand_embedding)
+        if frozen_rows is not None:
+            ner_model.page_word_embedding(args.emb_cache, frozen_rows, args.paged_embedding)
 
     if args.update == 'sgd':
         optimizer = optim.SGD(ner_model.parameters(), lr=args.lr, momentum=args.momentum, nesterov=True)
@@ -165,43 +266,49 @@ if __name__ == "__main__":
     else:
         if_cuda = False
 
+    dp = None
+    if args.dp_workers > 1:
+        if if_cuda:
+            raise ValueError('data-parallel training (--dp_workers) runs on the cpu, use --gpu -1')
+        dp = DataParallel(args.dp_workers, args.dp_port)
+        if dp.rank > 0:
+            # only rank 0 reports, evaluates and saves checkpoints
+            args.async_eval = False
+            args.profile = ''
+            sys.stdout = open(os.devnull, 'w')
+
+    profiler = profiling.NULL_PROFILER
+    if args.profile:
+        profiler = profiling.Profiler(synchronize=if_cuda)
+        ner_model.enable_profiler(profiler)
+        profile_file = open(args.profile, 'w')
+
+    if 'f' in args.eva_matrix:
+        score_fn = lambda model, loader: evaluate.calc_f1_score(model, loader, a_map, if_cuda and not args.async_eval)
+    else:
+        score_fn = lambda model, loader: (evaluate.calc_score(model, loader, if_cuda and not args.async_eval),)
+    if args.async_eval:
+        evaluator = evaluate.AsyncEvaluator(score_fn, dev_dataset_loader, test_dataset_loader, ner_model)
+    else:
+        evaluator = evaluate.Evaluator(score_fn, dev_dataset_loader, test_dataset_loader)
+
     tot_length = sum(map(lambda t: len(t), dataset_loader))
-    best_f1 = float('-inf')
-    best_acc = float('-inf')
     track_list = list()
+    # dev scores of the last scored epoch, test scores of the best one
+    last_scores = {'dev': None, 'test': None}
     start_time = time.time()
     epoch_list = range(args.start_epoch, args.start_epoch + args.epoch)
     patience_count = 0
 
-    for epoch_idx, args.start_epoch in enumerate(epoch_list):
-
-        epoch_loss = 0
-        ner_model.train()
-    
-        for feature, label, action in tqdm(
-                itertools.chain.from_iterable(dataset_loader), mininterval=2,
-                desc=' - Tot it %d (epoch %d)' % (tot_length, args.start_epoch), leave=False, file=sys.stdout):
-
-            fea_v, la_v, ac_v = utils.repack_vb(if_cuda, feature, label, action)
-            ner_model.zero_grad()  # zeroes the gradient of all parameters
-            # loss, _, _ = ner_model.forward(fea_v, ac_v)
-            loss, _, _ = ner_model.forward_batch(fea_v, ac_v)
-            loss.backward()
-            nn.utils.clip_grad_norm(ner_model.parameters(), args.clip_grad)
-            optimizer.step()
-            epoch_loss += utils.to_scalar(loss)
-
-        # update lr
-        utils.adjust_learning_rate(optimizer, args.lr / (1 + (args.start_epoch + 1) * args.lr_decay))
-
+    def track_scores(epoch, epoch_loss, state, dev_scores, test_scores):
+        """
+        report the scores of an epoch, test_scores are only given when dev improved and the epoch's snapshot is then saved
+        """
         if 'f' in args.eva_matrix:
-            dev_f1, dev_pre, dev_rec, dev_acc = evaluate.calc_f1_score(ner_model, dev_dataset_loader, a_map, if_cuda)
-
-            if dev_f1 > best_f1:
-                patience_count = 0
-                best_f1 = dev_f1
+            dev_f1, dev_pre, dev_rec, dev_acc = dev_scores
 
-                test_f1, test_pre, test_rec, test_acc = evaluate.calc_f1_score(ner_model, test_dataset_loader, a_map, if_cuda)
+            if test_scores is not None:
+                test_f1, test_pre, test_rec, test_acc = test_scores
 
                 track_list.append(
                     {'loss': epoch_loss, 'dev_f1': dev_f1, 'dev_acc': dev_acc, 'test_f1': test_f1,
@@ -210,7 +317,7 @@ if __name__ == "__main__":
                 print(
                     '(loss: %.4f, epoch: %d, dev F1 = %.4f, dev pre = %.4f, dev rec = %.4f, dev acc = %.4f, F1 on test = %.4f, pre on test = %.4f, rec on test = %.4f, acc on test= %.4f), saving...' %
                     (epoch_loss,
-                     args.start_epoch,
+                     epoch,
                      dev_f1,
                      dev_pre,
                      dev_rec,
@@ -220,39 +327,20 @@ if __name__ == "__main__":
                      test_rec,
                      test_acc))
 
-                try:
-                    utils.save_checkpoint({
-                        'epoch': args.start_epoch,
-                        'state_dict': ner_model.state_dict(),
-                        'optimizer': optimizer.state_dict(),
-                        'f_map': f_map,
-                        'l_map': l_map,
-                        'a_map': a_map,
-                        'ner_map': ner_map,
-                    }, {'track_list': track_list,
-                        'args': vars(args)
-                        }, args.checkpoint + 'stack_lstm')
-                except Exception as inst:
-                    print(inst)
-
             else:
-                patience_count += 1
                 print('(loss: %.4f, epoch: %d, dev F1 = %.4f, dev acc = %.4f)' %
                       (epoch_loss,
-                       args.start_epoch,
+                       epoch,
                        dev_f1,
                        dev_acc))
                 track_list.append({'loss': epoch_loss, 'dev_f1': dev_f1, 'dev_acc': dev_acc})
 
         else:
 
-            dev_acc = evaluate.calc_score(ner_model, dev_dataset_loader, if_cuda)
-
-            if dev_acc > best_acc:
-                patience_count = 0
-                best_acc = dev_acc
+            dev_acc, = dev_scores
 
-                test_acc = evaluate.calc_score(ner_model, test_dataset_loader, if_cuda)
+            if test_scores is not None:
+                test_acc, = test_scores
 
                 track_list.append(
                     {'loss': epoch_loss, 'dev_acc': dev_acc, 'test_acc': test_acc})
@@ -260,46 +348,126 @@ if __name__ == "__main__":
                 print(
                     '(loss: %.4f, epoch: %d, dev acc = %.4f, acc on test= %.4f), saving...' %
                     (epoch_loss,
-                     args.start_epoch,
+                     epoch,
                      dev_acc,
                      test_acc))
 
-                try:
-                    utils.save_checkpoint({
-                        'epoch': args.start_epoch,
-                        'state_dict': ner_model.state_dict(),
-                        'optimizer': optimizer.state_dict(),
-                        'f_map': f_map,
-                        'l_map': l_map,
-                        'a_map': a_map,
-                        'ner_map': ner_map,
-                    }, {'track_list': track_list,
-                        'args': vars(args)
-                        }, args.checkpoint + 'stack_lstm')
-                except Exception as inst:
-                    print(inst)
-
             else:
-                patience_count += 1
                 print('(loss: %.4f, epoch: %d, dev acc = %.4f)' %
                       (epoch_loss,
-                       args.start_epoch,
+                       epoch,
                        dev_acc))
                 track_list.append({'loss': epoch_loss, 'dev_acc': dev_acc})
 
+        last_scores['dev'] = dev_scores
+        if test_scores is not None:
+            last_scores['test'] = test_scores
+            try:
+                utils.save_checkpoint({
+                    'epoch': epoch,
+                    'state_dict': state['state_dict'],
+                    'optimizer': state['optimizer'],
+                    'f_map': f_map,
+                    'l_map': l_map,
+                    'a_map': a_map,
+                    'char_map': char_map,
+                    'ner_map': ner_map,
+                    'singleton_mask': singleton_mask,
+                }, {'track_list': track_list,
+                    'args': vars(args)
+                    }, args.checkpoint + 'stack_lstm')
+            except Exception as inst:
+                print(inst)
+
+    for epoch_idx, args.start_epoch in enumerate(epoch_list):
+
+        epoch_loss = 0
+        ner_model.train()
+        if dp is not None:
+            dp.start_epoch()
+        batches = itertools.chain.from_iterable(dataset_loader)
+        if profiler.enabled:
+            batches = profiler.batches(batches, lambda report: profile_file.write(json.dumps(dict(report, type='batch', epoch=args.start_epoch)) + '\n'))
+    
+        for feature, label, action in tqdm(
+                batches, mininterval=2,
+                desc=' - Tot it %d (epoch %d)' % (tot_length, args.start_epoch), leave=False, file=sys.stdout):
+
+            if dp is not None:
+                feature, label, action = dp.shard(feature, label, action)
+            fea_v, la_v, ac_v = utils.repack_vb(if_cuda, feature, label, action)
+            ner_model.zero_grad()  # zeroes the gradient of all parameters
+            # loss, _, _ = ner_model.forward(fea_v, ac_v)
+            batch_loss = 0
+            if fea_v.size(0) > 0:
+                with profiler.timer('forward'):
+                    loss, _, _ = ner_model.forward_batch(fea_v, ac_v)
+                with profiler.timer('backward'):
+                    loss.backward()
+                batch_loss = utils.to_scalar(loss)
+            if dp is not None:
+                with profiler.timer('grad_sync'):
+                    batch_loss = dp.all_reduce(ner_model.parameters(), batch_loss)
+            with profiler.timer('optimizer'):
+                nn.utils.clip_grad_norm(ner_model.parameters(), args.clip_grad)
+                optimizer.step()
+            epoch_loss += batch_loss
+
+        if profiler.enabled:
+            report = profiler.end_epoch()
+            profile_file.write(json.dumps(dict(report, type='epoch', epoch=args.start_epoch)) + '\n')
+            profile_file.flush()
+            print('profile: ' + profiling.format_report(report))
+
+        if dp is not None:
+            report = dp.epoch_report()
+            print('data parallel: %d processes, %.1f sentences/s, %.1f%% of wall time in gradient sync' %
+                  (report['processes'], report['sentences_per_sec'], 100 * report['sync_share']))
+
+        # update lr
+        utils.adjust_learning_rate(optimizer, args.lr / (1 + (args.start_epoch + 1) * args.lr_decay))
+
+        if dp is None or dp.rank == 0:
+            evaluator.submit(args.start_epoch, epoch_loss, ner_model, optimizer)
+
+        # scores arrive in epoch order: right away, or with --async_eval while the next epochs train
+        for epoch, epoch_loss, state, dev_scores, test_scores in evaluator.results(wait=epoch_idx == len(epoch_list) - 1):
+            track_scores(epoch, epoch_loss, state, dev_scores, test_scores)
+            patience_count = 0 if test_scores is not None else patience_count + 1
+
         print('epoch: ' + str(args.start_epoch) + '\t in ' + str(args.epoch) + ' take: ' + str(
             time.time() - start_time) + ' s')
 
-        if patience_count >= args.patience and args.start_epoch >= args.least_iters:
+        stop = patience_count >= args.patience and args.start_epoch >= args.least_iters
+        if dp is not None:
+            stop = dp.should_stop(stop)
+        if stop:
             break
 
+    # after an early stop, --async_eval may still be scoring the last epochs, one of them can be the best
+    for epoch, epoch_loss, state, dev_scores, test_scores in evaluator.results(wait=True):
+        track_scores(epoch, epoch_loss, state, dev_scores, test_scores)
+    evaluator.close()
+    if profiler.enabled:
+        profile_file.close()
+    if dp is not None:
+        if dp.rank > 0:
+            sys.stdout.close()
+            sys.stdout = sys.__stdout__
+        dp.close()
+
     # print best
-    if 'f' in args.eva_matrix:
-        print(
-            args.checkpoint + ' dev_f1: %.4f dev_rec: %.4f dev_pre: %.4f dev_acc: %.4f test_f1: %.4f test_rec: %.4f test_pre: %.4f test_acc: %.4f\n' % (
-            dev_f1, dev_rec, dev_pre, dev_acc, test_f1, test_rec, test_pre, test_acc))
-    else:
-        print(args.checkpoint + ' dev_acc: %.4f test_acc: %.4f\n' % (dev_acc, test_acc))
+    if last_scores['dev'] is not None:
+        if 'f' in args.eva_matrix:
+            dev_f1, dev_pre, dev_rec, dev_acc = last_scores['dev']
+            test_f1, test_pre, test_rec, test_acc = last_scores['test']
+            print(
+                args.checkpoint + ' dev_f1: %.4f dev_rec: %.4f dev_pre: %.4f dev_acc: %.4f test_f1: %.4f test_rec: %.4f test_pre: %.4f test_acc: %.4f\n' % (
+                dev_f1, dev_rec, dev_pre, dev_acc, test_f1, test_rec, test_pre, test_acc))
+        else:
+            dev_acc, = last_scores['dev']
+            test_acc, = last_scores['test']
+            print(args.checkpoint + ' dev_acc: %.4f test_acc: %.4f\n' % (dev_acc, test_acc))
 
     # printing summary
     print('setting:')